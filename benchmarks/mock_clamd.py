@@ -0,0 +1,50 @@
+#########################################################################
+#
+# Program name:    mock_clamd.py (Docket Socket benchmarks)
+#
+# Purpose: A stand-in for clamd that answers the INSTREAM command,
+# flagging any file containing the EICAR test string, so the scan
+# stage can be benchmarked without ClamAV's signature database.
+#
+##########################################################################
+
+import os
+import socketserver
+import struct
+import threading
+
+EICAR_MARKER = b"EICAR-STANDARD-ANTIVIRUS-TEST-FILE"
+
+class ClamdHandler(socketserver.StreamRequestHandler):
+    """Answers zINSTREAM with "stream: OK" or "stream: Eicar-Test-Signature FOUND"."""
+    def handle(self):
+        command = self.rfile.read(10)
+        if command != b"zINSTREAM\0":
+            self.wfile.write(b"UNKNOWN COMMAND\0")
+            return
+        found = False
+        tail = b""
+        while True:
+            size = struct.unpack("!L", self.rfile.read(4))[0]
+            if size == 0:
+                break
+            chunk = self.rfile.read(size)
+            # keep the end of the last chunk so a marker split across chunks is still found
+            found = found or EICAR_MARKER in tail + chunk
+            tail = chunk[-len(EICAR_MARKER):]
+        self.wfile.write(b"stream: Eicar-Test-Signature FOUND\0" if found else b"stream: OK\0")
+
+class ClamdServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def start(socket_path):
+    """Starts the stand-in clamd on a unix socket in a background thread.
+
+    Returns:
+            The server; socket_path is the address to use as views.CLAMD_ADDRESS.
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = ClamdServer(socket_path, ClamdHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
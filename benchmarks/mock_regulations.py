@@ -0,0 +1,237 @@
+#########################################################################
+#
+# Program name:    mock_regulations.py (Docket Socket benchmarks)
+#
+# Purpose: A local stand-in for the regulations.gov v3 API
+# (documents.json, document.json and download) serving synthetic
+# dockets, so Docket Socket can be benchmarked without using API quota.
+#
+# Dockets are named BENCH-<number of records>, ex: BENCH-10, BENCH-500000.
+# Records are generated from their number, so no docket is held in memory.
+#
+# Run on its own with:  python benchmarks/mock_regulations.py --port 8000
+#
+##########################################################################
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Mix of document types in a synthetic docket (out of 10 records)
+DOCUMENT_TYPES = ["Public Submission"] * 8 + ["Supporting & Related Material", "Rule"]
+FILE_TYPES = [".pdf", ".pdf", ".pdf", ".docx", ".htm"]
+CONTENT_TYPES = {".pdf": "application/pdf", ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document", ".htm": "text/html"}
+EICAR = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+
+class MockConfig(object):
+    """How the stand-in server behaves.
+
+    Arg:
+            latency: seconds added to every response
+            jitter: up to this many seconds more, at random
+            error_rate: fraction of requests answered with a 503
+            rate_limit: requests allowed per key per hour, reported in X-RateLimit-Limit/-Remaining
+                    (requests past it get a 429 with X-RateLimit-Reset)
+            attachment_bytes: average size of a downloaded file
+            form_letter_rate: fraction of comments that are the same form letter with the same attachment
+            withdrawn_rate: fraction of records listed as Withdrawn
+            virus_every: every this many records has a file containing the EICAR test string (0 for none)
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=10**9, attachment_bytes=20000,
+            form_letter_rate=0.3, withdrawn_rate=0.01, virus_every=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.attachment_bytes = attachment_bytes
+        self.form_letter_rate = form_letter_rate
+        self.withdrawn_rate = withdrawn_rate
+        self.virus_every = virus_every
+
+def docket_size(docket_ID):
+    """Number of records in a synthetic docket, from its name (BENCH-<records>). 0 for any other docket."""
+    match = re.match("BENCH-([0-9]+)$", docket_ID or "")
+    return int(match.group(1)) if match else 0
+
+def seeded(document_ID):
+    """A random number generator that gives the same numbers every time for a document."""
+    return random.Random(int(hashlib.md5(document_ID.encode("utf-8")).hexdigest()[:8], 16))
+
+def listing_record(docket_ID, number, config):
+    """The documents.json entry for record number of a docket."""
+    document_ID = "%s-%07d" % (docket_ID, number)
+    rng = seeded(document_ID)
+    return {"documentId": document_ID,
+        "documentType": DOCUMENT_TYPES[number % len(DOCUMENT_TYPES)],
+        "documentStatus": "Withdrawn" if rng.random() < config.withdrawn_rate else "Posted",
+        "postedDate": "2016-%02d-%02dT00:00:00-04:00" % (number % 12 + 1, number % 28 + 1),
+        "title": "Synthetic document %s" % number}
+
+def document_json(document_ID, base_url, config):
+    """The document.json response for a synthetic document."""
+    docket_ID, number = document_ID.rsplit("-", 1)
+    number = int(number)
+    record = listing_record(docket_ID, number, config)
+    rng = seeded(document_ID)
+    form_letter = record["documentType"] == "Public Submission" and rng.random() < config.form_letter_rate
+    value = lambda text: {"label": "", "value": text}
+    def file_formats(attachment_number=None):
+        file_type = FILE_TYPES[(number + (attachment_number or 0)) % len(FILE_TYPES)]
+        query = {"documentId": document_ID, "contentType": file_type[1:]}
+        if attachment_number is not None:
+            query["attachmentNumber"] = attachment_number
+        return ["%s/download?%s" % (base_url, urllib.parse.urlencode(query))]
+    attachments = [{"fileFormats": file_formats(attachment_number)} for attachment_number in range(1, 1 + (1 if form_letter else rng.randint(0, 3)))]
+    json_data = {"documentId": value(document_ID),
+        "documentType": value(record["documentType"]),
+        "title": value(record["title"]),
+        "postedDate": record["postedDate"],
+        "submitterName": value("Submitter %s" % rng.randint(1, 5000)),
+        "organization": value("Organization %s" % rng.randint(1, 200) if rng.random() < 0.3 else ""),
+        "comment": value("I support the proposed rule. " * 20 if form_letter else
+            "See attached" if rng.random() < 0.2 else "Comment %s: %s" % (number, " ".join(rng.choice(["rule", "agency", "cost", "benefit", "public", "health"]) for word in range(rng.randint(20, 400))))),
+        "abstract": value("Abstract of %s" % document_ID if record["documentType"] == "Rule" else ""),
+        "attachmentCount": value(len(attachments)),
+        "attachments": attachments}
+    if record["documentType"] != "Public Submission":
+        json_data["fileFormats"] = file_formats()
+    return json_data
+
+def download_body(query, config):
+    """Name and content of a downloaded file. Form letter attachments have the same content."""
+    document_ID = query.get("documentId", "")
+    docket_ID, number = document_ID.rsplit("-", 1)
+    rng = seeded(document_ID + query.get("attachmentNumber", ""))
+    if query.get("attachmentNumber") == "1" and document_json(document_ID, "", config)["comment"]["value"].startswith("I support"):
+        rng = seeded("form letter")
+    size = max(1, int(config.attachment_bytes * rng.uniform(0.5, 1.5)))
+    content = (("%s " % rng.random()).encode("ascii") * (size // 20 + 1))[:size]
+    if config.virus_every and int(number) % config.virus_every == 0:
+        content = EICAR + content
+    return "%s.%s" % (document_ID, query.get("contentType", "pdf")), content
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Answers documents.json, document.json and download requests like the v3 API."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        base_url = "http://%s:%s/regulations/v3" % self.server.server_address[:2]
+        delay = config.latency + random.uniform(0, config.jitter)
+        if delay:
+            time.sleep(delay)
+        api_key = query.get("api_key", "")
+        with server.lock:
+            server.requests += 1
+            window = int(time.time() // 3600)
+            if server.rate_limit_window.get(api_key) != window:
+                server.rate_limit_window[api_key] = window
+                server.rate_limit_used[api_key] = 0
+            server.rate_limit_used[api_key] += 1
+            remaining = config.rate_limit - server.rate_limit_used[api_key]
+        headers = {"X-RateLimit-Limit": str(config.rate_limit), "X-RateLimit-Remaining": str(max(remaining, 0))}
+        if remaining < 0:
+            headers["X-RateLimit-Reset"] = str(int(3600 - time.time() % 3600))
+            return self.send(429, b'{"error": "OVER_RATE_LIMIT"}', headers=headers)
+        if random.random() < config.error_rate:
+            return self.send(503, b'{"error": "injected"}', headers=headers)
+        if url.path.endswith("/documents.json"):
+            docket_ID = query.get("dktid")
+            size = docket_size(docket_ID)
+            offset = int(query.get("po", 0))
+            records_per_page = int(query.get("rpp", 25))
+            documents = []
+            if query.get("countsOnly") != "1":
+                documents = [listing_record(docket_ID, number, config) for number in range(offset, min(size, offset + records_per_page))]
+            body = json.dumps({"totalNumRecords": size, "documents": documents}).encode("utf-8")
+            self.send(200, body, headers=headers)
+        elif url.path.endswith("/document.json"):
+            document_ID = query.get("documentId", "")
+            if not docket_size(document_ID.rsplit("-", 1)[0]):
+                return self.send(404, b'{"error": "not found"}', headers=headers)
+            self.send(200, json.dumps(document_json(document_ID, base_url, config)).encode("utf-8"), headers=headers)
+        elif url.path.endswith("/download"):
+            file_name, content = download_body(query, config)
+            headers["Content-Disposition"] = 'attachment; filename="%s"' % file_name
+            with server.lock:
+                server.bytes_sent += len(content)
+            self.send(200, content, CONTENT_TYPES.get("." + query.get("contentType", "pdf"), "application/octet-stream"), headers)
+        else:
+            self.send(404, b'{"error": "not found"}', headers=headers)
+
+    def send(self, status, body, content_type="application/json", headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class MockServer(ThreadingHTTPServer):
+    """The stand-in API server. Counts the requests answered and bytes downloaded."""
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        ThreadingHTTPServer.__init__(self, address, MockHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.rate_limit_window = {}
+        self.rate_limit_used = {}
+
+    @property
+    def api_base(self):
+        """The url to use as views.API_BASE."""
+        return "http://%s:%s/regulations/v3" % self.server_address[:2]
+
+def start(config=None, host="127.0.0.1", port=0):
+    """Starts the stand-in server in a background thread.
+
+    Returns:
+            The MockServer; its api_base is the url to use as views.API_BASE.
+    """
+    server = MockServer((host, port), config or MockConfig())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_config_arguments(parser):
+    """Adds the MockConfig options to an argparse parser."""
+    defaults = MockConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="up to this many more seconds, at random")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="fraction of requests answered with a 503")
+    parser.add_argument("--rate-limit", type=int, default=defaults.rate_limit, help="requests per key per hour")
+    parser.add_argument("--attachment-bytes", type=int, default=defaults.attachment_bytes, help="average size of a downloaded file")
+    parser.add_argument("--form-letter-rate", type=float, default=defaults.form_letter_rate, help="fraction of comments that are a form letter")
+    parser.add_argument("--withdrawn-rate", type=float, default=defaults.withdrawn_rate, help="fraction of records withdrawn")
+    parser.add_argument("--virus-every", type=int, default=defaults.virus_every, help="every this many records has an EICAR file (0 for none)")
+
+def config_from_arguments(arguments):
+    """The MockConfig for options added by add_config_arguments."""
+    return MockConfig(latency=arguments.latency, jitter=arguments.jitter, error_rate=arguments.error_rate,
+        rate_limit=arguments.rate_limit, attachment_bytes=arguments.attachment_bytes, form_letter_rate=arguments.form_letter_rate,
+        withdrawn_rate=arguments.withdrawn_rate, virus_every=arguments.virus_every)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the regulations.gov v3 API serving synthetic dockets (BENCH-<records>).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_config_arguments(parser)
+    arguments = parser.parse_args()
+    server = MockServer((arguments.host, arguments.port), config_from_arguments(arguments))
+    print("Serving %s (try %s/documents.json?dktid=BENCH-100&countsOnly=1)" % (server.api_base, server.api_base))
+    server.serve_forever()
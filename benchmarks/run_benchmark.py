@@ -0,0 +1,196 @@
+#########################################################################
+#
+# Program name:    run_benchmark.py (Docket Socket benchmarks)
+#
+# Purpose: Runs docket_socket end to end against the local stand-in
+# API (mock_regulations.py) and clamd (mock_clamd.py) for synthetic
+# dockets of different sizes, and reports wall time, peak memory,
+# and requests and bytes per second.
+#
+# Examples:
+#   python benchmarks/run_benchmark.py --records 10 1000 10000
+#   python benchmarks/run_benchmark.py --records 1000 --runs 2 --latency 0.05
+#   python benchmarks/run_benchmark.py --records 500000 --doctype comments
+#   python benchmarks/run_benchmark.py --json new.json --compare baseline.json
+#   python benchmarks/run_benchmark.py --set DOWNLOAD_WORKERS=16 --set SCAN_WORKERS=8
+#
+# Each docket is run in a new process, so peak memory is measured per run.
+# With --runs 2 or more, later runs reuse the job folder and caches of the
+# first, measuring a resumed or repeated job.
+#
+##########################################################################
+
+import argparse
+import ast
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIRECTORY)
+import mock_clamd
+import mock_regulations
+
+REPOSITORY_DIRECTORY = os.path.dirname(BENCHMARK_DIRECTORY)
+DEFAULT_RECORDS = [10, 1000, 10000]
+# Reported for each run; compared against a baseline with --compare
+REPORT_COLUMNS = [("records", "records", "%d"), ("run", "run", "%d"), ("ok", "ok", "%s"), ("wall_seconds", "wall s", "%.2f"),
+    ("peak_rss_mb", "peak MB", "%.1f"), ("requests", "requests", "%d"), ("requests_per_second", "req/s", "%.1f"),
+    ("downloaded_mb", "MB in", "%.1f"), ("mb_per_second", "MB/s", "%.2f"), ("zip_mb", "zip MB", "%.1f")]
+LOWER_IS_BETTER = ("wall_seconds", "peak_rss_mb")
+
+def point_views_at(views, work_directory, api_base, clamd_address, rate_limit):
+    """Points Docket Socket's server paths, API and clamd at the benchmark's own.
+
+    Arg:
+            views: the imported views module
+            work_directory: folder for the job folders, zips, databases and caches of a benchmark
+            api_base: url of the stand-in API
+            clamd_address: unix socket of the stand-in clamd
+            rate_limit: requests per hour the stand-in API allows
+    """
+    views.PROCESS_DIRECTORY = os.path.join(work_directory, "docket_process_files")
+    views.ZIPPATH = os.path.join(work_directory, "www_docket")
+    views.JOBS_DB = os.path.join(views.PROCESS_DIRECTORY, "docket_socket_jobs.sqlite3")
+    views.RATE_LIMIT_DB = os.path.join(views.PROCESS_DIRECTORY, "docket_socket_rate_limit.sqlite3")
+    views.CACHE_DIRECTORY = os.path.join(work_directory, "docket_cache")
+    views.METADATA_CACHE_DIRECTORY = os.path.join(views.CACHE_DIRECTORY, "documents")
+    views.SEARCH_DB = os.path.join(views.PROCESS_DIRECTORY, "docket_socket_search.sqlite3")
+    views.API_BASE = api_base
+    views.CLAMD_ADDRESS = clamd_address
+    views.RATE_LIMIT_PER_HOUR = rate_limit
+    for directory in (views.PROCESS_DIRECTORY, views.ZIPPATH):
+        os.makedirs(directory, exist_ok=True)
+
+def run_docket(result_queue, docket_ID, doctype, work_directory, api_base, clamd_address, rate_limit, overrides):
+    """Runs docket_socket once for docket_ID (in a process of its own) and puts its measurements on result_queue."""
+    sys.path.insert(0, REPOSITORY_DIRECTORY)
+    from django.conf import settings
+    settings.configure(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+    import django
+    django.setup()
+    import views
+    point_views_at(views, work_directory, api_base, clamd_address, rate_limit)
+    for name, value in overrides.items():
+        setattr(views, name, value)
+    started = time.time()
+    ok = views.docket_socket(views.PROCESS_DIRECTORY, None, docket_ID, doctype, "benchmark@gao.gov")
+    wall_seconds = time.time() - started
+    summary = views.metrics_summary()
+    zip_bytes = sum(os.path.getsize(os.path.join(views.ZIPPATH, name)) for name in os.listdir(views.ZIPPATH))
+    result_queue.put({"ok": ok, "wall_seconds": wall_seconds,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "zip_mb": zip_bytes / 1024.0**2,
+        "counters": summary["counters"],
+        "timings": dict((metric, dict((label, {"count": stats["count"], "seconds": stats["seconds"], "bytes": stats["bytes"]})
+            for label, stats in labels.items())) for metric, labels in summary["timings"].items())})
+
+def benchmark(records, runs, doctype, config, overrides, keep=False):
+    """Benchmarks docket_socket on a synthetic docket of the given number of records.
+
+    Returns:
+            A list with the measurements of each run.
+    """
+    work_directory = tempfile.mkdtemp(prefix="docket_socket_benchmark_")
+    server = mock_regulations.start(config)
+    clamd = mock_clamd.start(os.path.join(work_directory, "clamd.sock"))
+    context = multiprocessing.get_context("spawn")
+    results = []
+    try:
+        for run in range(1, runs + 1):
+            requests_before, bytes_before = server.requests, server.bytes_sent
+            result_queue = context.Queue()
+            process = context.Process(target=run_docket, args=(result_queue, "BENCH-%d" % records, doctype, work_directory,
+                server.api_base, clamd.server_address, config.rate_limit, overrides))
+            process.start()
+            result = result_queue.get()
+            process.join()
+            result.update(records=records, run=run,
+                requests=server.requests - requests_before,
+                downloaded_mb=(server.bytes_sent - bytes_before) / 1024.0**2)
+            result["requests_per_second"] = result["requests"] / result["wall_seconds"]
+            result["mb_per_second"] = result["downloaded_mb"] / result["wall_seconds"]
+            results.append(result)
+            print(format_row(result))
+            sys.stdout.flush()
+    finally:
+        server.shutdown()
+        clamd.shutdown()
+        if keep:
+            print("Kept %s" % work_directory)
+        else:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    return results
+
+def format_row(result):
+    """One line of the report table."""
+    return "  ".join((format % result[key]).rjust(max(len(heading), 8)) for key, heading, format in REPORT_COLUMNS)
+
+def compare(results, baseline, tolerance):
+    """Compares results with an earlier --json report.
+
+    Returns:
+            A list of regressions: measurements more than tolerance (a fraction) worse than the baseline.
+    """
+    earlier = dict(((result["records"], result["run"]), result) for result in baseline["results"])
+    regressions = []
+    for result in results:
+        before = earlier.get((result["records"], result["run"]))
+        if before is None:
+            continue
+        for key in LOWER_IS_BETTER:
+            if before[key] > 0 and result[key] > before[key] * (1 + tolerance):
+                regressions.append("BENCH-%s run %s: %s %.2f -> %.2f (+%.0f%%)" % (result["records"], result["run"], key,
+                    before[key], result[key], 100 * (result[key] / before[key] - 1)))
+    return regressions
+
+def parse_override(text):
+    """NAME=VALUE from --set, with VALUE a python literal (ex: DOWNLOAD_WORKERS=16)."""
+    name, value = text.split("=", 1)
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark docket_socket against a local stand-in for the regulations.gov API.")
+    parser.add_argument("--records", type=int, nargs="+", default=DEFAULT_RECORDS, help="sizes of the synthetic dockets (10 to 500000)")
+    parser.add_argument("--runs", type=int, default=1, help="runs per docket; later runs reuse the job folder and caches")
+    parser.add_argument("--doctype", default="comments,supporting,primary", help="document types to download, comma separated")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], type=parse_override, metavar="NAME=VALUE",
+        help="override a views.py setting, ex: DOWNLOAD_WORKERS=16")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with the results of an earlier --json run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fraction worse than --compare that counts as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the job folders, zips and databases")
+    mock_regulations.add_config_arguments(parser)
+    arguments = parser.parse_args()
+    config = mock_regulations.config_from_arguments(arguments)
+    overrides = dict(arguments.overrides)
+    doctype = arguments.doctype.split(",")
+
+    print("  ".join(heading.rjust(max(len(heading), 8)) for key, heading, format in REPORT_COLUMNS))
+    results = []
+    for records in arguments.records:
+        results.extend(benchmark(records, arguments.runs, doctype, config, overrides, arguments.keep))
+    if arguments.json:
+        with open(arguments.json, "w") as report_file:
+            json.dump({"settings": dict(vars(arguments), overrides=overrides), "results": results}, report_file, indent=1, default=str)
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), arguments.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
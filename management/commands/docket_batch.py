@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...views import parse_docket_list, submit_batch, run_batch
+
+
+class Command(BaseCommand):
+    help = "Queues several dockets as one Docket Socket batch (one combined index and one email)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dockets', nargs='+', help='Docket numbers (or a file of them with @path)')
+        parser.add_argument('--email', required=True, help='GAO email address notified when the batch is done')
+        parser.add_argument('--doc-type', default='comments',
+            help='Comma separated document types: comments, primary, supporting (default comments)')
+        parser.add_argument('--run', action='store_true',
+            help='Run the batch in this process instead of leaving it for docket_worker')
+
+    def handle(self, *args, **options):
+        dockets = []
+        for docket in options['dockets']:
+            if docket.startswith('@'):
+                with open(docket[1:]) as docket_file:
+                    dockets.extend(parse_docket_list(docket_file.read()))
+            else:
+                dockets.append(docket)
+        dockets = parse_docket_list(dockets)
+        # with --run the batch is claimed as it is queued, so docket_worker cannot take it too
+        batch_id, errors = submit_batch(dockets, options['doc_type'].split(','), options['email'], claim=options['run'])
+        if batch_id is None:
+            raise CommandError("\n".join(errors))
+        self.stdout.write("Queued batch %s with %s docket(s)" % (batch_id, len(dockets)))
+        if options['run']:
+            run_batch(batch_id)
+            self.stdout.write("Finished batch %s" % batch_id)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ...views import enforce_retention, free_disk_bytes
+
+
+class Command(BaseCommand):
+    help = "Deletes Docket Socket job folders and zips that are too old, or over the disk quotas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list what would be deleted')
+
+    def handle(self, *args, **options):
+        deleted = enforce_retention(dry_run=options['dry_run'])
+        for folder, size, reason in deleted:
+            self.stdout.write("%s %s (%.1f MB): %s" % ("Would delete" if options['dry_run'] else "Deleted", folder, size / 1024.0**2, reason))
+        self.stdout.write("%.1f MB freed, %.1f GB free" % (sum(size for folder, size, reason in deleted) / 1024.0**2, free_disk_bytes() / 1024.0**3))
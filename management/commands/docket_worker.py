@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...views import run_worker, WORKER_PROCESSES
+
+
+class Command(BaseCommand):
+    help = "Runs queued Docket Socket downloads in a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=WORKER_PROCESSES,
+            help='Number of dockets downloaded at the same time (default %s)' % WORKER_PROCESSES)
+
+    def handle(self, *args, **options):
+        self.stdout.write("Docket worker started with %s process(es)" % options['processes'])
+        run_worker(options['processes'])
@@ -0,0 +1,338 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from . import views
+
+
+class RunPipelineTests(SimpleTestCase):
+    """run_pipeline: results in order, one failing item does not stop the others, and no threads are left behind."""
+
+    def setUp(self):
+        views.reset_metrics()
+        self.threads_before = threading.active_count()
+
+    def stages(self, fail_on=()):
+        def double(number):
+            time.sleep(0.001 * (number % 5)) # finish out of order
+            return number * 2
+        def check(number):
+            if number // 2 in fail_on:
+                raise ValueError(number)
+            return number + 1
+        return [("double", double, 4), ("check", check, 3)]
+
+    def assertNoThreadsLeft(self):
+        deadline = time.time() + 5
+        while threading.active_count() > self.threads_before and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(threading.active_count(), self.threads_before)
+
+    def test_results_in_order(self):
+        results = list(views.run_pipeline(range(200), self.stages()))
+        self.assertEqual([item for item, result, error in results], list(range(200)))
+        self.assertEqual([result for item, result, error in results], [number * 2 + 1 for number in range(200)])
+        self.assertNoThreadsLeft()
+
+    def test_failure_is_isolated(self):
+        results = list(views.run_pipeline(range(50), self.stages(fail_on={7, 31})))
+        failed = [item for item, result, error in results if error is not None]
+        self.assertEqual(failed, [7, 31])
+        self.assertIsInstance(results[7][2], ValueError)
+        self.assertEqual(len(results), 50)
+        self.assertEqual(results[8][1], 17)
+
+    def test_more_items_than_in_flight(self):
+        in_flight_limit = views.PIPELINE_MAX_IN_FLIGHT
+        views.PIPELINE_MAX_IN_FLIGHT = 5
+        try:
+            results = list(views.run_pipeline(range(100), self.stages()))
+        finally:
+            views.PIPELINE_MAX_IN_FLIGHT = in_flight_limit
+        self.assertEqual(len(results), 100)
+
+    def test_stopping_early_ends_every_thread(self):
+        records = views.run_pipeline(range(10000), self.stages())
+        for records_done, (item, result, error) in enumerate(records):
+            if records_done == 10:
+                break
+        # a worker left waiting on its queue would make close() wait for it forever
+        closing = threading.Thread(target=records.close, daemon=True)
+        closing.start()
+        closing.join(30)
+        self.assertFalse(closing.is_alive(), "pipeline threads did not stop")
+        self.assertNoThreadsLeft()
+
+    def test_feed_error_is_raised(self):
+        def items():
+            yield 1
+            raise IOError("listing failed")
+        with self.assertRaises(IOError):
+            list(views.run_pipeline(items(), self.stages()))
+        self.assertNoThreadsLeft()
+
+
+def set_views_globals(test, **values):
+    """Sets module globals of views for one test, restoring them when it ends."""
+    for name, value in values.items():
+        test.addCleanup(setattr, views, name, getattr(views, name))
+        setattr(views, name, value)
+
+
+class TemporaryStorageTestCase(SimpleTestCase):
+    """Points the job queue, rate limit database and job folders at a temporary directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        set_views_globals(self,
+            PROCESS_DIRECTORY=os.path.join(self.directory, "process"),
+            ZIPPATH=os.path.join(self.directory, "zips"),
+            CACHE_DIRECTORY=os.path.join(self.directory, "cache"),
+            METADATA_CACHE_DIRECTORY=os.path.join(self.directory, "cache", "documents"),
+            JOBS_DB=os.path.join(self.directory, "jobs.sqlite3"),
+            RATE_LIMIT_DB=os.path.join(self.directory, "rate_limit.sqlite3"))
+        for path in (views.PROCESS_DIRECTORY, views.ZIPPATH, views.METADATA_CACHE_DIRECTORY):
+            os.makedirs(path)
+        # rate_limit_db keeps one connection per thread
+        views.rate_limit_local.pid = None
+        self.addCleanup(self.close_rate_limit_db)
+
+    def close_rate_limit_db(self):
+        if getattr(views.rate_limit_local, "pid", None) is not None:
+            views.rate_limit_local.connection.close()
+            views.rate_limit_local.pid = None
+
+    def execute(self, sql, parameters=()):
+        connection = views.jobs_db()
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+
+class AcquireTokenTests(TemporaryStorageTestCase):
+    """acquire_token: fullest bucket first, and dockets take turns while tokens are scarce."""
+
+    def setUp(self):
+        super().setUp()
+        set_views_globals(self, API_KEYS=["key 1", "key 2"], RATE_LIMIT_PER_HOUR=100)
+
+    def set_tokens(self, api_key, tokens, blocked_until=0):
+        views.rate_limit_db().execute("UPDATE rate_limit SET tokens=?, updated=?, blocked_until=? WHERE api_key=?",
+            (tokens, time.time(), blocked_until, api_key))
+
+    def set_docket(self, docket_ID, last_served):
+        views.rate_limit_db().execute("INSERT OR REPLACE INTO rate_limit_dockets (docket, last_served, last_waiting) VALUES (?, ?, ?)",
+            (docket_ID, last_served, time.time()))
+
+    def test_fullest_bucket(self):
+        self.set_tokens("key 1", 60)
+        self.set_tokens("key 2", 90)
+        self.assertEqual(views.acquire_token("DOCKET-1"), "key 2")
+
+    def test_blocked_key_not_used(self):
+        self.set_tokens("key 1", 60)
+        self.set_tokens("key 2", 90, blocked_until=time.time() + 3600)
+        self.assertEqual(views.acquire_token("DOCKET-1"), "key 1")
+
+    def test_no_token(self):
+        self.set_tokens("key 1", 0)
+        self.set_tokens("key 2", 0)
+        with self.assertRaises(views.RateLimited):
+            views.acquire_token("DOCKET-1", can_wait=False)
+
+    def test_scarce_tokens_take_turns(self):
+        self.set_tokens("key 1", 10)
+        self.set_tokens("key 2", 0)
+        now = time.time()
+        self.set_docket("LARGE", now - 1)
+        self.set_docket("SMALL", now - 100)
+        # the docket served longest ago goes first
+        with self.assertRaises(views.RateLimited):
+            views.acquire_token("LARGE", can_wait=False)
+        self.assertEqual(views.acquire_token("SMALL", can_wait=False), "key 1")
+        with self.assertRaises(views.RateLimited):
+            views.acquire_token("SMALL", can_wait=False)
+        self.assertEqual(views.acquire_token("LARGE", can_wait=False), "key 1")
+
+    def test_plenty_of_tokens_no_turns(self):
+        self.set_tokens("key 1", views.FAIR_SHARE_RESERVE + 10)
+        self.set_tokens("key 2", 0)
+        now = time.time()
+        self.set_docket("LARGE", now - 1)
+        self.set_docket("SMALL", now - 100)
+        self.assertEqual(views.acquire_token("LARGE", can_wait=False), "key 1")
+
+
+class ManifestTests(TemporaryStorageTestCase):
+    """load_manifest and manifest_current: which records a rerun of a job can reuse."""
+
+    def setUp(self):
+        super().setUp()
+        self.PATH = os.path.join(views.PROCESS_DIRECTORY, "DOCKET-1_Comments")
+        os.makedirs(self.PATH)
+        self.file_path = os.path.join(self.PATH, "DOCKET-1-0001.pdf")
+        with open(self.file_path, "wb") as saved_file:
+            saved_file.write(b"x" * 100)
+        self.entry = {"ID": "DOCKET-1-0001", "Type": "Public Submission", "Listed": "2016-01-01T00:00:00-04:00",
+            "Files": [{"Path": self.file_path, "Size": 100}]}
+        self.listing = {"documentId": "DOCKET-1-0001", "documentType": "Public Submission", "postedDate": "2016-01-01T00:00:00-04:00"}
+
+    def test_later_entry_replaces_earlier(self):
+        with open(os.path.join(self.PATH, views.MANIFEST_NAME), "w") as manifest_file:
+            manifest_file.write(json.dumps(dict(self.entry, Incomplete=True)) + "\n")
+            manifest_file.write(json.dumps(dict(self.entry, ID="DOCKET-1-0002")) + "\n")
+            manifest_file.write(json.dumps(self.entry) + "\n")
+            manifest_file.write('{"ID": "DOCKET-1-0003", "Ty') # interrupted job
+        manifest = views.load_manifest(self.PATH)
+        self.assertEqual(sorted(manifest), ["DOCKET-1-0001", "DOCKET-1-0002"])
+        self.assertNotIn("Incomplete", manifest["DOCKET-1-0001"])
+
+    def test_no_manifest(self):
+        self.assertEqual(views.load_manifest(self.PATH), {})
+
+    def test_current(self):
+        self.assertTrue(views.manifest_current(self.entry, self.listing))
+
+    def test_not_in_manifest(self):
+        self.assertFalse(views.manifest_current(None, self.listing))
+
+    def test_listing_changed(self):
+        self.assertFalse(views.manifest_current(self.entry, dict(self.listing, postedDate="2017-01-01T00:00:00-04:00")))
+        self.assertFalse(views.manifest_current(self.entry, dict(self.listing, documentType="Rule")))
+
+    def test_incomplete(self):
+        self.assertFalse(views.manifest_current(dict(self.entry, Incomplete=True), self.listing))
+
+    def test_file_changed_or_missing(self):
+        with open(self.file_path, "ab") as saved_file:
+            saved_file.write(b"x")
+        self.assertFalse(views.manifest_current(self.entry, self.listing))
+        os.remove(self.file_path)
+        self.assertFalse(views.manifest_current(self.entry, self.listing))
+
+    def test_quarantined_file(self):
+        os.remove(self.file_path)
+        self.assertTrue(views.manifest_current(dict(self.entry, Quarantined=[self.file_path]), self.listing))
+
+
+class SchedulerTests(TemporaryStorageTestCase):
+    """claim_job and preempt_jobs: the order jobs run in, and which running job makes way."""
+
+    def setUp(self):
+        super().setUp()
+        set_views_globals(self, MIN_FREE_BYTES=0)
+
+    def enqueue(self, docket_ID, records, email="a@gao.gov", doctype=("comments",)):
+        return views.enqueue_job(docket_ID, list(doctype), email, records)
+
+    def start(self, job_id, started):
+        self.execute("UPDATE jobs SET status='running', started=? WHERE id=?", (started, job_id))
+
+    def test_smaller_job_first(self):
+        self.enqueue("DOCKET-1", 1000)
+        small = self.enqueue("DOCKET-2", 10)
+        self.assertEqual(views.claim_job()["id"], small)
+        self.assertEqual(views.get_job(small)["status"], "running")
+
+    def test_fair_share(self):
+        finished = self.enqueue("DOCKET-1", 100, email="a@gao.gov")
+        self.execute("UPDATE jobs SET status='done', started=?, finished=? WHERE id=?", (time.time() - 2000, time.time() - 1000, finished))
+        self.enqueue("DOCKET-2", 10, email="a@gao.gov")
+        other_email = self.enqueue("DOCKET-3", 10, email="b@gao.gov")
+        self.assertEqual(views.claim_job()["id"], other_email)
+
+    def test_fast_lane(self):
+        self.enqueue("DOCKET-1", int(views.FAST_LANE_SECONDS / views.SECONDS_PER_WORK_UNIT))
+        self.assertIsNone(views.claim_job(fast_lane=True))
+        self.assertIsNotNone(views.claim_job())
+
+    def test_uncounted_job_waits(self):
+        self.enqueue("DOCKET-1", 0)
+        self.assertIsNone(views.claim_job())
+
+    def test_same_folder_waits(self):
+        self.start(self.enqueue("DOCKET-1", 1000), time.time())
+        self.enqueue("DOCKET-1", 10)
+        other_docket = self.enqueue("DOCKET-2", 100)
+        self.assertEqual(views.claim_job()["id"], other_docket)
+        self.assertIsNone(views.claim_job())
+
+    def test_preempts_job_with_most_work_left(self):
+        started = time.time() - views.PREEMPT_AFTER_SECONDS - 60
+        self.start(self.enqueue("DOCKET-1", 50000), started)
+        largest = self.enqueue("DOCKET-2", 100000)
+        self.start(largest, started)
+        small = self.enqueue("DOCKET-3", 10)
+        self.execute("UPDATE jobs SET submitted=? WHERE id=?", (time.time() - 3 * views.WORKER_POLL_SECONDS, small))
+        self.assertEqual(views.preempt_jobs(), largest)
+        with self.assertRaises(views.JobPreempted):
+            views.check_preempted(largest)
+        # one job at a time makes way
+        self.assertIsNone(views.preempt_jobs())
+
+    def test_no_preemption(self):
+        started = time.time() - views.PREEMPT_AFTER_SECONDS - 60
+        too_new = self.enqueue("DOCKET-1", 100000)
+        self.start(too_new, time.time())
+        preempted_before = self.enqueue("DOCKET-2", 100000)
+        self.start(preempted_before, started)
+        self.execute("UPDATE jobs SET preemptions=? WHERE id=?", (views.PREEMPT_MAX, preempted_before))
+        small = self.enqueue("DOCKET-3", 10)
+        # queued just now: a worker may still be about to take it
+        self.assertIsNone(views.preempt_jobs())
+        self.execute("UPDATE jobs SET submitted=? WHERE id=?", (time.time() - 3 * views.WORKER_POLL_SECONDS, small))
+        self.assertIsNone(views.preempt_jobs())
+
+
+class RetentionTests(TemporaryStorageTestCase):
+    """enforce_retention with dry_run: which job folders would be deleted, and that nothing is."""
+
+    def setUp(self):
+        super().setUp()
+        set_views_globals(self, PROCESS_QUOTA_BYTES=0, ZIP_QUOTA_BYTES=0, MIN_FREE_BYTES=0)
+
+    def make_folder(self, name, size, days_unused, accesses=0):
+        PATH = os.path.join(views.PROCESS_DIRECTORY, name)
+        os.makedirs(PATH)
+        with open(os.path.join(PATH, "comment.htm"), "wb") as saved_file:
+            saved_file.write(b"x" * size)
+        views.record_storage(PATH, [])
+        self.execute("UPDATE storage SET last_access=?, accesses=? WHERE folder=?", (time.time() - days_unused * 86400, accesses, PATH))
+        return PATH
+
+    def enqueue_job(self):
+        return views.enqueue_job("QUEUED", ["comments"], "a@gao.gov", 10)
+
+    def test_old_folders(self):
+        old = self.make_folder("OLD_Comments", 1000, 100)
+        self.make_folder("RECENT_Comments", 1000, 1)
+        self.make_folder("POPULAR_Comments", 1000, 100, accesses=views.RETENTION_WARM_ACCESSES)
+        in_use = self.make_folder("QUEUED_Comments", 1000, 100)
+        self.execute("UPDATE jobs SET folder=? WHERE id=?", (in_use, self.enqueue_job()))
+        self.assertEqual(views.enforce_retention(dry_run=True), [(old, 1000, "unused for 100 days")])
+        self.assertTrue(os.path.exists(old))
+        self.assertEqual(len(self.execute("SELECT * FROM storage")), 4)
+
+    def test_over_quota_least_recently_used_first(self):
+        views.PROCESS_QUOTA_BYTES = 2500
+        popular = self.make_folder("POPULAR_Comments", 1000, 5, accesses=views.RETENTION_WARM_ACCESSES)
+        oldest = self.make_folder("OLDEST_Comments", 1000, 3)
+        self.make_folder("NEWEST_Comments", 1000, 1)
+        self.make_folder("NEWER_Comments", 1000, 2)
+        deleted = views.enforce_retention(dry_run=True)
+        self.assertEqual([(folder, reason) for folder, size, reason in deleted], [(oldest, "job folders over quota"),
+            (os.path.join(views.PROCESS_DIRECTORY, "NEWER_Comments"), "job folders over quota")])
+        self.assertTrue(os.path.exists(oldest) and os.path.exists(popular))
+
+    def test_shared_files_not_counted(self):
+        PATH = self.make_folder("OLD_Comments", 1000, 100)
+        os.link(os.path.join(PATH, "comment.htm"), os.path.join(views.CACHE_DIRECTORY, "cached"))
+        views.record_storage_size(PATH)
+        self.assertEqual(views.enforce_retention(dry_run=True), [(PATH, 0, "unused for 100 days")])
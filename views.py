@@ -16,16 +16,185 @@ import re
 import time
 import subprocess
 import requests
+import requests.adapters
 import shutil
 import operator
 import glob
+import zipfile
+import sqlite3
+import json
+import gzip
+import hashlib
+import fcntl
+import urllib.parse
+import socket
+import struct
+import tempfile
+import multiprocessing
+import threading
+import collections
+import random
+import concurrent.futures
+import queue
+import csv
+import html
 import xlsxwriter
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # Parquet directories are skipped without pyarrow
+    pyarrow = None
+try:
+    from pdfminer.high_level import extract_text as pdf_extract_text
+except ImportError: # PDF attachments are not searchable without pdfminer.six
+    pdf_extract_text = None
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 #import Django functions
 from django.shortcuts import render
 from django import forms
 from django.contrib import messages
 from django.core.mail import send_mail
+from django.http import HttpResponse, JsonResponse, Http404
+from django.views.decorators.csrf import csrf_exempt
+
+# Server locations for in-progress job folders and the published zip files
+PROCESS_DIRECTORY = "/var/docket_process_files"
+ZIPPATH = "/var/www/docket"
+# Job queue shared by the website and the docket worker processes
+JOBS_DB = os.path.join(PROCESS_DIRECTORY, "docket_socket_jobs.sqlite3")
+WORKER_PROCESSES = 2 # number of docket jobs a worker runs at the same time
+WORKER_POLL_SECONDS = 5
+# Scheduling of queued jobs by their estimated run time (see job_priority)
+FAST_LANE_WORKERS = 1 # extra worker processes that only run jobs estimated to take FAST_LANE_SECONDS or less
+FAST_LANE_SECONDS = 600
+SECONDS_PER_WORK_UNIT = 0.5 # a record or an attachment, until jobs have been measured
+ATTACHMENTS_PER_RECORD = 1.0 # until jobs have been measured
+SCHEDULER_HISTORY_JOBS = 100 # recent finished jobs used to measure the two above
+FAIR_SHARE_WINDOW = 24*3600 # worker seconds an email used in this window count against its next job
+QUEUE_AGING = 1.0 # seconds of estimated run time forgiven per second a job waits, so large jobs are not starved
+PREEMPT_AFTER_SECONDS = 1800 # a running job is only preempted after running this long
+PREEMPT_RATIO = 10 # ...and if it has this many times more work left than the job waiting for it
+PREEMPT_MAX = 2 # times a job can be preempted
+# Batches of dockets requested together (see run_batch)
+BATCH_MAX_DOCKETS = 100
+BATCH_PREFETCH_WORKERS = 2 # threads warming the metadata cache for a batch's next docket
+BATCH_INDEX_FIELDS = ('Docket', 'Document ID', 'Document Type', 'Document Title', 'Submitter Name',
+    'Organization Name', 'Date Posted', 'Attachment Count', 'Duplicate Group', 'Zip File(s)')
+# Disk space of job folders and published zips (see enforce_retention); 0 for no limit
+PROCESS_QUOTA_BYTES = 500*1024**3
+ZIP_QUOTA_BYTES = 200*1024**3
+RETENTION_MAX_AGE = 90*24*3600 # seconds unused before a job folder and its zips are deleted
+RETENTION_WARM_ACCESSES = 3 # folders of dockets requested this often are kept past RETENTION_MAX_AGE and deleted last
+RETENTION_CHECK_SECONDS = 3600 # how often the docket worker enforces the retention rules
+MIN_FREE_BYTES = 20*1024**3 # queued jobs wait while less disk space than this would be left
+ESTIMATED_BYTES_PER_RECORD = 1024**2 # job size estimate until jobs have been measured
+# Columns added to the jobs table after it was first released; added to existing databases by jobs_db
+JOB_COLUMNS_ADDED = (("batch_id", "INTEGER"), ("folder", "TEXT NOT NULL DEFAULT ''"), ("zips", "TEXT NOT NULL DEFAULT ''"),
+    ("attachments", "INTEGER NOT NULL DEFAULT 0"), ("preempt", "INTEGER NOT NULL DEFAULT 0"), ("preemptions", "INTEGER NOT NULL DEFAULT 0"))
+# Threads for each stage of a docket job's pipeline (see run_pipeline)
+METADATA_WORKERS = 8 # document.json requests
+DOWNLOAD_WORKERS = 8 # documents whose files are downloading
+PIPELINE_QUEUE_SIZE = 32 # records waiting between two stages
+PIPELINE_MAX_IN_FLIGHT = 500 # records in the pipeline at once
+# Pages of the docket listing fetched at the same time; documents.json returns at most RECORDS_PER_PAGE records a page
+LISTING_WORKERS = 4
+RECORDS_PER_PAGE = 1000
+# Attachments are streamed to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+# Attachments shared across dockets and users, stored once per content hash (set CACHE_MAX_BYTES to 0 to turn off)
+CACHE_DIRECTORY = "/var/docket_cache"
+CACHE_MAX_BYTES = 200*1024**3 # least recently used attachments are evicted beyond this
+FICLONE = 0x40049409 # Linux ioctl for reflink copies
+cache_local = threading.local()
+# document.json responses kept for later jobs and reports (set METADATA_CACHE_TTL to 0 to turn off)
+METADATA_CACHE_DIRECTORY = "/var/docket_cache/documents"
+METADATA_CACHE_TTL = 7*24*3600 # seconds
+# Files are streamed to a long-running clamd as they are downloaded (a unix socket path, or a (host, port) tuple)
+CLAMD_ADDRESS = "/var/run/clamav/clamd.ctl"
+CLAMD_TIMEOUT = 300 # seconds
+SCAN_WORKERS = 4 # records whose files are being scanned
+# Directory of the docket's records: any of "xlsx", "csv" (and "parquet" if pyarrow is installed)
+DIRECTORY_FORMATS = ("xlsx",)
+DIRECTORY_FIELDS = ('Document ID', 'Link','Document Type', 'Document Title',
+    'Submitter Name', 'Organization Name', 'Date Posted', 'Attachment Count', 'Duplicate Group', 'Attachment Link(s)')
+XLSX_MAX_ROWS = 1048576 # rows per worksheet, including the header
+XLSX_MAX_SHEET_NAME = 31 # characters in a worksheet name
+PARQUET_BATCH_ROWS = 10000
+# The all comments html is split into files of at most this many comments or bytes
+COMMENTS_PER_FILE = 10000
+COMMENTS_FILE_BYTES = 50*1024**2
+# The zip is built as files pass the virus scan; formats that are already compressed are stored as is
+ZIP_VOLUME_BYTES = 0 # start a new zip (name_1.zip, name_2.zip, ...) past this size; 0 for one zip
+ZIP_REUSE_MAX_WASTE = 0.5 # share of an earlier run's zip that may be replaced entries before it is rebuilt instead of reused; 0 to always rebuild
+STORED_EXTENSIONS = {".pdf", ".docx", ".xlsx", ".pptx", ".jpg", ".jpeg", ".png", ".gif", ".zip", ".gz", ".mp3", ".mp4", ".mov", ".wmv"}
+# Identical attachments and comments within a docket are stored once (see DocketDedup)
+DEDUP_FILES = True
+DEDUP_NEAR_DUPLICATES = False # also group comments that are nearly the same (MinHash); uses more CPU and memory
+DEDUP_SIMILARITY = 0.8 # share of MINHASH_SHINGLE_WORDS-word phrases near duplicates have in common (estimated)
+# Link, instead of download, attachments of a comment matching a form letter seen already. Each one is linked only if
+# its size (from the response headers; the body is not downloaded) is the same, but a personalised attachment of the
+# same size would be replaced by the other comment's copy, so this can lose data. Saves bandwidth, not API quota.
+DEDUP_SKIP_KNOWN_ATTACHMENTS = False
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16 # MINHASH_PERMUTATIONS must be a multiple
+MINHASH_SHINGLE_WORDS = 5
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_PARAMETERS = [(random.Random(seed).randrange(1, MINHASH_PRIME), random.Random(-seed).randrange(MINHASH_PRIME)) for seed in range(1, MINHASH_PERMUTATIONS + 1)]
+# Comments that only point to their attachments
+SEE_ATTACHED = {"", "see attached", "see attached file", "see attached files", "see attached file(s)"}
+# Full text search over every docket downloaded (see SearchIndex and the search view); needs SQLite with FTS5
+SEARCH_INDEX = True
+SEARCH_DB = os.path.join(PROCESS_DIRECTORY, "docket_socket_search.sqlite3")
+SEARCH_WORKERS = 4 # records whose files' text is being extracted
+SEARCH_COMMIT_RECORDS = 100 # records added to the index per transaction...
+SEARCH_COMMIT_SECONDS = 5 # ...or fewer, once the first of them has waited this long
+SEARCH_MAX_TEXT = 2000000 # characters of text indexed per file
+SEARCH_RESULTS = 20 # results per page of the search view (at most 100)
+search_local = threading.local()
+search_fts5 = None # whether this process's SQLite has FTS5 (see search_available); None until checked
+# Records finished so far in a job folder; lets interrupted and repeated jobs skip them
+MANIFEST_NAME = "docket_socket_manifest.jsonl"
+# Quarantined files of a job folder that have been emailed about already (one JSON [file name, SHA-256] per line)
+QUARANTINE_REPORTED_NAME = "quarantine_reported.jsonl"
+# Locked by the job using a job folder, so two jobs for the same docket and document types never share it at once
+FOLDER_LOCK_NAME = ".docket_socket.lock"
+# regulations.gov API (benchmarks/ points this at a local stand-in server)
+API_BASE = "http://api.data.gov:80/regulations/v3"
+# regulations.gov API keys; requests are spread over every key listed here
+API_KEYS = ["06oqGOmSQFYA1K5d4cOQ3estOJ0TfokvaSERlwXq"]
+# Token buckets shared by every worker process and the website (one row per API key)
+RATE_LIMIT_DB = os.path.join(PROCESS_DIRECTORY, "docket_socket_rate_limit.sqlite3")
+RATE_LIMIT_PER_HOUR = 1000 # assumed quota per key until the API reports X-RateLimit-Limit
+RATE_LIMIT_POLL_SECONDS = 0.5 # longest a request waits before checking the bucket again
+FAIR_SHARE_RESERVE = 50 # below this many tokens, concurrent dockets take turns
+rate_limit_docket = "" # docket this process is downloading; used to share tokens fairly
+rate_limit_local = threading.local()
+# HTTP connection pool shared by the threads of a process
+HTTP_POOL_SIZE = 2*DOWNLOAD_WORKERS # connections kept alive per host
+HTTP_TIMEOUT = (10, 120) # seconds to connect, seconds between bytes received
+HTTP_RETRIES = 5 # retries after a connection error, timeout, or 5xx response
+HTTP_BACKOFF_SECONDS = 2 # wait before the first retry, doubled for each retry after that
+HTTP_WEB_TIMEOUT = (3, 10) # requests made while a web page waits (wait=False) get this timeout and no retries
+http_lock = threading.Lock()
+http_session_pid = None
+http_session = None
+# Timings, counters and queue depths of the job this process is running (see observe), saved to
+# METRICS_NAME in the job folder and to the jobs database for the metrics view
+METRICS_NAME = "docket_socket_metrics.json"
+METRICS_TOTALS_ID = 0 # job_metrics row holding the totals of finished jobs (job IDs start at 1)
+METRICS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300) # histogram upper bounds, in seconds
+METRICS = { # timing: (label name, or "" if unlabelled, help text)
+    "request_seconds": ("endpoint", "regulations.gov API requests, until the response headers arrived"),
+    "rate_limit_wait_seconds": ("", "Time waiting for a rate limit token before each request"),
+    "download_seconds": ("endpoint", "Time saving response bodies to disk"),
+    "listing_seconds": ("", "Time listing every record of a docket"),
+    "stage_seconds": ("stage", "Time each record spent in each stage of the pipeline"),
+    "scan_seconds": ("scanner", "Time scanning files for viruses"),
+    "zip_seconds": ("compression", "Time adding files to the published zip"),
+}
+metrics_lock = threading.Lock()
+job_metrics = {"timings": {}, "counters": {}, "gauges": {}}
 
 class DocketForm(forms.Form):
     DOC_TYPES = (
@@ -37,19 +206,71 @@ class DocketForm(forms.Form):
     email = forms.EmailField()
     doc_type = forms.MultipleChoiceField(choices=DOC_TYPES, widget=forms.CheckboxSelectMultiple)
 
-def isdocket(docket_ID):
+class BatchDocketForm(forms.Form):
+    docket_numbers = forms.CharField(label='Docket Numbers (one per line)', widget=forms.Textarea)
+    email = forms.EmailField()
+    doc_type = forms.MultipleChoiceField(choices=DocketForm.DOC_TYPES, widget=forms.CheckboxSelectMultiple)
+
+def isdocket(docket_ID, wait=True):
     """Check to see if records exist for the docket number.
     
     Arg:
             docket_ID: The docket number requested.
+            wait: False to raise RateLimited instead of waiting for a request token (see acquire_token)
     Returns:
             True if records exist for the given docket number
-            The request object for the docket number
+            The number of records in the docket
+    """
+    number_of_records = count_docket_records(docket_ID, wait)
+
+    return number_of_records > 0, number_of_records
+
+def docket_listing_url(docket_ID, offset=0, counts_only=False):
+    """The documents.json url for one page of a docket listing (or just its record count)."""
+    return API_BASE + "/documents.json?countsOnly=%s&dktid=%s&rpp=%s&po=%s" % (int(counts_only), docket_ID, RECORDS_PER_PAGE, offset)
+
+def count_docket_records(docket_ID, wait=True):
+    """Gets the number of records in a docket with a count-only request, without listing them.
+
+    Arg:
+            docket_ID: The docket number.
+            wait: False to raise RateLimited instead of waiting for a request token (see acquire_token)
+    Returns:
+            totalNumRecords for the docket (includes Primary, Supporting, and Comments).
+    """
+    return check_quota_and_get(docket_listing_url(docket_ID, counts_only=True), wait=wait).json().get("totalNumRecords") or 0
+
+def list_docket_records(docket_ID, first_page=None):
+    """Lists every record in a docket.
+
+    The first page of the listing gives totalNumRecords, so the offsets of all the other pages
+    are known up front; they are fetched LISTING_WORKERS at a time and their records are
+    yielded page by page, in listing order.
+
+    Arg:
+            docket_ID: The docket number.
+            first_page: The parsed JSON of the listing's first page, if it was already fetched.
+    Returns:
+            generator of the records (dictionaries from documents.json).
     """
-    request_response = check_quota_and_get("http://api.data.gov:80/regulations/v3/documents.json?api_key=06oqGOmSQFYA1K5d4cOQ3estOJ0TfokvaSERlwXq&countsOnly=0&dktid=%s&rpp=1000" % docket_ID)
-    number_of_records = request_response.json().get("totalNumRecords")
+    if first_page is None:
+        first_page = check_quota_and_get(docket_listing_url(docket_ID)).json()
+    number_of_records = first_page.get("totalNumRecords") or 0
+    page_size = len(first_page["documents"]) or RECORDS_PER_PAGE
+    for document_data in first_page["documents"]:
+        yield document_data
+    offsets = range(page_size, number_of_records, page_size)
+    pages = ordered_map(lambda offset: check_quota_and_get(docket_listing_url(docket_ID, offset)).json()["documents"], offsets, LISTING_WORKERS)
+    for page in pages:
+        for document_data in page:
+            yield document_data
 
-    return number_of_records > 0, request_response
+def docket_count(request, docket_ID):
+    """Previews the size of a docket as JSON, using a count-only request (503 while the API quota is used up)."""
+    try:
+        return JsonResponse({"docket":docket_ID, "totalNumRecords":count_docket_records(docket_ID, wait=False)})
+    except RateLimited:
+        return JsonResponse({"docket":docket_ID, "errors":["The API quota is used up; try again later"]}, status=503)
 
 def home(request):
     # if this is a POST request we need to process the form data
@@ -65,12 +286,24 @@ def home(request):
             if email[-7:].lower() != 'gao.gov':
                     messages.error(request, 'Email must be GAO email')
                     return render(request, 'html/error.html')
-            # check if the docket number is valid
-            docket_request = isdocket(docket_number)
+            # check if the docket number is valid; if the API quota is used up (or the API is down)
+            # the job is queued anyway and the worker counts the docket (see count_queued_jobs)
+            try:
+                docket_request = isdocket(docket_number, wait=False)
+            except (RateLimited, requests.RequestException):
+                docket_request = (True, 0)
             if docket_request[0]:
-                # # BEGIN MAIN DOWNLOAD # #
-                    docket_socket("/var/docket_process_files", docket_request[1], docket_number, doc_type, email)
-                    return render(request, 'html/results.html', {'email':email,'docket':docket_number})
+                    space = check_disk_space(estimate_job_bytes(docket_request[1]), enforce=False)
+                    if space == "refuse":
+                        messages.error(request, 'Docket %s is too large for the disk space on the server' % docket_number)
+                        return render(request, 'html/error.html')
+                    if space == "wait":
+                        messages.info(request, 'The server is low on disk space; your download will start once space is freed')
+                # # QUEUE MAIN DOWNLOAD # # (run by the docket_worker management command)
+                    job_id = enqueue_job(docket_number, doc_type, email, docket_request[1])
+                    position, eta = queue_position(job_id)
+                    return render(request, 'html/results.html', {'email':email,'docket':docket_number,'job_id':job_id,
+                        'queue_position':position,'eta':format_eta(eta)})
             else:
                 messages.error(request, 'No Docket found for Docket Number: %s' % docket_number)
                 return render(request, 'html/error.html')
@@ -87,6 +320,1107 @@ def home(request):
 
     return render(request, 'html/home.html', {'form': form})
 
+def job_status(request, job_id):
+    """Reports the status and progress of a queued docket job as JSON.
+
+    Arg:
+            request: Django request object.
+            job_id: ID of the job returned when the docket was requested.
+    Returns:
+            JsonResponse with the job status, records downloaded so far, timestamps, and its place in the
+            queue and estimated seconds until it is done (see queue_position).
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise Http404('No docket job with ID %s' % job_id)
+    position, eta = queue_position(job_id)
+    return JsonResponse(dict(job, queue_position=position, eta_seconds=eta))
+
+def batch(request):
+    """Form for downloading several dockets as one batch (see run_batch)."""
+    if request.method == 'POST':
+        form = BatchDocketForm(request.POST)
+        if form.is_valid():
+            dockets = parse_docket_list(form.cleaned_data['docket_numbers'])
+            email = form.cleaned_data['email']
+            batch_id, errors = submit_batch(dockets, form.cleaned_data['doc_type'], email, wait=False)
+            if batch_id is None:
+                for error in errors:
+                    messages.error(request, error)
+                return render(request, 'html/error.html')
+            position, eta = queue_position(batch_id=batch_id)
+            return render(request, 'html/results.html', {'email':email,'docket':", ".join(dockets),'job_id':batch_id,'batch_id':batch_id,
+                'queue_position':position,'eta':format_eta(eta)})
+        else:
+            for field in form.errors.as_data():
+                messages.error(request, 'The field ' + field + ' does not have a valid value')
+            return render(request, 'html/error.html')
+    return render(request, 'html/batch.html', {'form': BatchDocketForm()})
+
+@csrf_exempt
+def batch_api(request):
+    """Queues a batch of dockets from a JSON POST, ex: {"dockets": ["OCC-2013-0003", ...], "doc_type": ["comments"], "email": "..."}
+
+    Returns:
+            JsonResponse with the batch ID and the job ID of each docket, or the errors (status 400).
+    """
+    if request.method != 'POST':
+        return JsonResponse({"errors": ["POST a JSON object with dockets, doc_type and email"]}, status=405)
+    try:
+        body = json.loads(request.body.decode("utf-8"))
+        dockets = parse_docket_list(body["dockets"])
+        doctype = [doc_type for doc_type in body["doc_type"] if doc_type in dict(DocketForm.DOC_TYPES)]
+        email = body["email"]
+    except (ValueError, KeyError, TypeError) as e:
+        return JsonResponse({"errors": ["Could not read the request: %s" % e]}, status=400)
+    batch_id, errors = submit_batch(dockets, doctype, email, wait=False)
+    if batch_id is None:
+        return JsonResponse({"errors": errors}, status=400)
+    return batch_status(request, batch_id)
+
+def batch_status(request, batch_id):
+    """Reports the status of a batch and each of its dockets' jobs as JSON."""
+    batch_row, jobs = get_batch(batch_id)
+    if batch_row is None:
+        raise Http404('No docket batch with ID %s' % batch_id)
+    position, eta = queue_position(batch_id=batch_id)
+    return JsonResponse(dict(batch_row, jobs=[dict(job) for job in jobs], queue_position=position, eta_seconds=eta))
+
+def search(request):
+    """Searches the text of every docket downloaded, best matches first, as JSON.
+
+    GET parameters: q (FTS5 query, ex: "clean water" OR wetlands), and optionally docket, type
+    (document type), limit and offset.
+
+    Returns:
+            JsonResponse with the matching records, each with a snippet of the matching text.
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({"errors": ["Add a search query: ?q=..."]}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', SEARCH_RESULTS)), 100)
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        return JsonResponse({"errors": ["limit and offset must be numbers"]}, status=400)
+    started = time.time()
+    try:
+        results = search_index(query, request.GET.get('docket', ''), request.GET.get('type', ''), limit, offset)
+    except sqlite3.OperationalError as e:
+        return JsonResponse({"errors": ["Search is not available: %s" % e]}, status=503)
+    return JsonResponse({"query": query, "results": results, "milliseconds": round(1000 * (time.time() - started), 1)})
+
+def storage_status(request):
+    """Reports the disk space used by job folders and zips, the quotas, and free space as JSON."""
+    entries = storage_entries()
+    return JsonResponse({"folders": len(entries),
+        "folder_bytes": sum(entry["folder_bytes"] for entry in entries), "reclaimable_bytes": sum(entry["reclaimable_bytes"] for entry in entries),
+        "zip_bytes": sum(entry["zip_bytes"] for entry in entries),
+        "process_quota_bytes": PROCESS_QUOTA_BYTES, "zip_quota_bytes": ZIP_QUOTA_BYTES,
+        "free_bytes": free_disk_bytes(), "min_free_bytes": MIN_FREE_BYTES})
+
+def attachment_cache_status(request):
+    """Reports the attachment cache's hit, miss and eviction counts and size as JSON."""
+    return JsonResponse(attachment_cache_stats())
+
+def metrics(request):
+    """Reports the docket jobs' metrics in the Prometheus text format.
+
+    Timings and counters are totals over every job that has run: the totals of finished jobs (see
+    fold_job_metrics) plus the snapshots of jobs not yet finished (see save_job_metrics). Queue depths
+    are summed over the jobs running now. Also reports the job queue and the attachment cache.
+    """
+    connection = jobs_db()
+    try:
+        job_counts = connection.execute("SELECT status, COUNT(*) AS jobs FROM jobs GROUP BY status").fetchall()
+        rows = connection.execute("SELECT jobs.status, job_metrics.metrics FROM job_metrics LEFT JOIN jobs ON jobs.id=job_metrics.job_id").fetchall()
+    finally:
+        connection.close()
+    total = {"timings": {}, "counters": {}, "gauges": {}}
+    gauges = {}
+    for row in rows:
+        snapshot = json.loads(row["metrics"])
+        merge_metrics(total, snapshot)
+        if row["status"] == "running":
+            for metric, labels in snapshot["gauges"].items():
+                for label, value in labels.items():
+                    gauges[(metric, label)] = gauges.get((metric, label), 0) + value
+    timings = dict(((metric, label), stats) for metric, labels in total["timings"].items() for label, stats in labels.items())
+    counters = dict(((metric, label), value) for metric, labels in total["counters"].items() for label, value in labels.items())
+    lines = ["# TYPE docket_socket_jobs gauge"]
+    lines += [prometheus_line("jobs", [("status", row["status"])], row["jobs"]) for row in job_counts]
+    for metric, (label_name, help_text) in sorted(METRICS.items()):
+        lines += ["# HELP docket_socket_%s %s" % (metric, help_text), "# TYPE docket_socket_%s histogram" % metric]
+        for (timing, label), stats in sorted(timings.items()):
+            if timing != metric:
+                continue
+            cumulative = 0
+            for upper_bound, count in zip(METRICS_BUCKETS + ("+Inf",), stats["buckets"]):
+                cumulative += count
+                lines.append(prometheus_line(metric + "_bucket", [(label_name, label), ("le", upper_bound)], cumulative))
+            lines.append(prometheus_line(metric + "_sum", [(label_name, label)], stats["seconds"]))
+            lines.append(prometheus_line(metric + "_count", [(label_name, label)], stats["count"]))
+        for (timing, label), stats in sorted(timings.items()):
+            if timing == metric:
+                lines.append(prometheus_line(metric.replace("_seconds", "_errors_total"), [(label_name, label)], stats["errors"]))
+                if stats["bytes"]:
+                    lines.append(prometheus_line(metric.replace("_seconds", "_bytes_total"), [(label_name, label)], stats["bytes"]))
+    for (metric, label), value in sorted(counters.items()):
+        lines.append(prometheus_line(metric + "_total", [("kind", label)], value))
+    for (metric, label), value in sorted(gauges.items()):
+        lines.append(prometheus_line(metric, [("name", label)], value))
+    for name, value in sorted(attachment_cache_stats().items()):
+        lines.append(prometheus_line("attachment_cache_" + name, [], value))
+    return HttpResponse("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4")
+
+def jobs_db():
+    """Opens the job queue database, creating the jobs table if needed.
+
+    The connection is in autocommit mode; callers that need several statements
+    to run atomically issue BEGIN IMMEDIATE themselves.
+
+    Returns:
+            connection: sqlite3 connection to JOBS_DB.
+    """
+    connection = sqlite3.connect(JOBS_DB, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        docket TEXT NOT NULL,
+        doc_type TEXT NOT NULL,
+        email TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        records_total INTEGER NOT NULL DEFAULT 0,
+        records_done INTEGER NOT NULL DEFAULT 0,
+        worker_pid INTEGER,
+        submitted REAL,
+        started REAL,
+        finished REAL,
+        error TEXT NOT NULL DEFAULT '',
+        batch_id INTEGER,
+        folder TEXT NOT NULL DEFAULT '',
+        zips TEXT NOT NULL DEFAULT '',
+        attachments INTEGER NOT NULL DEFAULT 0,
+        preempt INTEGER NOT NULL DEFAULT 0,
+        preemptions INTEGER NOT NULL DEFAULT 0)""")
+    columns = set(column["name"] for column in connection.execute("PRAGMA table_info(jobs)"))
+    for column, definition in JOB_COLUMNS_ADDED:
+        if column not in columns:
+            try:
+                connection.execute("ALTER TABLE jobs ADD COLUMN %s %s" % (column, definition))
+            except sqlite3.OperationalError:
+                pass # added by another process at the same time
+    connection.execute("""CREATE TABLE IF NOT EXISTS batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        doc_type TEXT NOT NULL,
+        email TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        submitted REAL,
+        finished REAL,
+        zips TEXT NOT NULL DEFAULT '')""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS storage (
+        folder TEXT PRIMARY KEY,
+        zips TEXT NOT NULL DEFAULT '',
+        folder_bytes INTEGER NOT NULL DEFAULT 0,
+        reclaimable_bytes INTEGER NOT NULL DEFAULT 0,
+        zip_bytes INTEGER NOT NULL DEFAULT 0,
+        records INTEGER NOT NULL DEFAULT 0,
+        created REAL,
+        last_access REAL,
+        accesses INTEGER NOT NULL DEFAULT 0)""")
+    connection.execute("CREATE TABLE IF NOT EXISTS job_metrics (job_id INTEGER PRIMARY KEY, updated REAL, metrics TEXT NOT NULL)")
+    return connection
+
+def enqueue_job(docket_ID, doctype, email, number_of_records=0):
+    """Adds a docket download to the job queue.
+
+    Arg:
+            docket_ID: The docket number requested.
+            doctype: List of document types requested (from Django form).
+            email: Email address notified when the download is complete.
+            number_of_records: totalNumRecords reported for the docket, used for progress.
+    Returns:
+            The ID of the new job.
+    """
+    connection = jobs_db()
+    try:
+        cursor = connection.execute("INSERT INTO jobs (docket, doc_type, email, records_total, submitted) VALUES (?, ?, ?, ?, ?)",
+            (docket_ID, ",".join(doctype), email, number_of_records or 0, time.time()))
+        return cursor.lastrowid
+    finally:
+        connection.close()
+
+def enqueue_batch(docket_IDs, doctype, email, numbers_of_records, claim=False):
+    """Adds a batch of dockets to the job queue: one job per docket, run together by one worker (see run_batch).
+
+    Arg:
+            docket_IDs: The docket numbers requested.
+            doctype: List of document types requested (from Django form).
+            email: Email address notified once every docket of the batch is done.
+            numbers_of_records: totalNumRecords of each docket, used for progress (None or 0 if not counted yet).
+            claim: True to claim the batch for this process in the same transaction (see run_batch),
+                    so no worker can take it first.
+    Returns:
+            The ID of the new batch.
+    """
+    connection = jobs_db()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            batch_id = connection.execute("INSERT INTO batches (doc_type, email, submitted) VALUES (?, ?, ?)",
+                (",".join(doctype), email, time.time())).lastrowid
+            for docket_ID, number_of_records in zip(docket_IDs, numbers_of_records):
+                connection.execute("INSERT INTO jobs (docket, doc_type, email, records_total, submitted, batch_id) VALUES (?, ?, ?, ?, ?, ?)",
+                    (docket_ID, ",".join(doctype), email, number_of_records or 0, time.time(), batch_id))
+            if claim:
+                claim_batch(connection, batch_id)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return batch_id
+    finally:
+        connection.close()
+
+def get_batch(batch_id):
+    """Looks up a batch and the jobs of its dockets.
+
+    Returns:
+            The batch row (None if there is no such batch) and the list of its job rows, in the order requested.
+    """
+    connection = jobs_db()
+    try:
+        return (connection.execute("SELECT * FROM batches WHERE id=?", (batch_id,)).fetchone(),
+            connection.execute("SELECT * FROM jobs WHERE batch_id=? ORDER BY id", (batch_id,)).fetchall())
+    finally:
+        connection.close()
+
+def update_batch(batch_id, **fields):
+    """Updates columns of a batch."""
+    connection = jobs_db()
+    try:
+        connection.execute("UPDATE batches SET %s WHERE id=?" % ", ".join(column + "=?" for column in fields),
+            tuple(fields.values()) + (batch_id,))
+    finally:
+        connection.close()
+
+def parse_docket_list(dockets):
+    """The docket numbers in a list, or in text separated by new lines, commas or spaces, without repeats."""
+    if isinstance(dockets, str):
+        dockets = re.split("[\\s,;]+", dockets)
+    docket_IDs = []
+    for docket_ID in dockets:
+        docket_ID = str(docket_ID).strip()
+        if docket_ID and docket_ID not in docket_IDs:
+            docket_IDs.append(docket_ID)
+    return docket_IDs
+
+def submit_batch(docket_IDs, doctype, email, claim=False, wait=True):
+    """Checks a batch request and queues it. The dockets are counted in parallel, LISTING_WORKERS at a time.
+
+    With claim True the batch is claimed for this process as it is queued (see enqueue_batch). With wait
+    False (for web requests) dockets that cannot be counted right away, because the API quota is used up
+    or the API is down, are queued with no count; docket_socket counts them when the batch runs.
+
+    Returns:
+            The batch ID (None if the request was refused) and a list of error messages.
+    """
+    if email[-7:].lower() != 'gao.gov':
+        return None, ['Email must be GAO email']
+    if not doctype:
+        return None, ['Choose at least one document type']
+    if not docket_IDs or len(docket_IDs) > BATCH_MAX_DOCKETS:
+        return None, ['A batch needs 1 to %s docket numbers' % BATCH_MAX_DOCKETS]
+    def count(docket_ID):
+        try:
+            return count_docket_records(docket_ID, wait)
+        except (RateLimited, requests.RequestException):
+            if wait:
+                raise
+            return None
+    numbers_of_records = list(ordered_map(count, docket_IDs, LISTING_WORKERS))
+    errors = ['No Docket found for Docket Number: %s' % docket_ID for docket_ID, number in zip(docket_IDs, numbers_of_records) if number == 0]
+    if errors:
+        return None, errors
+    if check_disk_space(estimate_job_bytes(sum(number or 0 for number in numbers_of_records)), enforce=False) == "refuse":
+        return None, ['The batch is too large for the disk space on the server']
+    return enqueue_batch(docket_IDs, doctype, email, numbers_of_records, claim), []
+
+def get_job(job_id):
+    """Looks up a job in the job queue.
+
+    Arg:
+            job_id: ID of the job.
+    Returns:
+            The job row, or None if there is no such job.
+    """
+    connection = jobs_db()
+    try:
+        return connection.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+    finally:
+        connection.close()
+
+def update_job(job_id, **fields):
+    """Updates columns of a job. Does nothing when job_id is None (docket_socket run outside the queue).
+
+    Arg:
+            job_id: ID of the job.
+            fields: column names and their new values.
+    """
+    if job_id is None or not fields:
+        return
+    connection = jobs_db()
+    try:
+        connection.execute("UPDATE jobs SET %s WHERE id=?" % ", ".join(column + "=?" for column in fields),
+            tuple(fields.values()) + (job_id,))
+    finally:
+        connection.close()
+
+def claim_job(fast_lane=False):
+    """Takes the queued job (or batch) that should run next and marks it as running in this process.
+
+    Arg:
+            fast_lane: True to only take jobs estimated to take FAST_LANE_SECONDS or less.
+    Returns:
+            The claimed job row (the first job of a batch), or None if there is no job to take.
+    """
+    connection = jobs_db()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            schedule = runnable_schedule(connection)
+            if fast_lane:
+                schedule = [unit for unit in schedule if unit["seconds"] <= FAST_LANE_SECONDS]
+            job = schedule[0]["job"] if schedule else None
+            if job is not None and job["batch_id"] is not None:
+                # the dockets of a batch are run together
+                claim_batch(connection, job["batch_id"])
+            elif job is not None:
+                connection.execute("UPDATE jobs SET status='running', worker_pid=?, started=?, preempt=0 WHERE id=?",
+                    (os.getpid(), time.time(), job["id"]))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return job
+    finally:
+        connection.close()
+
+def job_folder_key(job):
+    """The docket and document types of a job, which decide its job folder (see makefolders)."""
+    return job["docket"], frozenset(job["doc_type"].split(","))
+
+def runnable_schedule(connection):
+    """job_schedule without the jobs (or batches) that would use the job folder of a running job.
+
+    Such a job would share the running job's manifest, log file and zip, so it waits until that job is
+    done (a resubmission, a refresh, or a batch that has a docket in common with another request).
+    """
+    schedule = job_schedule(connection)
+    busy = set(job_folder_key(job) for job in connection.execute("SELECT docket, doc_type FROM jobs WHERE status='running'"))
+    if not busy:
+        return schedule
+    blocked_batches = set(job["batch_id"] for job in connection.execute(
+        "SELECT batch_id, docket, doc_type FROM jobs WHERE status='queued' AND batch_id IS NOT NULL") if job_folder_key(job) in busy)
+    return [unit for unit in schedule if not (unit["job"]["batch_id"] in blocked_batches if unit["job"]["batch_id"] is not None
+        else job_folder_key(unit["job"]) in busy)]
+
+class JobPreempted(Exception):
+    """Raised in docket_socket when the scheduler asks a running job to make way (see preempt_jobs)."""
+
+def scheduler_rates(connection):
+    """Seconds per work unit (a record or an attachment) and attachments per record, measured from recent jobs.
+
+    Returns:
+            (seconds per work unit, attachments per record), SECONDS_PER_WORK_UNIT and ATTACHMENTS_PER_RECORD until jobs have finished.
+    """
+    jobs = connection.execute("""SELECT records_total, attachments, finished - started AS seconds FROM jobs
+        WHERE status='done' AND records_total > 0 AND started IS NOT NULL AND preemptions = 0 ORDER BY id DESC LIMIT ?""",
+        (SCHEDULER_HISTORY_JOBS,)).fetchall()
+    records = sum(job["records_total"] for job in jobs)
+    if not records:
+        return SECONDS_PER_WORK_UNIT, ATTACHMENTS_PER_RECORD
+    attachments = sum(job["attachments"] for job in jobs)
+    return sum(job["seconds"] for job in jobs) / (records + attachments), attachments / records
+
+def estimate_job_seconds(job, rates):
+    """Estimated seconds left to run a job, from its records left and attachments (counted so far, or estimated).
+
+    Arg:
+            job: job row
+            rates: scheduler_rates()
+    """
+    seconds_per_unit, attachments_per_record = rates
+    if job["records_done"] and job["attachments"]:
+        attachments_per_record = job["attachments"] / job["records_done"]
+    records = max(job["records_total"] - job["records_done"], 0)
+    return records * (1 + attachments_per_record) * seconds_per_unit
+
+def job_schedule(connection):
+    """The queued jobs in the order they will run, each batch as one unit (see job_priority).
+
+    Jobs whose docket has not been counted yet (see count_queued_jobs) are left out.
+
+    Returns:
+            List of dictionaries: "job" (the job row, the first of a batch), "email", "seconds" (estimated run time) and "priority".
+    """
+    rates = scheduler_rates(connection)
+    now = time.time()
+    units = collections.OrderedDict()
+    # jobs queued before their docket was counted wait for count_queued_jobs
+    for job in connection.execute("SELECT * FROM jobs WHERE status='queued' AND (records_total > 0 OR batch_id IS NOT NULL) ORDER BY id"):
+        key = ("batch", job["batch_id"]) if job["batch_id"] is not None else ("job", job["id"])
+        if key not in units:
+            units[key] = {"job": job, "email": job["email"], "seconds": 0.0, "submitted": job["submitted"] or now}
+        units[key]["seconds"] += estimate_job_seconds(job, rates)
+    usage = email_usage(connection, rates)
+    for unit in units.values():
+        unit["priority"] = job_priority(unit["seconds"], usage.get(unit["email"], 0), now - unit["submitted"])
+    return sorted(units.values(), key=lambda unit: (unit["priority"], unit["job"]["id"]))
+
+def email_usage(connection, rates):
+    """Worker seconds each email has used in the last FAIR_SHARE_WINDOW, plus the estimated time left of its running jobs."""
+    now = time.time()
+    usage = collections.defaultdict(float)
+    for job in connection.execute("SELECT * FROM jobs WHERE started > ? OR status='running'", (now - FAIR_SHARE_WINDOW,)):
+        if job["status"] == "running":
+            usage[job["email"]] += now - job["started"] + estimate_job_seconds(job, rates)
+        elif job["finished"]:
+            usage[job["email"]] += job["finished"] - job["started"]
+    return usage
+
+def job_priority(seconds, email_seconds, waited):
+    """Priority of a queued job: lower runs first.
+
+    Small jobs run first, an email that has used more worker time recently waits longer (fair share), and
+    every second waited counts QUEUE_AGING seconds in the job's favor, so large jobs still get their turn.
+
+    Arg:
+            seconds: estimated run time of the job
+            email_seconds: worker seconds used by the job's email (see email_usage)
+            waited: seconds since the job was queued
+    """
+    return seconds + email_seconds - QUEUE_AGING * waited
+
+def queue_position(job_id=None, batch_id=None):
+    """Where a job or batch is in the queue, and when it should be done.
+
+    Simulates the workers (WORKER_PROCESSES, plus FAST_LANE_WORKERS for small jobs) running the queue in
+    job_schedule order after the running jobs, using the estimated run time of each job.
+
+    Arg:
+            job_id: ID of the job (or of any job of a batch)
+            batch_id: ID of the batch, instead of job_id
+    Returns:
+            (place in the queue, starting at 1, or 0 once running; estimated seconds until done), or (None, None) if it is not queued or running.
+    """
+    connection = jobs_db()
+    try:
+        if batch_id is None:
+            job = connection.execute("SELECT batch_id FROM jobs WHERE id=?", (job_id,)).fetchone()
+            batch_id = job["batch_id"] if job is not None else None
+        rates = scheduler_rates(connection)
+        running = connection.execute("SELECT * FROM jobs WHERE status='running'").fetchall()
+        schedule = job_schedule(connection)
+    finally:
+        connection.close()
+    wanted = lambda job: job["batch_id"] == batch_id if batch_id is not None else job["id"] == job_id
+    if any(wanted(job) for job in running):
+        # the dockets of a batch run one after another
+        return 0, int(sum(estimate_job_seconds(job, rates) for job in running if wanted(job)))
+    # seconds until each worker is free, the longest running jobs on the regular workers
+    busy = collections.defaultdict(float)
+    for job in running:
+        busy[job["batch_id"] if job["batch_id"] is not None else -job["id"]] += estimate_job_seconds(job, rates)
+    busy = sorted(busy.values(), reverse=True) + [0.0] * (WORKER_PROCESSES + FAST_LANE_WORKERS)
+    workers = busy[:WORKER_PROCESSES]
+    fast_workers = busy[WORKER_PROCESSES:WORKER_PROCESSES + FAST_LANE_WORKERS]
+    for position, unit in enumerate(schedule, 1):
+        lanes = [workers] + ([fast_workers] if unit["seconds"] <= FAST_LANE_SECONDS and fast_workers else [])
+        lane = min(lanes, key=min)
+        start = min(lane)
+        lane[lane.index(start)] = start + unit["seconds"]
+        if wanted(unit["job"]):
+            return position, int(start + unit["seconds"])
+    return None, None
+
+def format_eta(seconds):
+    """Estimated time until a job is done, in words (ex: "about 2 hours")."""
+    if seconds is None:
+        return ""
+    for unit_seconds, unit in ((86400, "day"), (3600, "hour"), (60, "minute")):
+        if seconds >= unit_seconds:
+            count = int(round(seconds / float(unit_seconds)))
+            return "about %s %s%s" % (count, unit, "s" if count != 1 else "")
+    return "less than a minute"
+
+def preempt_jobs():
+    """Asks a long running job to make way for a much smaller queued one when no worker is free for it.
+
+    A queued job is waiting for a worker once it has been queued for two polls with disk space to spare.
+    The job stops after its next progress update and goes back on the queue; when it runs again it resumes
+    from its manifest (see docket_socket). Only jobs that have run PREEMPT_AFTER_SECONDS, have PREEMPT_RATIO
+    times more work left than the first job in the queue, and have been preempted fewer than PREEMPT_MAX
+    times are preempted. Batches are not preempted.
+
+    Returns:
+            The ID of the job asked to stop, or None.
+    """
+    connection = jobs_db()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            running = connection.execute("SELECT * FROM jobs WHERE status='running'").fetchall()
+            schedule = runnable_schedule(connection)
+            preempted = None
+            if (schedule and time.time() - schedule[0]["submitted"] > 2 * WORKER_POLL_SECONDS and
+                    free_disk_bytes() >= MIN_FREE_BYTES and not any(job["preempt"] for job in running)):
+                rates = scheduler_rates(connection)
+                candidates = [job for job in running if job["batch_id"] is None and job["preemptions"] < PREEMPT_MAX and
+                    time.time() - job["started"] > PREEMPT_AFTER_SECONDS and
+                    estimate_job_seconds(job, rates) > PREEMPT_RATIO * max(schedule[0]["seconds"], 1)]
+                if candidates:
+                    preempted = max(candidates, key=lambda job: estimate_job_seconds(job, rates))["id"]
+                    connection.execute("UPDATE jobs SET preempt=1 WHERE id=?", (preempted,))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return preempted
+    finally:
+        connection.close()
+
+def check_preempted(job_id):
+    """Raises JobPreempted if the scheduler has asked the job to stop (see preempt_jobs)."""
+    job = get_job(job_id) if job_id is not None else None
+    if job is not None and job["preempt"]:
+        raise JobPreempted("Job %s preempted" % job_id)
+
+def claim_batch(connection, batch_id):
+    """Marks the queued jobs of a batch as running in this process (inside the caller's transaction)."""
+    connection.execute("UPDATE jobs SET status='running', worker_pid=?, started=? WHERE batch_id=? AND status='queued'",
+        (os.getpid(), time.time(), batch_id))
+    connection.execute("UPDATE batches SET status='running' WHERE id=?", (batch_id,))
+
+def requeue_interrupted_jobs():
+    """Puts running jobs whose worker process no longer exists back on the queue.
+
+    Called when the worker starts and whenever a worker process dies, so jobs
+    interrupted by a crash or a server restart are picked back up.
+
+    Returns:
+            The number of jobs requeued.
+    """
+    connection = jobs_db()
+    try:
+        requeued = 0
+        for job in connection.execute("SELECT id, worker_pid FROM jobs WHERE status='running'").fetchall():
+            try:
+                os.kill(job["worker_pid"], 0)
+                continue # worker still alive
+            except (OSError, TypeError):
+                pass
+            connection.execute("UPDATE jobs SET status='queued', worker_pid=NULL, preempt=0 WHERE id=? AND status='running'", (job["id"],))
+            requeued += 1
+        return requeued
+    finally:
+        connection.close()
+
+def run_job(job):
+    """Runs a claimed job through docket_socket and records the outcome in the queue.
+
+    Arg:
+            job: job row returned by claim_job.
+    """
+    if job["batch_id"] is not None:
+        run_batch(job["batch_id"])
+        return
+    try:
+        completed = docket_socket(PROCESS_DIRECTORY, None, job["docket"], job["doc_type"].split(","), job["email"], job_id=job["id"])
+    except JobPreempted:
+        # back on the queue; the next run resumes from the job folder's manifest
+        connection = jobs_db()
+        try:
+            connection.execute("UPDATE jobs SET status='queued', worker_pid=NULL, preempt=0, preemptions=preemptions+1 WHERE id=?", (job["id"],))
+        finally:
+            connection.close()
+        fold_job_metrics(job["id"])
+        return
+    except Exception as e:
+        update_job(job["id"], error=str(e))
+        completed = False
+    update_job(job["id"], status="done" if completed else "failed", finished=time.time())
+    fold_job_metrics()
+
+def run_batch(batch_id):
+    """Runs the dockets of a batch claimed by this process, then publishes a combined index and sends one email.
+
+    The dockets run one after another in this process, sharing its connection pool, and duplicate
+    comments are grouped across the whole batch (see DocketDedup). While a docket downloads, the
+    metadata of the next one is fetched into the metadata cache (see prefetch_metadata).
+
+    Arg:
+            batch_id: ID of the batch.
+    """
+    batch_row, jobs = get_batch(batch_id)
+    doctype = batch_row["doc_type"].split(",")
+    claimed = [job for job in jobs if job["status"] == "running" and job["worker_pid"] == os.getpid()]
+    dedup = DocketDedup()
+    for position, job in enumerate(claimed):
+        stop_prefetch = threading.Event()
+        prefetch = threading.Thread(target=prefetch_metadata, args=([next_job["docket"] for next_job in claimed[position + 1:position + 2]], doctype, stop_prefetch), daemon=True)
+        prefetch.start()
+        try:
+            completed = docket_socket(PROCESS_DIRECTORY, None, job["docket"], doctype, batch_row["email"], job_id=job["id"], dedup=dedup, notify=False)
+        except Exception as e:
+            update_job(job["id"], error=str(e))
+            completed = False
+        stop_prefetch.set()
+        prefetch.join()
+        update_job(job["id"], status="done" if completed else "failed", finished=time.time())
+    batch_row, jobs = get_batch(batch_id)
+    try:
+        zip_names = write_batch_index(batch_id, jobs)
+    except Exception as e:
+        print("Failed to write the index of batch %s due to %s" % (batch_id, e))
+        zip_names = []
+    lines = []
+    for job in jobs:
+        if job["status"] == "done":
+            lines += ['%s: [WEB ADDRESS TBD]/docket/%s' % (job["docket"], zip_name) for zip_name in job["zips"].split(",") if zip_name]
+        else:
+            lines.append('%s: download failed (%s)' % (job["docket"], job["error"] or job["status"]))
+    lines += ['Combined index: [WEB ADDRESS TBD]/docket/%s' % zip_name for zip_name in zip_names]
+    send_mail('Your docket batch download is complete', 'Your batch of %s dockets is complete:\n' % len(jobs) + "\n".join(lines), 'letzlerr@gao.gov', [batch_row["email"]], fail_silently=False)
+    update_batch(batch_id, status="done" if all(job["status"] == "done" for job in jobs) else "failed", finished=time.time(), zips=",".join(zip_names))
+    fold_job_metrics()
+
+def prefetch_metadata(docket_IDs, doctype, stop):
+    """Fetches the document.json data of dockets into the metadata cache ahead of their download (see get_document).
+
+    Only records of the requested types are fetched. Stops early once stop is set.
+
+    Arg:
+            docket_IDs: The dockets to prefetch.
+            doctype: List of document types requested.
+            stop: threading.Event set when the prefetch should end.
+    """
+    if METADATA_CACHE_TTL <= 0:
+        return
+    for docket_ID in docket_IDs:
+        try:
+            document_IDs = (document_data["documentId"] for document_data in list_docket_records(docket_ID)
+                if document_data["documentStatus"] != "Withdrawn" and
+                document_folder(document_data["documentType"], "primary" in doctype, "supporting" in doctype, "comments" in doctype) is not None)
+            for document in ordered_map(get_document, document_IDs, BATCH_PREFETCH_WORKERS):
+                if stop.is_set():
+                    return
+        except Exception as e:
+            print("Stopped prefetching %s due to %s" % (docket_ID, e))
+
+def write_batch_index(batch_id, jobs):
+    """Writes a combined index of every record downloaded by a batch and publishes it as a zip.
+
+    The index (batch_<id>_index.xlsx and .csv) lists the records of each docket from its manifest,
+    with duplicate groups found across the whole batch, and has a second worksheet with the status
+    and zip files of each docket. Records past XLSX_MAX_ROWS continue on worksheets Records 2, Records 3, ...
+
+    Arg:
+            batch_id: ID of the batch.
+            jobs: the batch's job rows.
+    Returns:
+            The names of the published zip files.
+    """
+    PATH = os.path.join(PROCESS_DIRECTORY, "batch_%s" % batch_id)
+    os.makedirs(PATH, exist_ok=True)
+    name = "batch_%s_index" % batch_id
+    workbook = xlsxwriter.Workbook(os.path.join(PATH, name + ".xlsx"), {'constant_memory': True})
+    bold = workbook.add_format({'bold': True})
+    records_sheet = workbook.add_worksheet("Records")
+    records_sheet.write_row(0, 0, BATCH_INDEX_FIELDS, bold)
+    dockets_sheet = workbook.add_worksheet("Dockets")
+    dockets_sheet.write_row(0, 0, ('Docket', 'Status', 'Records', 'Error', 'Zip File(s)'), bold)
+    first_of_group = {} # fingerprint -> first document ID in the batch
+    records_sheets = 1
+    row = 1
+    with open(os.path.join(PATH, name + ".csv"), "w", newline="", encoding="utf-8") as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(BATCH_INDEX_FIELDS)
+        for number, job in enumerate(jobs, 1):
+            dockets_sheet.write_row(number, 0, (job["docket"], job["status"], job["records_total"], job["error"], job["zips"].replace(",", ", ")))
+            if not job["folder"]:
+                continue
+            manifest = load_manifest(job["folder"])
+            for document_ID in sorted(manifest):
+                entry = manifest[document_ID]
+                duplicate_group = ""
+                if entry.get("Fingerprint"):
+                    duplicate_group = first_of_group.setdefault(entry["Fingerprint"], document_ID)
+                    if duplicate_group == document_ID:
+                        duplicate_group = ""
+                values = (job["docket"], document_ID, entry["Type"], entry.get("Title", ""), entry.get("Submitter", ""), entry.get("Organization", ""),
+                    (entry.get("Posted") or "")[:10], parse_count(entry.get("AttachmentCount")), duplicate_group, job["zips"].replace(",", ", "))
+                if row >= XLSX_MAX_ROWS:
+                    records_sheets += 1
+                    records_sheet = workbook.add_worksheet("Records %s" % records_sheets)
+                    records_sheet.write_row(0, 0, BATCH_INDEX_FIELDS, bold)
+                    row = 1
+                records_sheet.write_row(row, 0, values)
+                row += 1
+                csv_writer.writerow(values)
+    workbook.close()
+    index_zip = DocketZip(ZIPPATH, PATH)
+    for extension in (".xlsx", ".csv"):
+        index_zip.add(os.path.join(PATH, name + extension))
+    zip_names = index_zip.close()
+    record_storage(PATH, zip_names)
+    return zip_names
+
+def directory_size(path):
+    """Bytes in the files under path, and the bytes deleting them would free (0, 0 if it does not exist).
+
+    Attachments linked from the attachment cache (or another job folder) have more than one link,
+    so deleting the job folder does not free them; only files with a single link are reclaimable.
+    """
+    total = reclaimable = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0, 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                sizes = directory_size(entry.path)
+                total += sizes[0]
+                reclaimable += sizes[1]
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                total += stat.st_size
+                if stat.st_nlink == 1:
+                    reclaimable += stat.st_size
+        except OSError:
+            pass # removed while counting
+    return total, reclaimable
+
+def record_storage(PATH, zip_names, records=0):
+    """Records the size of a finished job's folder and zips for enforce_retention.
+
+    Arg:
+            PATH: The job folder.
+            zip_names: The names of its zips in ZIPPATH.
+            records: The number of records in the job.
+    """
+    zip_bytes = 0
+    for zip_name in zip_names:
+        try:
+            zip_bytes += os.path.getsize(os.path.join(ZIPPATH, zip_name))
+        except OSError:
+            pass
+    connection = jobs_db()
+    try:
+        now = time.time()
+        connection.execute("INSERT OR IGNORE INTO storage (folder, created, last_access) VALUES (?, ?, ?)", (PATH, now, now))
+        connection.execute("UPDATE storage SET zips=?, folder_bytes=?, reclaimable_bytes=?, zip_bytes=?, records=?, last_access=? WHERE folder=?",
+            (",".join(zip_names),) + directory_size(PATH) + (zip_bytes, records, now, PATH))
+    finally:
+        connection.close()
+
+def record_storage_access(PATH):
+    """Counts a new job for a job folder, tracking the folder for enforce_retention from the moment it is used."""
+    connection = jobs_db()
+    try:
+        now = time.time()
+        connection.execute("INSERT OR IGNORE INTO storage (folder, created, last_access) VALUES (?, ?, ?)", (PATH, now, now))
+        connection.execute("UPDATE storage SET last_access=?, accesses=accesses+1 WHERE folder=?", (now, PATH))
+    finally:
+        connection.close()
+
+def record_storage_size(PATH):
+    """Updates the size of a job folder whose job stopped without publishing (failed or preempted)."""
+    connection = jobs_db()
+    try:
+        connection.execute("UPDATE storage SET folder_bytes=?, reclaimable_bytes=? WHERE folder=?", directory_size(PATH) + (PATH,))
+    finally:
+        connection.close()
+
+def track_untracked_folders():
+    """Adds job folders missing from the storage table (made before it existed, or by a job whose worker
+    died), with their zips, so enforce_retention can delete them. Folders tracked with no size yet are measured.
+
+    Returns:
+            The number of folders added.
+    """
+    connection = jobs_db()
+    try:
+        tracked = dict((row["folder"], row["folder_bytes"]) for row in connection.execute("SELECT folder, folder_bytes FROM storage"))
+    finally:
+        connection.close()
+    try:
+        folders = [entry.path for entry in os.scandir(PROCESS_DIRECTORY) if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        return 0
+    added = 0
+    for PATH in folders:
+        if PATH in tracked:
+            if not tracked[PATH]:
+                record_storage_size(PATH)
+            continue
+        name = os.path.basename(PATH)
+        # zips are published as <folder>.zip, or <folder>_1.zip, <folder>_2.zip, ... (see DocketZip)
+        zip_names = [zip_name for zip_name in os.listdir(ZIPPATH) if re.match(re.escape(name) + "(_[0-9]+)?\\.zip$", zip_name)] if os.path.isdir(ZIPPATH) else []
+        record_storage(PATH, zip_names)
+        modified = os.stat(PATH).st_mtime
+        connection = jobs_db()
+        try:
+            connection.execute("UPDATE storage SET created=?, last_access=? WHERE folder=?", (modified, modified, PATH))
+        finally:
+            connection.close()
+        added += 1
+    return added
+
+def storage_entries():
+    """The job folders tracked for retention, with "last_used" the later of the last job and the last zip download.
+
+    Returns:
+            List of dictionaries (rows of the storage table plus last_used).
+    """
+    connection = jobs_db()
+    try:
+        rows = connection.execute("SELECT * FROM storage").fetchall()
+    finally:
+        connection.close()
+    entries = []
+    for row in rows:
+        entry = dict(row)
+        entry["last_used"] = entry["last_access"] or 0
+        for zip_name in filter(None, entry["zips"].split(",")):
+            try: # the web server serves the zips, so their access time is the only sign of downloads
+                entry["last_used"] = max(entry["last_used"], os.stat(os.path.join(ZIPPATH, zip_name)).st_atime)
+            except OSError:
+                pass
+        entries.append(entry)
+    return entries
+
+def free_disk_bytes():
+    """Free disk space for job folders, zips and the attachment cache: the smallest if they are on different disks."""
+    free = []
+    for path in (PROCESS_DIRECTORY, ZIPPATH, CACHE_DIRECTORY):
+        try:
+            free.append(shutil.disk_usage(path).free)
+        except OSError:
+            pass
+    return min(free) if free else 0
+
+def estimate_job_bytes(number_of_records):
+    """Disk space a job of number_of_records records is expected to take, from the jobs measured so far."""
+    connection = jobs_db()
+    try:
+        measured = connection.execute("SELECT SUM(folder_bytes + zip_bytes), SUM(records) FROM storage WHERE records > 0").fetchone()
+    finally:
+        connection.close()
+    if measured[1]:
+        return int(number_of_records * measured[0] / measured[1])
+    return number_of_records * ESTIMATED_BYTES_PER_RECORD
+
+def check_disk_space(needed_bytes, enforce=True):
+    """Checks whether a new job fits on disk, deleting old job folders first if needed (see enforce_retention).
+
+    Arg:
+            needed_bytes: estimated size of the job (see estimate_job_bytes)
+            enforce: False to not delete anything (in web requests; the worker deletes folders before it runs the job)
+    Returns:
+            "ok" if it fits now, "wait" if it would fit once queued and running jobs finish and their
+            folders can be deleted, or "refuse" if it would not fit even then.
+    """
+    if free_disk_bytes() - needed_bytes >= MIN_FREE_BYTES:
+        return "ok"
+    if enforce:
+        enforce_retention(needed_bytes)
+    free = free_disk_bytes()
+    if free - needed_bytes >= MIN_FREE_BYTES:
+        return "ok"
+    in_use = sum(entry["reclaimable_bytes"] + entry["zip_bytes"] for entry in storage_entries())
+    if free + in_use - needed_bytes >= MIN_FREE_BYTES:
+        return "wait"
+    return "refuse"
+
+def enforce_retention(needed_bytes=0, dry_run=False):
+    """Deletes job folders (and their zips) that are too old, or least recently used ones while over quota.
+
+    A folder unused for RETENTION_MAX_AGE is deleted unless its docket is popular (RETENTION_WARM_ACCESSES
+    jobs or more). While the folders or zips are over PROCESS_QUOTA_BYTES or ZIP_QUOTA_BYTES, or free disk
+    space would be below MIN_FREE_BYTES after needed_bytes more, the least recently used folders are deleted,
+    popular ones last. Folders of queued or running jobs are never deleted. Sizes count only the bytes deleting
+    a folder frees (see directory_size); attachments shared with the attachment cache are freed by evict_cache,
+    which runs first, along with purge_metadata_cache.
+
+    Arg:
+            needed_bytes: disk space about to be used by a new job
+            dry_run: True to only list what would be deleted
+    Returns:
+            List of (job folder, bytes freed, reason) for each folder deleted.
+    """
+    track_untracked_folders()
+    if not dry_run:
+        if CACHE_MAX_BYTES > 0:
+            evict_cache()
+        purge_metadata_cache()
+    connection = jobs_db()
+    try:
+        in_use = set(row["folder"] for row in connection.execute("SELECT folder FROM jobs WHERE status IN ('queued', 'running')"))
+    finally:
+        connection.close()
+    entries = storage_entries()
+    folder_bytes = sum(entry["reclaimable_bytes"] for entry in entries)
+    zip_bytes = sum(entry["zip_bytes"] for entry in entries)
+    free = free_disk_bytes()
+    entries = [entry for entry in entries if entry["folder"] not in in_use]
+    entries.sort(key=lambda entry: (entry["accesses"] >= RETENTION_WARM_ACCESSES, entry["last_used"]))
+    freed = 0
+    deleted = []
+    now = time.time()
+    for entry in entries:
+        size = entry["reclaimable_bytes"] + entry["zip_bytes"]
+        if entry["accesses"] < RETENTION_WARM_ACCESSES and now - entry["last_used"] > RETENTION_MAX_AGE:
+            reason = "unused for %s days" % int((now - entry["last_used"]) / 86400)
+        elif PROCESS_QUOTA_BYTES and folder_bytes > PROCESS_QUOTA_BYTES:
+            reason = "job folders over quota"
+        elif ZIP_QUOTA_BYTES and zip_bytes > ZIP_QUOTA_BYTES:
+            reason = "zips over quota"
+        elif free + freed - needed_bytes < MIN_FREE_BYTES:
+            reason = "low on disk space"
+        else:
+            continue
+        if not dry_run:
+            delete_job_folder(entry["folder"], filter(None, entry["zips"].split(",")))
+        folder_bytes -= entry["reclaimable_bytes"]
+        zip_bytes -= entry["zip_bytes"]
+        freed += size
+        deleted.append((entry["folder"], size, reason))
+    return deleted
+
+def delete_job_folder(PATH, zip_names):
+    """Deletes a job folder, its zips, and its records in the search index and storage table."""
+    shutil.rmtree(PATH, ignore_errors=True)
+    for zip_name in zip_names:
+        try:
+            os.remove(os.path.join(ZIPPATH, zip_name))
+        except FileNotFoundError:
+            pass
+    if search_available():
+        connection = search_db()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            folder_name = os.path.basename(PATH)
+            connection.execute("DELETE FROM search_text WHERE rowid IN (SELECT id FROM search_documents WHERE folder=?)", (folder_name,))
+            connection.execute("DELETE FROM search_documents WHERE folder=?", (folder_name,))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+    connection = jobs_db()
+    try:
+        connection.execute("DELETE FROM storage WHERE folder=?", (PATH,))
+    finally:
+        connection.close()
+
+def count_queued_jobs():
+    """Counts the records of dockets queued while the API quota was used up (see home).
+
+    A docket with no records fails, as does one that could never fit on disk. Stops without waiting
+    when the quota is used up; the rest are counted on a later call.
+
+    Returns:
+            The number of jobs counted.
+    """
+    connection = jobs_db()
+    try:
+        jobs = connection.execute("SELECT * FROM jobs WHERE status='queued' AND records_total=0 AND batch_id IS NULL ORDER BY id").fetchall()
+    finally:
+        connection.close()
+    counted = 0
+    for job in jobs:
+        try:
+            number_of_records = count_docket_records(job["docket"], wait=False)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code >= 500:
+                break # the API is down; try again later
+            number_of_records = 0
+        except (RateLimited, requests.RequestException):
+            break
+        if not number_of_records:
+            update_job(job["id"], status="failed", finished=time.time(), error='No Docket found for Docket Number: %s' % job["docket"])
+        elif check_disk_space(estimate_job_bytes(number_of_records)) == "refuse":
+            update_job(job["id"], status="failed", finished=time.time(), error='Docket %s is too large for the disk space on the server' % job["docket"])
+        else:
+            update_job(job["id"], records_total=number_of_records)
+        counted += 1
+    return counted
+
+def job_worker(fast_lane=False):
+    """Runs queued docket jobs one at a time until the process is stopped.
+
+    While free disk space is below MIN_FREE_BYTES (after enforce_retention), jobs stay queued.
+
+    Arg:
+            fast_lane: True to only run jobs estimated to take FAST_LANE_SECONDS or less.
+    """
+    while True:
+        if free_disk_bytes() < MIN_FREE_BYTES:
+            enforce_retention()
+            if free_disk_bytes() < MIN_FREE_BYTES:
+                time.sleep(WORKER_POLL_SECONDS)
+                continue
+        job = claim_job(fast_lane)
+        if job is None:
+            time.sleep(WORKER_POLL_SECONDS)
+        else:
+            run_job(job)
+
+def run_worker(processes=WORKER_PROCESSES):
+    """Starts a pool of job_worker processes and keeps it at full strength.
+
+    Each process runs one docket at a time, so processes (plus FAST_LANE_WORKERS
+    for small jobs) caps the number of dockets this worker downloads concurrently.
+    A process that dies is replaced and its job is put back on the queue. Long
+    jobs are preempted for much smaller ones waiting (see preempt_jobs).
+
+    Arg:
+            processes: The number of worker processes.
+    """
+    pool = []
+    fast_pool = []
+    retention_checked = 0
+    while True:
+        if time.time() - retention_checked > RETENTION_CHECK_SECONDS:
+            try:
+                for folder, size, reason in enforce_retention():
+                    print("Deleted %s (%s bytes): %s" % (folder, size, reason))
+            except Exception as e:
+                print("Failed to enforce retention due to {}".format(e))
+            retention_checked = time.time()
+        pool = [process for process in pool if process.is_alive()]
+        fast_pool = [process for process in fast_pool if process.is_alive()]
+        if len(pool) < processes or len(fast_pool) < FAST_LANE_WORKERS:
+            requeued = requeue_interrupted_jobs()
+            if requeued:
+                print("Requeued %s interrupted job(s)" % requeued)
+            for workers, size, fast_lane in ((pool, processes, False), (fast_pool, FAST_LANE_WORKERS, True)):
+                while len(workers) < size:
+                    process = multiprocessing.Process(target=job_worker, args=(fast_lane,), daemon=True)
+                    process.start()
+                    workers.append(process)
+        try:
+            count_queued_jobs()
+            preempted = preempt_jobs()
+            if preempted:
+                print("Preempting job %s" % preempted)
+        except Exception as e:
+            # the pool keeps running; scheduling is tried again on the next poll
+            print("Failed to schedule jobs due to {}".format(e))
+        time.sleep(WORKER_POLL_SECONDS)
+
 def makefolders(directory, docket_no, primary_on, supporting_on, comments_on):
     """Makes folders for the docket number.
     
@@ -128,7 +1462,7 @@ def makefolders(directory, docket_no, primary_on, supporting_on, comments_on):
     if sum([comments_on,primary_on,supporting_on]) != 1:
         if primary_on:
             primary_path = os.path.join(path, "Primary_Documents")
-            os.makedirs(primary_path)
+            os.makedirs(primary_path,exist_ok=True)
         if supporting_on:
             supporting_path = os.path.join(path, "Supporting_Documents")
             os.makedirs(supporting_path,exist_ok=True)
@@ -153,29 +1487,389 @@ def dtime(path=""):
     else:
         return datetime.fromtimestamp(int(os.stat(path).st_mtime)).strftime('%m/%d/%Y %I:%M:%S %p')
 
-def check_quota_and_get(url):
-    """Downloads url. If at the rate limit, wait 10 minutes and retry.
-        
+def check_quota_and_get(url, stream=False, wait=True):
+    """Downloads url once the shared rate limiter allows it. If rate limited anyway, wait and retry.
+
+    Every request takes a token from the token bucket of one of the API_KEYS (see acquire_token),
+    and the rate limit headers of the response are fed back into that bucket (see update_rate_limit).
+    The API key is added to the url here. Requests go through the process's pooled session with
+    HTTP_TIMEOUT; connection errors, timeouts and 5xx responses are retried up to HTTP_RETRIES
+    times with exponential backoff, each retry taking a new token. A 429 response blocks its API key
+    for as long as the response asks (see retry_after_seconds) and counts as a retry too. Once out of
+    retries, and for any other 4xx response, requests.HTTPError is raised. With wait=False (a web request is waiting)
+    the request is made once with HTTP_WEB_TIMEOUT and is not retried.
+
     Arg:
-            url: The url to be downloaded.
+            url: The url to be downloaded (without api_key).
+            stream: If True, only the headers are read; the body is read later with iter_content
+                    (see save_stream) and the caller must close the response.
+            wait: False to raise RateLimited instead of waiting for a request token, and not to retry (for web requests)
     Returns:
-            request_response: request object of the url.
+            request_response: request object of the url (status 2xx or 3xx).
     """
     #print("checking rate limit\n")
     #print(url)
-    rate_limit_remaining = 1
+    attempt = 0
+    retries = HTTP_RETRIES if wait else 0
+    timeout = HTTP_TIMEOUT if wait else HTTP_WEB_TIMEOUT
     while True:
-        if rate_limit_remaining>=0:
-            request_response = requests.get(url)
+        started = time.time()
+        api_key = acquire_token(rate_limit_docket, wait)
+        observe("rate_limit_wait_seconds", "", time.time() - started)
+        started = time.time()
+        try:
+            request_response = get_session().get(url, params={"api_key": api_key}, stream=stream, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            record_request(url, time.time() - started, None)
+            attempt += 1
+            if attempt > retries:
+                raise
+            time.sleep(HTTP_BACKOFF_SECONDS * 2**(attempt - 1))
+            continue
+        record_request(url, time.time() - started, request_response.status_code)
+        if 'X-RateLimit-Remaining' in request_response.headers:
             rate_limit_remaining = int(request_response.headers['X-RateLimit-Remaining'])
             assert rate_limit_remaining>=0, "Negative rate limit; heading for infinite loop!"
-            if rate_limit_remaining == 0:
-                print ('Rate limited. Waiting 10 minutes to retry', end='')
-                time.sleep(600)
-            else:
-                return request_response
-        else :
-            time.sleep(10)
+            update_rate_limit(api_key, request_response.headers)
+        if request_response.status_code == 429:
+            # no thread or process uses the key again until the API allows it; acquire_token waits for that
+            block_api_key(api_key, time.time() + retry_after_seconds(request_response.headers, attempt))
+            if not wait:
+                request_response.close()
+                raise RateLimited("The API answered 429 Too Many Requests")
+        if request_response.status_code == 429 and attempt < retries:
+            request_response.close()
+            attempt += 1
+        elif request_response.status_code >= 500 and attempt < retries:
+            request_response.close()
+            attempt += 1
+            time.sleep(HTTP_BACKOFF_SECONDS * 2**(attempt - 1))
+        elif request_response.status_code >= 400:
+            # out of retries, or a client error: the body is an error message, not the data asked for
+            request_response.close()
+            # the url without api_key, since the message ends up in logs and job_status
+            raise requests.HTTPError("%s %s for %s" % (request_response.status_code, request_response.reason, url), response=request_response)
+        else:
+            return request_response
+
+def get_session():
+    """Returns this process's requests.Session, creating it on first use.
+
+    The session keeps up to HTTP_POOL_SIZE connections per host alive, so the download
+    threads reuse TCP/TLS connections instead of making a new one for every request.
+    A forked worker process gets its own session.
+    """
+    global http_session, http_session_pid
+    with http_lock:
+        if http_session_pid != os.getpid():
+            http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            http_session.mount("http://", adapter)
+            http_session.mount("https://", adapter)
+            http_session_pid = os.getpid()
+        return http_session
+
+def record_request(url, seconds, status_code):
+    """Records a request's latency, grouped by API endpoint (documents.json, document.json, download).
+
+    Arg:
+            url: The url requested.
+            seconds: Time until the response headers arrived (or the request failed).
+            status_code: HTTP status of the response, or None if no response was received.
+    """
+    observe("request_seconds", url_endpoint(url), seconds, error=status_code is None or status_code >= 500)
+
+def url_endpoint(url):
+    """The API endpoint of a url, ex: document.json"""
+    return url.split("?")[0].rstrip("/").split("/")[-1]
+
+def log_request_stats(logfile):
+    """Writes the request counts and latency per API endpoint to the logfile."""
+    with metrics_lock:
+        for endpoint, stats in sorted(job_metrics["timings"].get("request_seconds", {}).items()):
+            logfile.write("[%s] %s: %s requests, %s errors, %.2f s average, %.2f s max\n" % (dtime(), endpoint,
+                stats["count"], stats["errors"], stats["seconds"] / stats["count"], stats["max_seconds"]))
+
+def observe(metric, label, seconds, size=0, error=False):
+    """Adds one timed operation to the current job's metrics.
+
+    Arg:
+            metric: one of METRICS
+            label: what was timed, ex: the endpoint of a request
+            seconds: how long it took
+            size: bytes handled, for throughput
+            error: True if the operation failed
+    """
+    with metrics_lock:
+        stats = job_metrics["timings"].setdefault(metric, {}).get(label)
+        if stats is None:
+            stats = job_metrics["timings"][metric][label] = {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "bytes": 0, "buckets": [0] * (len(METRICS_BUCKETS) + 1)}
+        stats["count"] += 1
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["bytes"] += size
+        stats["errors"] += bool(error)
+        bucket = 0
+        while bucket < len(METRICS_BUCKETS) and seconds > METRICS_BUCKETS[bucket]:
+            bucket += 1
+        stats["buckets"][bucket] += 1
+
+def count_metric(metric, label, amount=1):
+    """Adds amount to one of the current job's counters, ex: count_metric("records", "failed")."""
+    with metrics_lock:
+        counters = job_metrics["counters"].setdefault(metric, {})
+        counters[label] = counters.get(label, 0) + amount
+
+def set_gauge(metric, label, value):
+    """Sets one of the current job's gauges, ex: the depth of a pipeline queue."""
+    with metrics_lock:
+        job_metrics["gauges"].setdefault(metric, {})[label] = value
+
+def reset_metrics():
+    """Clears the metrics at the start of a job."""
+    with metrics_lock:
+        for kind in job_metrics:
+            job_metrics[kind].clear()
+
+def metrics_summary():
+    """The current job's metrics, with the average time and bytes per second of each timing.
+
+    Returns:
+            Dictionary with "timings", "counters" and "gauges", ready for json.
+    """
+    with metrics_lock:
+        summary = json.loads(json.dumps(job_metrics))
+    for timings in summary["timings"].values():
+        for stats in timings.values():
+            stats["average_seconds"] = stats["seconds"] / stats["count"]
+            stats["bytes_per_second"] = stats["bytes"] / stats["seconds"] if stats["seconds"] else 0
+    summary["buckets"] = list(METRICS_BUCKETS)
+    return summary
+
+def save_job_metrics(job_id):
+    """Stores a snapshot of the current job's metrics in the jobs database for the metrics view.
+
+    Does nothing when job_id is None (docket_socket run outside the queue).
+    """
+    if job_id is None:
+        return
+    with metrics_lock:
+        snapshot = json.dumps(job_metrics)
+    connection = jobs_db()
+    try:
+        connection.execute("INSERT OR REPLACE INTO job_metrics (job_id, updated, metrics) VALUES (?, ?, ?)", (job_id, time.time(), snapshot))
+    finally:
+        connection.close()
+
+def merge_metrics(total, snapshot):
+    """Adds the timings and counters of a metrics snapshot (see save_job_metrics) to total, in place."""
+    for metric, labels in snapshot["timings"].items():
+        for label, stats in labels.items():
+            into = total["timings"].setdefault(metric, {}).get(label)
+            if into is None:
+                total["timings"][metric][label] = dict(stats, buckets=list(stats["buckets"]))
+                continue
+            for key in ("count", "errors", "seconds", "bytes"):
+                into[key] += stats[key]
+            into["max_seconds"] = max(into.get("max_seconds", 0.0), stats.get("max_seconds", 0.0))
+            into["buckets"] = [a + b for a, b in zip(into["buckets"], stats["buckets"])]
+    for metric, labels in snapshot["counters"].items():
+        counters = total["counters"].setdefault(metric, {})
+        for label, value in labels.items():
+            counters[label] = counters.get(label, 0) + value
+    return total
+
+def fold_job_metrics(job_id=None):
+    """Adds the metrics of finished jobs to the totals row (METRICS_TOTALS_ID) and deletes their own rows.
+
+    Keeps the job_metrics table, and so each scrape of the metrics view, to one row per unfinished job.
+
+    Arg:
+            job_id: a job to fold in even if it is queued (a preempted job starts its metrics over when it runs again)
+    """
+    connection = jobs_db()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute("""SELECT job_id, metrics FROM job_metrics WHERE job_id != ? AND
+                (job_id = ? OR job_id NOT IN (SELECT id FROM jobs WHERE status IN ('queued', 'running')))""",
+                (METRICS_TOTALS_ID, job_id)).fetchall()
+            if rows:
+                totals_row = connection.execute("SELECT metrics FROM job_metrics WHERE job_id=?", (METRICS_TOTALS_ID,)).fetchone()
+                totals = json.loads(totals_row["metrics"]) if totals_row is not None else {"timings": {}, "counters": {}, "gauges": {}}
+                for row in rows:
+                    merge_metrics(totals, json.loads(row["metrics"]))
+                connection.execute("INSERT OR REPLACE INTO job_metrics (job_id, updated, metrics) VALUES (?, ?, ?)",
+                    (METRICS_TOTALS_ID, time.time(), json.dumps(totals)))
+                connection.executemany("DELETE FROM job_metrics WHERE job_id=?", [(row["job_id"],) for row in rows])
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
+
+def prometheus_line(name, labels, value):
+    """One line of the Prometheus text format, ex: docket_socket_jobs{status="queued"} 3"""
+    labels = ",".join('%s="%s"' % (label_name, str(label_value).replace("\\", "\\\\").replace('"', '\\"'))
+        for label_name, label_value in labels if label_value != "")
+    return "docket_socket_%s%s %s" % (name, "{%s}" % labels if labels else "", value)
+
+def rate_limit_db():
+    """Opens (once per thread) the token bucket database, adding a bucket for any new API key.
+
+    Returns:
+            connection: sqlite3 connection to RATE_LIMIT_DB.
+    """
+    if getattr(rate_limit_local, "pid", None) == os.getpid():
+        return rate_limit_local.connection
+    connection = sqlite3.connect(RATE_LIMIT_DB, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS rate_limit (
+        api_key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        capacity REAL NOT NULL,
+        updated REAL NOT NULL,
+        blocked_until REAL NOT NULL DEFAULT 0)""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS rate_limit_dockets (
+        docket TEXT PRIMARY KEY,
+        last_served REAL NOT NULL DEFAULT 0,
+        last_waiting REAL NOT NULL DEFAULT 0)""")
+    for api_key in API_KEYS:
+        connection.execute("INSERT OR IGNORE INTO rate_limit (api_key, tokens, capacity, updated) VALUES (?, ?, ?, ?)",
+            (api_key, RATE_LIMIT_PER_HOUR, RATE_LIMIT_PER_HOUR, time.time()))
+    rate_limit_local.pid = os.getpid()
+    rate_limit_local.connection = connection
+    return connection
+
+def refill(bucket, now):
+    """Tokens in a bucket at time now. Buckets refill continuously at their hourly capacity."""
+    return min(bucket["capacity"], bucket["tokens"] + (now - bucket["updated"]) * bucket["capacity"] / 3600)
+
+class RateLimited(Exception):
+    """Raised by acquire_token when no request token is available and the caller cannot wait."""
+
+def acquire_token(docket_ID="", can_wait=True):
+    """Waits for a request token and returns the API key it belongs to.
+
+    Takes one token from the fullest bucket in API_KEYS. Requests are paced by the refill rate
+    rather than stalling once the quota runs out. While tokens are scarce (fewer than
+    FAIR_SHARE_RESERVE), the dockets waiting for tokens take turns, the docket served longest
+    ago going first, so one large docket cannot starve the others.
+
+    Arg:
+            docket_ID: The docket the request is for.
+            can_wait: False to raise RateLimited instead of waiting when no token is available.
+    Returns:
+            api_key: The API key to send with the request.
+    """
+    connection = rate_limit_db()
+    while True:
+        now = time.time()
+        wait = RATE_LIMIT_POLL_SECONDS
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("INSERT OR IGNORE INTO rate_limit_dockets (docket) VALUES (?)", (docket_ID,))
+            connection.execute("UPDATE rate_limit_dockets SET last_waiting=? WHERE docket=?", (now, docket_ID))
+            best_key, best_tokens = None, 0
+            for bucket in connection.execute("SELECT * FROM rate_limit").fetchall():
+                if bucket["api_key"] not in API_KEYS:
+                    continue
+                if bucket["blocked_until"] > now:
+                    wait = min(wait, bucket["blocked_until"] - now)
+                    continue
+                tokens = refill(bucket, now)
+                if tokens >= 1 and tokens > best_tokens:
+                    best_key, best_tokens = bucket["api_key"], tokens
+                else:
+                    wait = min(wait, (1 - tokens) * 3600 / bucket["capacity"])
+            if best_key is not None and best_tokens < FAIR_SHARE_RESERVE:
+                # tokens are scarce: only the waiting docket served longest ago may take one
+                turn = connection.execute("SELECT docket FROM rate_limit_dockets WHERE last_waiting>? ORDER BY last_served, docket LIMIT 1",
+                    (now - 4*RATE_LIMIT_POLL_SECONDS,)).fetchone()
+                if turn is not None and turn["docket"] != docket_ID:
+                    best_key = None
+            if best_key is not None:
+                connection.execute("UPDATE rate_limit SET tokens=?, updated=? WHERE api_key=?", (best_tokens - 1, now, best_key))
+                connection.execute("UPDATE rate_limit_dockets SET last_served=? WHERE docket=?", (now, docket_ID))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        if best_key is not None:
+            return best_key
+        if not can_wait:
+            raise RateLimited("No API request token available")
+        time.sleep(max(wait, 0.01))
+
+def update_rate_limit(api_key, headers):
+    """Feeds the rate limit headers of a response back into the API key's bucket.
+
+    X-RateLimit-Limit sets the bucket's capacity (and so its refill rate). The bucket never holds
+    more tokens than X-RateLimit-Remaining, since other users of the key spend from the same quota.
+    If the quota is used up and the API says when it resets (X-RateLimit-Reset), the key is not
+    used again until then.
+
+    Arg:
+            api_key: The API key the request was sent with.
+            headers: The response headers.
+    """
+    try:
+        remaining = float(headers['X-RateLimit-Remaining'])
+    except (KeyError, ValueError):
+        return
+    connection = rate_limit_db()
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        bucket = connection.execute("SELECT * FROM rate_limit WHERE api_key=?", (api_key,)).fetchone()
+        if bucket is not None:
+            capacity = float(headers.get('X-RateLimit-Limit') or bucket["capacity"])
+            tokens = min(refill(bucket, now), remaining)
+            blocked_until = bucket["blocked_until"]
+            if remaining == 0 and headers.get('X-RateLimit-Reset', '').isdigit():
+                reset = float(headers['X-RateLimit-Reset'])
+                # the reset header is either seconds to wait or an epoch timestamp
+                blocked_until = reset if reset > 1e9 else now + reset
+            connection.execute("UPDATE rate_limit SET tokens=?, capacity=?, updated=?, blocked_until=? WHERE api_key=?",
+                (tokens, capacity, now, blocked_until, api_key))
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+
+def retry_after_seconds(headers, attempt):
+    """Seconds to wait after a 429 response.
+
+    Arg:
+            headers: The response headers.
+            attempt: Retries made so far for the request.
+    Returns:
+            The Retry-After header (seconds or a date), else X-RateLimit-Reset (seconds or an epoch timestamp),
+            else exponential backoff from HTTP_BACKOFF_SECONDS, for responses without either (ex: from a proxy).
+    """
+    now = time.time()
+    retry_after = headers.get('Retry-After', '').strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    if retry_after:
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - now, 0)
+        except (TypeError, ValueError):
+            pass
+    reset = headers.get('X-RateLimit-Reset', '').strip()
+    if reset.isdigit():
+        reset = float(reset)
+        return max(reset - now, 0) if reset > 1e9 else reset
+    return HTTP_BACKOFF_SECONDS * 2**attempt
+
+def block_api_key(api_key, until):
+    """Empties an API key's bucket and keeps acquire_token from using the key before the time until."""
+    connection = rate_limit_db()
+    connection.execute("UPDATE rate_limit SET tokens=0, updated=?, blocked_until=MAX(blocked_until, ?) WHERE api_key=?",
+        (time.time(), until, api_key))
 
 def getvalue(json,key):
     """Check if json key exists. If it does return the 'value' otherwise return an empty string.
@@ -183,67 +1877,376 @@ def getvalue(json,key):
             json: The json data to pull from.
             key: The key from the json data you are interested in.
     Returns:
-            The string in the 'value' key of the requested key.
+            The string in the 'value' key of the requested key.
+    """
+    #example illustrating that "value" is nested:
+    #  "comment":{"label":"Comment","value":"See attached file(s)"},"
+    try:
+        json.get(key)
+        return json.get(key)['value']
+    except:
+        return ""
+
+class DocumentRecord(object):
+    """The fields of a document.json response used by Docket Socket, parsed once per document.
+
+    Arg:
+            document_ID: The document ID.
+            json: The parsed document.json response.
+    """
+    __slots__ = ("document_ID", "title", "submitter_name", "organization_name", "comment", "abstract",
+        "restrict_reason", "attachment_count", "posted_date", "file_formats", "attachments")
+
+    def __init__(self, document_ID, json):
+        self.document_ID = document_ID
+        self.title = getvalue(json,"title")
+        self.submitter_name = getvalue(json,"submitterName")
+        self.organization_name = getvalue(json,"organization")
+        self.comment = getvalue(json,"comment")
+        self.abstract = getvalue(json,"abstract")
+        self.restrict_reason = getvalue(json,"restrictReason")
+        self.attachment_count = getvalue(json,"attachmentCount")
+        self.posted_date = json.get("postedDate") or ""
+        self.file_formats = json.get("fileFormats")
+        # the file formats of each attachment
+        self.attachments = [attachment["fileFormats"] for attachment in json.get("attachments") or []]
+
+def get_document(document_ID):
+    """Gets the document.json data for a document ID, from the metadata cache if possible.
+
+    Responses are kept (gzipped) under METADATA_CACHE_DIRECTORY/<docket>/ for METADATA_CACHE_TTL seconds,
+    so later jobs, refreshes and reports for the same documents do not use the API. Only 200 responses
+    with a documentId are kept; anything else raises requests.HTTPError or ValueError, and the record fails.
+
+    Arg:
+            document_ID: The document ID, like OCC-2013-0003-0062
+    Returns:
+            DocumentRecord for the document.
+    """
+    cache_path = os.path.join(METADATA_CACHE_DIRECTORY, document_ID.rsplit("-", 1)[0], document_ID + ".json.gz")
+    try:
+        if time.time() - os.stat(cache_path).st_mtime < METADATA_CACHE_TTL:
+            with gzip.open(cache_path, "rb") as cache_file:
+                json_data = json.loads(cache_file.read().decode("utf-8"))
+            if "documentId" in json_data: # error bodies cached by earlier versions are fetched again
+                return DocumentRecord(document_ID, json_data)
+    except (OSError, ValueError):
+        pass # not cached, expired, or unreadable; fetch it again
+    # use the document API to learn more about each document ID, like OCC-2013-0003-0062
+    # ex http://api.data.gov:80/regulations/v3/document.json?documentId=OCC-2013-0003-0062
+    request_response = check_quota_and_get(API_BASE + "/document.json?documentId=%s" % document_ID)
+    if request_response.status_code != 200:
+        raise requests.HTTPError("%s %s for document.json of %s" % (request_response.status_code, request_response.reason, document_ID), response=request_response)
+    body = request_response.content
+    json_data = json.loads(body.decode("utf-8"))
+    if not isinstance(json_data, dict) or "documentId" not in json_data:
+        raise ValueError("document.json of %s has no documentId: %s" % (document_ID, body[:200]))
+    document = DocumentRecord(document_ID, json_data)
+    if METADATA_CACHE_TTL > 0:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            temp_path = "%s.%s.part" % (cache_path, threading.get_ident())
+            with gzip.open(temp_path, "wb") as cache_file:
+                cache_file.write(body)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            pass # not cached (ex: its folder was just purged); the record is fine
+    return document
+
+def purge_metadata_cache():
+    """Deletes the document.json responses older than METADATA_CACHE_TTL (all of them if the cache is turned off),
+    and the docket folders of the metadata cache left empty. Called by enforce_retention.
+
+    Returns:
+            The number of files deleted.
+    """
+    now = time.time()
+    deleted = 0
+    try:
+        dockets = [entry.path for entry in os.scandir(METADATA_CACHE_DIRECTORY) if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        return 0
+    for docket_path in dockets:
+        try:
+            entries = list(os.scandir(docket_path))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if now - entry.stat(follow_symlinks=False).st_mtime >= METADATA_CACHE_TTL:
+                    os.remove(entry.path)
+                    deleted += 1
+            except OSError:
+                pass # replaced or removed meanwhile
+        try:
+            os.rmdir(docket_path)
+        except OSError:
+            pass # not empty
+    return deleted
+
+def dlfiles(list_of_file_formats, logfile, PATH, file_records=None):
+    """Download files (attachments) from a list of file formats.
+
+    Downloads the files in the list and saves them to the PATH.
+    The file name is the document ID given, the attachment number (numbers sequentially),
+    and the file extension. Writes The file download times and file sizes to the logfile.
+
+    Arg:
+            list_of_file_formats: List of different files to be downloaded
+            logfile: variable for logfile
+            PATH: output path
+            file_records: if given, the url, path, size and SHA-256 of each downloaded file is appended to it (see manifest)
+    Returns:
+            files: A list of the files download locations ("N/A" for a file that could not be downloaded).
+    """
+    #ex: list_of_file_formats = ["https://api.data.gov/regulations/v3/download?documentId=OCC-2013-0003-0138&attachmentNumber=1&contentType=pdf"]
+    files=[]
+    for file_format in list_of_file_formats:
+        # use the file format url that was extracted from the file link in the document's API response
+        # ex: file_format = "https://api.data.gov/regulations/v3/download?documentId=OCC-2013-0003-0062&attachmentNumber=1&contentType=pdf"
+        try: # extract the document ID from the file url
+            document_ID = re.search("documentId=(.*?\d)&", file_format).group(1)
+        except:
+            logfile.write("Could not find document ID. Check: " + file_format)
+        try: # find the given attachment number from the url
+            file_num = "_" + re.search("attachmentNumber=([0-9]+)", file_format).group(1)
+        except:
+            file_num = ""
+        # attachments downloaded before, for any docket, are linked from the attachment cache without using the API
+        key = cache_key(file_format)
+        cached = cache_lookup(key)
+        if cached is not None:
+            try:
+                file_ext = cached["file_ext"]
+                file_name_and_path = os.path.join(PATH, document_ID + file_num + file_ext)
+                link_file(cache_object_path(cached["sha256"]), file_name_and_path)
+                if file_records is not None:
+                    file_records.append({"URL":file_format, "Path":file_name_and_path, "Size":cached["size"], "SHA256":cached["sha256"]})
+                logfile.write("[%s] %s bytes\tCopied %s%s%s from the attachment cache\n" % (dtime(), cached["size"], document_ID, file_num, file_ext))
+                count_metric("files", "cached")
+                count_metric("file_bytes", "cached", cached["size"])
+                files.append(PATH + "/" + document_ID + file_num + file_ext)
+                continue
+            except OSError:
+                pass # cached copy was evicted after the lookup; download it again
+        # request the attachment link; the body is streamed to the output file after the name is worked out from the headers
+        try:
+            request = check_quota_and_get(file_format, stream=True)
+        except requests.RequestException as e:
+            # a missing (4xx) attachment, or one still failing after the retries, fails only this file
+            logfile.write("[%s] Could not download %s%s: %s\n" % (dtime(), document_ID, file_num, e))
+            count_metric("files", "failed")
+            files.append("N/A")
+            continue
+        try:
+            if request.headers.get('Content-Disposition') == 'None':
+                logfile.write("[%s] Filetype not found for %s" % (dtime(), file_format))
+                count_metric("files", "failed")
+                files.append("N/A")
+            else:
+                try: # find the file extension using regular expressions from the header
+                    file_ext = re.split(('(\\.[^.]+)"$'),request.headers.get('Content-Disposition'))[1]
+                except:
+                    logfile.write("Could not find file extension. Check: " + request.headers.get('Content-Disposition'))
+                try:
+                    file_name_and_path = os.path.join(PATH, document_ID + file_num + file_ext)
+                    size, sha256 = save_stream(request, file_name_and_path)
+                    cache_store(key, file_name_and_path, sha256, file_ext, size)
+                    if file_records is not None:
+                        file_records.append({"URL":file_format, "Path":file_name_and_path, "Size":size, "SHA256":sha256})
+                    logfile.write("[%s] %s bytes\tDownloaded %s%s%s\n" % (dtime(file_name_and_path), os.stat(file_name_and_path).st_size, document_ID, file_num, file_ext))
+                    count_metric("files", "downloaded")
+                    count_metric("file_bytes", "downloaded", size)
+                    files.append(PATH + "/" + document_ID + file_num + file_ext)
+                except:
+                    logfile.write("Could not download: " + file_format)
+                    count_metric("files", "failed")
+                    files.append("N/A")
+        finally:
+            request.close()
+    return files
+
+def cache_db():
+    """Opens (once per thread) the attachment cache index.
+
+    Table attachments maps each attachment (see cache_key) to the SHA-256 of its content;
+    the content itself is stored once per hash under CACHE_DIRECTORY/objects.
+    Table cache_stats counts hits, misses and evictions across all jobs.
+
+    Returns:
+            connection: sqlite3 connection to the cache index.
+    """
+    if getattr(cache_local, "pid", None) == os.getpid():
+        return cache_local.connection
+    os.makedirs(os.path.join(CACHE_DIRECTORY, "objects"), exist_ok=True)
+    connection = sqlite3.connect(os.path.join(CACHE_DIRECTORY, "attachments.sqlite3"), timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS attachments (
+        key TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        file_ext TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL)""")
+    connection.execute("CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256)")
+    connection.execute("CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    cache_local.pid = os.getpid()
+    cache_local.connection = connection
+    return connection
+
+def cache_key(url):
+    """Attachment cache key for a download url: documentId|attachmentNumber|contentType."""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    return "|".join(query.get(name, [""])[0] for name in ("documentId", "attachmentNumber", "contentType"))
+
+def cache_object_path(sha256):
+    """Where the attachment with the given SHA-256 is stored in the cache."""
+    return os.path.join(CACHE_DIRECTORY, "objects", sha256[:2], sha256)
+
+def count_cache(name, amount=1):
+    """Adds amount to one of the counters in cache_stats."""
+    connection = cache_db()
+    connection.execute("INSERT OR IGNORE INTO cache_stats (name) VALUES (?)", (name,))
+    connection.execute("UPDATE cache_stats SET value=value+? WHERE name=?", (amount, name))
+
+def cache_lookup(key):
+    """Looks up an attachment in the cache, counting the hit or miss.
+
+    Arg:
+            key: the attachment's cache_key
+    Returns:
+            The attachments row (sha256, file_ext, size), or None if the attachment is not cached.
+    """
+    if CACHE_MAX_BYTES <= 0:
+        return None
+    connection = cache_db()
+    cached = connection.execute("SELECT * FROM attachments WHERE key=?", (key,)).fetchone()
+    if cached is None or not os.path.exists(cache_object_path(cached["sha256"])):
+        count_cache("misses")
+        return None
+    connection.execute("UPDATE attachments SET last_access=? WHERE key=?", (time.time(), key))
+    count_cache("hits")
+    count_cache("bytes_saved", cached["size"])
+    return cached
+
+def cache_store(key, file_name_and_path, sha256, file_ext, size):
+    """Adds a downloaded attachment to the cache.
+
+    The content is linked into the cache (see link_file) under its SHA-256,
+    so attachments with identical content are stored once.
+
+    Arg:
+            key: the attachment's cache_key
+            file_name_and_path: the downloaded file
+            sha256: SHA-256 hex digest of the file
+            file_ext: file extension from the Content-Disposition header
+            size: size of the file in bytes
+    """
+    if CACHE_MAX_BYTES <= 0:
+        return
+    object_path = cache_object_path(sha256)
+    if not os.path.exists(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        link_file(file_name_and_path, object_path)
+    cache_db().execute("INSERT OR REPLACE INTO attachments (key, sha256, file_ext, size, last_access) VALUES (?, ?, ?, ?, ?)",
+        (key, sha256, file_ext, size, time.time()))
+
+def link_file(source, destination, hard_link=True):
+    """Puts a copy of source at destination without copying bytes where the file system allows it.
+
+    Tries a hard link (unless hard_link is False, for a copy that will be changed), then a reflink
+    (FICLONE, on file systems that support it), then falls back to copying. The new file is renamed
+    into place, so destination is never left half written.
+    """
+    temp_path = os.path.join(os.path.dirname(destination), ".%s.%s.part" % (os.path.basename(destination), threading.get_ident()))
+    try:
+        if not hard_link:
+            raise OSError("not hard linked")
+        os.link(source, temp_path)
+    except OSError:
+        with open(source, "rb") as source_file, open(temp_path, "wb") as temp_file:
+            try:
+                fcntl.ioctl(temp_file.fileno(), FICLONE, source_file.fileno())
+            except OSError:
+                shutil.copyfileobj(source_file, temp_file, DOWNLOAD_CHUNK_SIZE)
+    os.replace(temp_path, destination)
+
+def evict_cache():
+    """Deletes the least recently used attachments until the cache is within CACHE_MAX_BYTES.
+
+    Job folders keep their own links to evicted attachments, so only the cached copy goes.
+
+    Returns:
+            The number of bytes freed.
     """
-    #example illustrating that "value" is nested:
-    #  "comment":{"label":"Comment","value":"See attached file(s)"},"
+    connection = cache_db()
+    objects = connection.execute("SELECT sha256, MAX(size) AS size, MAX(last_access) AS last_access FROM attachments GROUP BY sha256 ORDER BY last_access").fetchall()
+    total = sum(cached["size"] for cached in objects)
+    freed = 0
+    for cached in objects:
+        if total - freed <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(cache_object_path(cached["sha256"]))
+        except FileNotFoundError:
+            pass
+        connection.execute("DELETE FROM attachments WHERE sha256=?", (cached["sha256"],))
+        count_cache("evictions")
+        freed += cached["size"]
+    return freed
+
+def uncache_attachment(sha256):
+    """Removes an attachment's content from the cache (used when clamd flags it)."""
     try:
-        json.get(key)
-        return json.get(key)['value']
-    except:
-        return ""
+        os.remove(cache_object_path(sha256))
+    except FileNotFoundError:
+        pass
+    cache_db().execute("DELETE FROM attachments WHERE sha256=?", (sha256,))
 
-def dlfiles(list_of_file_formats, logfile, PATH):
-    """Download files (attachments) from a list of file formats.
+def attachment_cache_stats():
+    """Hit, miss and eviction counts of the attachment cache, and its current size.
 
-    Downloads the files in the list and saves them to the PATH.
-    The file name is the document ID given, the attachment number (numbers sequentially),
-    and the file extension. Writes The file download times and file sizes to the logfile.
+    Returns:
+            Dictionary of counter name to value.
+    """
+    connection = cache_db()
+    stats = dict((row["name"], row["value"]) for row in connection.execute("SELECT * FROM cache_stats"))
+    stats["bytes_cached"] = connection.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM attachments GROUP BY sha256)").fetchone()[0]
+    return stats
+
+def save_stream(request_response, file_name_and_path, chunk_size=None):
+    """Writes the body of a streamed response to a file, DOWNLOAD_CHUNK_SIZE bytes at a time.
+
+    The body is written to a temporary file in the same folder which is renamed into place
+    once it is complete, so memory use does not depend on the size of the file and a failed
+    download never leaves a partial file under the final name.
 
     Arg:
-            list_of_file_formats: List of different files to be downloaded
-            logfile: variable for logfile
-            PATH: output path
+            request_response: response requested with stream=True
+            file_name_and_path: where to save the body
+            chunk_size: bytes read per chunk (defaults to DOWNLOAD_CHUNK_SIZE)
     Returns:
-            files: A list of the files download locations.
+            The number of bytes written and the SHA-256 hex digest of the body.
     """
-    #ex: list_of_file_formats = ["https://api.data.gov/regulations/v3/download?documentId=OCC-2013-0003-0138&attachmentNumber=1&contentType=pdf"]
-    files=[]
-    for file_format in list_of_file_formats:
-        # use the file format url that was extracted from the file link in the document's API response
-        # ex: file_format = "https://api.data.gov/regulations/v3/download?documentId=OCC-2013-0003-0062&attachmentNumber=1&contentType=pdf"
-        document_url_to_request = file_format+"&api_key=06oqGOmSQFYA1K5d4cOQ3estOJ0TfokvaSERlwXq"
-        # with a binary output file opened
-        # request the attachment link and write the contents to the binary output file.
-        request = check_quota_and_get(document_url_to_request)
-        attachment_data = request.content 
-        if request.headers.get('Content-Disposition') == 'None':
-            logfile.write("[%s] Filetype not found for %s" % (dtime(), file_format))
-        else:
-            try: # find the file extension using regular expressions from the header
-                file_ext = re.split(('(\\.[^.]+)"$'),request.headers.get('Content-Disposition'))[1]
-            except:
-                logfile.write("Could not find file extension. Check: " + request.headers.get('Content-Disposition'))
-            try: # extract the document ID from the file url
-                document_ID = re.search("documentId=(.*?\d)&", file_format).group(1)
-            except:
-                logfile.write("Could not find document ID. Check: " + file_format)
-            try: # find the given attachment number from the url
-                file_num = "_" + re.search("attachmentNumber=([0-9]+)", file_format).group(1)
-            except:
-                file_num = ""
-            try:
-                file_name_and_path = os.path.join(PATH, document_ID + file_num + file_ext)
-                with open(file_name_and_path, "wb+") as attachment_output_file:
-                    attachment_output_file.write(attachment_data)
-                logfile.write("[%s] %s bytes\tDownloaded %s%s%s\n" % (dtime(file_name_and_path), os.stat(file_name_and_path).st_size, document_ID, file_num, file_ext))
-                files.append(PATH + "/" + document_ID + file_num + file_ext)
-            except:
-                logfile.write("Could not download: " + file_format)
-                files.append("N/A")
-    return files
+    size = 0
+    started = time.time()
+    checksum = hashlib.sha256()
+    temp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(file_name_and_path), prefix=".", suffix=".part", delete=False)
+    try:
+        with temp_file:
+            for chunk in request_response.iter_content(chunk_size=chunk_size or DOWNLOAD_CHUNK_SIZE):
+                temp_file.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+        os.replace(temp_file.name, file_name_and_path)
+    except:
+        os.remove(temp_file.name)
+        observe("download_seconds", url_endpoint(request_response.url), time.time() - started, size, error=True)
+        raise
+    observe("download_seconds", url_endpoint(request_response.url), time.time() - started, size)
+    return size, checksum.hexdigest()
 
-def dlcontent(document_ID, request_response, logfile, PATH):
+def dlcontent(document_ID, document, logfile, PATH, file_records=None):
     """Downloads all primary and supporting documents (including attachments).
 
     Uses the JSON data from the document ID . If the data is not restricted (usually because it is a duplicate),
@@ -252,36 +2255,36 @@ def dlcontent(document_ID, request_response, logfile, PATH):
 
     Arg:
             document_ID: the document ID to be downloaded
-            request_response: JSON data for the particular document ID
+            document: DocumentRecord for the particular document ID
             logfile: variable for logfile
             PATH: output path
+            file_records: if given, a record of each file saved is appended to it (see dlfiles)
     Returns:
             file_links: the file locations of the downloaded documents
             attachment_links the file locations of the downloaded attachments
     """
-    if getvalue(request_response.json(),'restrictReason')=="":
+    if document.restrict_reason=="":
         try:
-            list_of_file_formats = request_response.json()["fileFormats"]
-            file_links=dlfiles(list_of_file_formats, logfile, PATH)[0]
+            list_of_file_formats = document.file_formats
+            file_links=dlfiles(list_of_file_formats, logfile, PATH, file_records)[0]
         except:
             logfile.write("%s not downloaded" % document_ID)
             file_links=["N/A"]
-    if getvalue(request_response.json(),"abstract")!="":    
+    if document.abstract!="":
         file_name_and_path = os.path.join(PATH,document_ID + "_abstract.html")
         with open(file_name_and_path, "w") as html_output_file:
-            html_output_file.write(getvalue(request_response.json(),"abstract"))
-        logfile.write("[%s] %s bytes\tDownloaded %_abstract.html\n" % (dtime(file_name_and_path), os.stat(file_name_and_path).st_size, document_ID))
+            html_output_file.write(document.abstract)
+        logfile.write("[%s] %s bytes\tDownloaded %s_abstract.html\n" % (dtime(file_name_and_path), os.stat(file_name_and_path).st_size, document_ID))
+        if file_records is not None:
+            file_records.append({"URL":"", "Path":file_name_and_path, "Size":os.stat(file_name_and_path).st_size})
 
-    attachment_count = getvalue(request_response.json(),"attachmentCount")
     attachment_links=[]
-    if attachment_count not in {0, '0', ''}:
-        list_of_attachments = request_response.json()["attachments"]
-        for attachment in list_of_attachments:
-            list_of_file_formats = attachment["fileFormats"]
-            attachment_links.extend(dlfiles(list_of_file_formats, logfile, PATH))
+    if document.attachment_count not in {0, '0', ''}:
+        for list_of_file_formats in document.attachments:
+            attachment_links.extend(dlfiles(list_of_file_formats, logfile, PATH, file_records))
     return {"Link":file_links, "Attachments":attachment_links}
     
-def dlcomments(document_ID, request_response, all_html_comments, logfile, PATH):
+def dlcomments(document_ID, document, all_html_comments, logfile, PATH, file_records=None, known_attachments=None):
     """Downloads a single comments (including attachments).
 
     Uses the meta data to save as header and in the directory.
@@ -290,41 +2293,1167 @@ def dlcomments(document_ID, request_response, all_html_comments, logfile, PATH):
 
     Arg:
             document_ID: the document ID of the particular comment
-            request_response: JSON data for the particular document ID
+            document: DocumentRecord for the particular document ID
             all_html_comments: html file containing all html comments concatenated
             logfile: variable for logfile
             PATH: output path
+            file_records: if given, a record of each file saved is appended to it (see dlfiles)
+            known_attachments: attachments of an identical form letter, linked instead of downloaded (see DocketDedup.known_attachments)
     Returns:
             all_html_comments: adds the current comment and returns the html file containing all html comments concatenated
             file_link: the file location of the downloaded document
             attachment_links: file locations of the downloaded attachments.
     """
-    title = getvalue(request_response.json(),"title")
-    submitter_name = getvalue(request_response.json(),"submitterName")
-    organization_name = getvalue(request_response.json(),"organization")
-    attachment_count = getvalue(request_response.json(),"attachmentCount")
-    comment_text = getvalue(request_response.json(),"comment")
+    title = document.title
+    submitter_name = document.submitter_name
+    organization_name = document.organization_name
+    attachment_count = document.attachment_count
+    comment_text = document.comment
     # attach meta data as header to html comment
     comment_all = "<h2>%s</h2><h3>%s</h3><b>Submitter Name:</b> %s <b>Organization Name:</b> %s<br><b>Comment: </b>%s" %(document_ID, title, submitter_name, organization_name, comment_text)            
 
-    if comment_text.lower().strip() not in {"", "see attached", "see attached file", "see attached files", "see attached file(s)"}: #if contains attach
+    if comment_text.lower().strip() not in SEE_ATTACHED: #if contains attach
         all_html_comments = all_html_comments + "\n" + comment_all
         file_name_and_path = os.path.join(PATH, document_ID + ".html")
         file_link =  PATH + "/" + document_ID + ".html"      
         with open(file_name_and_path, "w") as html_output_file:
             html_output_file.write(comment_all)
         logfile.write("[%s] %s bytes\tDownloaded %s.html\n" % (dtime(file_name_and_path), os.stat(file_name_and_path).st_size, document_ID))
+        if file_records is not None:
+            file_records.append({"URL":"", "Path":file_name_and_path, "Size":os.stat(file_name_and_path).st_size})
     else:
         file_link= "See attached"
     #download all attachments
     attachment_links=[]
     if attachment_count not in {0, '0', ''}:
-            list_of_attachments = request_response.json()["attachments"]
-            for attachment in list_of_attachments:
-                list_of_file_formats = attachment["fileFormats"]
-                attachment_links.extend(dlfiles(list_of_file_formats, logfile, PATH))
+        if known_attachments is not None:
+            attachment_links.extend(link_known_attachments(document_ID, known_attachments, logfile, PATH, file_records))
+        else:
+            for list_of_file_formats in document.attachments:
+                attachment_links.extend(dlfiles(list_of_file_formats, logfile, PATH, file_records))
     return {"HTML":all_html_comments, "Link":file_link, "Attachments":attachment_links}
+
+def link_known_attachments(document_ID, known_attachments, logfile, PATH, file_records=None):
+    """Saves the attachments of a form letter comment by linking the copies of an identical comment's attachments.
+
+    Only the headers of each attachment are requested; one whose Content-Length differs from the
+    identical comment's copy is downloaded instead (see dlfiles).
+
+    Arg:
+            document_ID: the document ID of the comment
+            known_attachments: file records of the identical comment's attachments (see DocketDedup.known_attachments)
+            logfile: variable for logfile
+            PATH: output path
+            file_records: if given, a record of each file saved is appended to it (see dlfiles)
+    Returns:
+            files: A list of the files' locations.
+    """
+    files = []
+    for known in known_attachments:
+        url = known["URL"].replace(known["ID"], document_ID)
+        request = check_quota_and_get(url, stream=True)
+        request.close() # only the headers are needed
+        if request.headers.get("Content-Length") != str(known["Size"]):
+            logfile.write("[%s] %s%s differs from form letter %s; downloading it\n" % (dtime(), document_ID, known["Suffix"], known["ID"]))
+            files.extend(dlfiles([url], logfile, PATH, file_records))
+            continue
+        file_name = document_ID + known["Suffix"]
+        file_name_and_path = os.path.join(PATH, file_name)
+        # the attachment cache keeps the content even if the other comment's copy is removed as a duplicate
+        source = cache_object_path(known["SHA256"])
+        if not os.path.exists(source):
+            source = known["Path"]
+        link_file(source, file_name_and_path)
+        if file_records is not None:
+            file_records.append({"URL":url, "Path":file_name_and_path, "Size":known["Size"], "SHA256":known["SHA256"]})
+        logfile.write("[%s] %s bytes\tLinked %s from form letter %s\n" % (dtime(), known["Size"], file_name, known["ID"]))
+        count_metric("files", "known_duplicate")
+        files.append(PATH + "/" + file_name)
+    return files
         
+class DirectoryWriter(object):
+    """Writes the directory of a docket's records as they arrive, in each of DIRECTORY_FORMATS.
+
+    xlsx: <docket>_directory.xlsx, written in xlsxwriter's constant memory mode so rows are flushed to
+    disk as they are written. When a worksheet is full (XLSX_MAX_ROWS), the directory continues on
+    another worksheet. csv: <docket>_directory.csv. parquet: <docket>_directory.parquet, written in
+    batches of PARQUET_BATCH_ROWS (needs pyarrow). CSV and Parquet hold plain values: link paths
+    instead of hyperlinks, ISO dates, and the attachment links joined by "; " (a list in Parquet).
+
+    Arg:
+            PATH: The job folder.
+            docket_ID: The docket number.
+    """
+    def __init__(self, PATH, docket_ID):
+        self.PATH = PATH
+        self.docket_ID = docket_ID
+        self.paths = []
+        self.xls_directory = None
+        self.csv_file = None
+        self.parquet_writer = None
+        if "xlsx" in DIRECTORY_FORMATS:
+            self.paths.append(os.path.join(PATH, docket_ID + "_directory.xlsx"))
+            self.xls_directory = xlsxwriter.Workbook(self.paths[-1], {'constant_memory': True})
+            self.date_format = self.xls_directory.add_format({'num_format': 'mm/dd/yyyy'})
+            self.bold = self.xls_directory.add_format({'bold': True})
+            self.blueU = self.xls_directory.add_format({'underline': True, 'font_color': 'blue'})
+            self.worksheets = 0
+            self.add_worksheet()
+        if "csv" in DIRECTORY_FORMATS:
+            self.paths.append(os.path.join(PATH, docket_ID + "_directory.csv"))
+            self.csv_file = open(self.paths[-1], "w", newline="", encoding="utf-8")
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(DIRECTORY_FIELDS)
+        if "parquet" in DIRECTORY_FORMATS and pyarrow is not None:
+            self.paths.append(os.path.join(PATH, docket_ID + "_directory.parquet"))
+            self.parquet_schema = pyarrow.schema([(field, pyarrow.string()) for field in DIRECTORY_FIELDS[:6]] +
+                [(DIRECTORY_FIELDS[6], pyarrow.date32()), (DIRECTORY_FIELDS[7], pyarrow.int64()), (DIRECTORY_FIELDS[8], pyarrow.string()),
+                (DIRECTORY_FIELDS[9], pyarrow.list_(pyarrow.string()))])
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(self.paths[-1], self.parquet_schema)
+            self.parquet_rows = []
+
+    def add_worksheet(self):
+        """Starts a new worksheet with the header row."""
+        self.worksheets += 1
+        name = self.docket_ID + " Directory"
+        if len(name) > XLSX_MAX_SHEET_NAME:
+            name = "Directory"
+        if self.worksheets > 1: # the docket is already in the first worksheet's name
+            name = "Directory %s" % self.worksheets
+        self.worksheet = self.xls_directory.add_worksheet(name)
+        self.worksheet.set_column('A:A', len(self.docket_ID)*1.4)    # Widen column A
+        self.worksheet.set_column('B:K', 18)    # Widen columns
+        # Write header in bold.
+        self.worksheet.write_row(0, 0, DIRECTORY_FIELDS, self.bold) #write header
+        self.row = 1 #Directory starts on row 1
+
+    def write_row(self, document_ID, link, document_Type, title, submitter_name, organization_name, date_posted, attachment_count, duplicate_group, attachments):
+        """Adds a record to the directory.
+
+        Arg:
+                link: path of the document relative to the job folder, "See attached", or "Download failed"
+                date_posted: datetime the document was posted, or None
+                duplicate_group: document ID of the first comment the record duplicates (see DocketDedup), or ""
+                attachments: paths of the attachments relative to the job folder
+                (the other arguments are the values of the directory's columns)
+        """
+        if self.xls_directory is not None:
+            if self.row >= XLSX_MAX_ROWS:
+                self.add_worksheet()
+            worksheet, row = self.worksheet, self.row
+            worksheet.write_row(row,0,(document_ID, '', document_Type, title,
+                submitter_name, organization_name))
+            #Write Link
+            if link in {"See attached", "Download failed"}:
+                worksheet.write(row, 1, link)
+            else:
+                worksheet.write(row, 1, '=HYPERLINK("%s")' % link, self.blueU)
+            if date_posted is not None:
+                worksheet.write_datetime(row,6,date_posted,self.date_format)
+            else:
+                worksheet.write(row,6,"")
+            worksheet.write_number(row,7,attachment_count)
+            worksheet.write(row,8,duplicate_group)
+            #Write attachment links
+            col = 9
+            for attachment in attachments:
+                worksheet.write(row, col, '=HYPERLINK("%s")' % attachment, self.blueU)
+                col += 1
+            self.row += 1
+        if self.csv_file is not None:
+            self.csv_writer.writerow((document_ID, link, document_Type, title, submitter_name, organization_name,
+                date_posted.strftime('%Y-%m-%d') if date_posted is not None else "", attachment_count, duplicate_group, "; ".join(attachments)))
+        if self.parquet_writer is not None:
+            self.parquet_rows.append((document_ID, link, document_Type, title, submitter_name, organization_name,
+                date_posted.date() if date_posted is not None else None, attachment_count, duplicate_group, list(attachments)))
+            if len(self.parquet_rows) >= PARQUET_BATCH_ROWS:
+                self.flush_parquet()
+
+    def flush_parquet(self):
+        """Writes the buffered Parquet rows as a row group."""
+        if self.parquet_rows:
+            columns = list(zip(*self.parquet_rows))
+            self.parquet_writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.parquet_schema)], schema=self.parquet_schema))
+            self.parquet_rows = []
+
+    def close(self):
+        """Finishes the directory files.
+
+        Returns:
+                The paths of the files written.
+        """
+        if self.xls_directory is not None:
+            self.xls_directory.close()
+        if self.csv_file is not None:
+            self.csv_file.close()
+        if self.parquet_writer is not None:
+            self.flush_parquet()
+            self.parquet_writer.close()
+        return self.paths
+
+class CommentsWriter(object):
+    """Writes the all comments html file as comments arrive, without keeping them in memory.
+
+    A new file is started after COMMENTS_PER_FILE comments or COMMENTS_FILE_BYTES bytes, so very
+    large dockets give files a browser can open. A docket that fits in one file gets
+    <docket>_all_comments.html as before; otherwise the comments are in <docket>_all_comments_1.html,
+    _2.html, ... and <docket>_all_comments.html is an index page linking to them.
+
+    Arg:
+            PATH: The job folder.
+            docket_ID: The docket number.
+    """
+    def __init__(self, PATH, docket_ID):
+        self.PATH = PATH
+        self.docket_ID = docket_ID
+        self.shards = [] # [file name, first document ID, last document ID, number of comments]
+        self.html_output_file = None
+
+    def write(self, document_ID, html):
+        """Appends a comment's html (empty for comments that are only attachments)."""
+        if html == "":
+            return
+        if self.html_output_file is None or self.shards[-1][3] >= COMMENTS_PER_FILE or self.html_output_file.tell() >= COMMENTS_FILE_BYTES:
+            if self.html_output_file is not None:
+                self.html_output_file.close()
+            file_name = "%s_all_comments_%s.html" % (self.docket_ID, len(self.shards) + 1)
+            self.html_output_file = open(os.path.join(self.PATH, file_name), "w")
+            self.shards.append([file_name, document_ID, document_ID, 0])
+        self.html_output_file.write(html)
+        self.shards[-1][2] = document_ID
+        self.shards[-1][3] += 1
+
+    def close(self):
+        """Finishes the all comments file(s).
+
+        Returns:
+                The paths of the files written.
+        """
+        index_path = os.path.join(self.PATH, self.docket_ID + "_all_comments.html")
+        if self.html_output_file is not None:
+            self.html_output_file.close()
+        if len(self.shards) <= 1:
+            if self.shards:
+                os.replace(os.path.join(self.PATH, self.shards[0][0]), index_path)
+            else:
+                open(index_path, "w").close()
+            return [index_path]
+        with open(index_path, "w") as html_output_file:
+            html_output_file.write("<h2>%s Comments</h2><ul>\n" % self.docket_ID)
+            for file_name, first_ID, last_ID, count in self.shards:
+                html_output_file.write('<li><a href="%s">%s to %s</a> (%s comments)</li>\n' % (file_name, first_ID, last_ID, count))
+            html_output_file.write("</ul>\n")
+        return [index_path] + [os.path.join(self.PATH, shard[0]) for shard in self.shards]
+
+def comment_hash(comment_text):
+    """SHA-256 of a comment's text with case and spacing normalized, so form letters match.
+
+    Returns:
+            The hex digest, or "" for comments that only point to their attachments.
+    """
+    text = " ".join(comment_text.lower().split())
+    if text in SEE_ATTACHED:
+        return ""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def minhash(comment_text):
+    """MinHash signature of a comment's MINHASH_SHINGLE_WORDS-word phrases, for finding near duplicates.
+
+    The share of positions where two signatures are equal estimates the share of phrases the comments have in common.
+
+    Returns:
+            List of MINHASH_PERMUTATIONS integers.
+    """
+    words = comment_text.lower().split()
+    shingles = set(" ".join(words[start:start + MINHASH_SHINGLE_WORDS]) for start in range(max(1, len(words) - MINHASH_SHINGLE_WORDS + 1)))
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles]
+    return [min((a * value + b) % MINHASH_PRIME for value in hashes) for a, b in MINHASH_PARAMETERS]
+
+class DocketDedup(object):
+    """Finds duplicate attachments and comments within a docket, as records arrive in documentId order.
+
+    Files with the same SHA-256 as a file saved earlier are deleted and the record's links point to the
+    first copy, so each attachment is stored and zipped once. Comments with the same text (see comment_hash),
+    or with no text and the same attachments, are put in a duplicate group named after the first comment
+    of the group; duplicates after the first link to the first comment's html instead of keeping their own.
+    With DEDUP_NEAR_DUPLICATES, comments whose MinHash signatures are at least DEDUP_SIMILARITY alike join
+    the same group, but keep their own html.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.PATH = ""
+        self.files = {} # SHA-256 -> path of the first copy
+        self.groups = {} # comment fingerprint -> (document ID of the first comment, its html path)
+        self.bands = {} # MinHash band -> document ID of a group
+        self.signatures = {} # document ID of a group -> MinHash signature
+        self.form_letters = {} # comment hash -> attachments of the first comment downloaded, for DEDUP_SKIP_KNOWN_ATTACHMENTS
+
+    def start_docket(self, PATH):
+        """Starts a docket's job folder. Files are only shared within a job folder, so each zip is complete;
+        comment groups carry on across the dockets of a batch (see run_batch)."""
+        self.PATH = PATH
+        self.files = {}
+
+    def add_record(self, record, logfile):
+        """Removes the record's duplicate files and finds its duplicate group.
+
+        Updates record's "Files", "Links" and "HTML" to refer to the first copies, and sets its
+        "Fingerprint". Called by the ordered consumer of docket_socket (one thread).
+
+        Arg:
+                record: the record returned by download_record or fetch_record
+                logfile: variable for logfile
+        Returns:
+                The document ID of the first comment of the record's duplicate group,
+                or "" if the record is not a duplicate (or not a comment).
+        """
+        if record["Type"] == "Public Submission" and "Fingerprint" not in record:
+            # kept in the manifest, since a resumed duplicate no longer lists the files it shared
+            record["Fingerprint"] = record.get("CommentHash", "")
+            attachment_hashes = sorted(file_record["SHA256"] for file_record in record["Files"] if file_record.get("SHA256"))
+            if not record["Fingerprint"] and attachment_hashes:
+                record["Fingerprint"] = "attachments:" + ",".join(attachment_hashes)
+        if DEDUP_FILES:
+            self.remove_duplicate_files(record, logfile)
+        fingerprint = record.get("Fingerprint", "")
+        if not fingerprint:
+            return ""
+        html_path = record["Links"]["Link"] if record["Links"]["Link"] != "See attached" else ""
+        first = self.groups.get(fingerprint)
+        if first is None:
+            self.groups[fingerprint] = (record["ID"], html_path)
+            return self.near_duplicate_group(record)
+        first_ID, first_html = first
+        if DEDUP_FILES and html_path and first_html.startswith(self.PATH) and html_path != first_html and os.path.exists(first_html):
+            # keep one copy of the comment's html; the directory links to it
+            if os.path.exists(html_path):
+                os.remove(html_path)
+            record["Files"] = [file_record for file_record in record["Files"] if file_record["Path"] != html_path]
+            record["Links"]["Link"] = first_html
+        if html_path:
+            record["HTML"] = "\n<h2>%s</h2><h3>%s</h3><b>Submitter Name:</b> %s <b>Organization Name:</b> %s<br><b>Comment: </b>Same as %s" % (
+                record["ID"], record["Title"], record["Submitter"], record["Organization"], first_ID)
+        count_metric("records", "duplicate")
+        return first_ID
+
+    def remove_duplicate_files(self, record, logfile):
+        """Deletes files of the record already saved for an earlier record, pointing the record's links at the first copy."""
+        kept = []
+        for file_record in record["Files"]:
+            sha256 = file_record.get("SHA256")
+            first_path = self.files.get(sha256) if sha256 else None
+            if first_path is None or first_path == file_record["Path"] or not os.path.exists(first_path):
+                if sha256 and os.path.exists(file_record["Path"]):
+                    self.files[sha256] = file_record["Path"]
+                kept.append(file_record)
+                continue
+            if os.path.exists(file_record["Path"]):
+                os.remove(file_record["Path"])
+            links = record["Links"]
+            # links from dlfiles use PATH + "/" + name; file records use os.path.join
+            for path in (file_record["Path"], os.path.normpath(file_record["Path"])):
+                if links["Link"] == path:
+                    links["Link"] = first_path
+                links["Attachments"] = [first_path if link == path else link for link in links["Attachments"]]
+            logfile.write("[%s] %s is the same as %s; kept one copy\n" % (dtime(), os.path.basename(file_record["Path"]), os.path.basename(first_path)))
+            count_metric("files", "duplicate")
+            count_metric("file_bytes", "duplicate", file_record["Size"])
+        record["Files"] = kept
+
+    def near_duplicate_group(self, record):
+        """The group of an earlier comment nearly the same as the record (DEDUP_NEAR_DUPLICATES), or "".
+
+        Comments are compared only with comments that share a band of their MinHash signature.
+        """
+        signature = record.get("MinHash")
+        if not signature:
+            return ""
+        rows = len(signature) // MINHASH_BANDS
+        bands = [(band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(MINHASH_BANDS)]
+        best_ID, best_similarity = "", DEDUP_SIMILARITY
+        for candidate in set(self.bands[band] for band in bands if band in self.bands):
+            similarity = sum(a == b for a, b in zip(signature, self.signatures[candidate])) / float(len(signature))
+            if similarity >= best_similarity:
+                best_ID, best_similarity = candidate, similarity
+        if best_ID:
+            count_metric("records", "near_duplicate")
+            return best_ID
+        self.signatures[record["ID"]] = signature
+        for band in bands:
+            self.bands.setdefault(band, record["ID"])
+        return ""
+
+    def known_attachments(self, fingerprint, attachments):
+        """Attachments of an earlier comment with the same text and the same attachment types (DEDUP_SKIP_KNOWN_ATTACHMENTS).
+
+        Called by the download threads, so the earlier comment is the first one downloaded, not the first in documentId order.
+
+        Arg:
+                fingerprint: comment_hash of the comment
+                attachments: the comment's DocumentRecord attachments
+        Returns:
+                List of file records to link (see link_known_attachments), or None to download the attachments.
+        """
+        if not fingerprint:
+            return None
+        with self.lock:
+            known = self.form_letters.get(fingerprint)
+        if known is None or known[0] != attachment_types(attachments):
+            return None
+        return known[1]
+
+    def remember_attachments(self, fingerprint, document_ID, attachments, file_records):
+        """Keeps the attachments of the first comment downloaded with a given text, for known_attachments."""
+        if not fingerprint or not attachments:
+            return
+        known = []
+        for file_record in file_records:
+            match = re.search("attachmentNumber=([0-9]+)", file_record["URL"])
+            if match is None or not file_record.get("SHA256"):
+                continue
+            known.append({"ID":document_ID, "URL":file_record["URL"], "Path":file_record["Path"], "Size":file_record["Size"],
+                "SHA256":file_record["SHA256"], "Suffix":"_" + match.group(1) + os.path.splitext(file_record["Path"])[1]})
+        if len(known) != len(attachments):
+            return # an attachment could not be downloaded; do not reuse a partial set
+        with self.lock:
+            self.form_letters.setdefault(fingerprint, (attachment_types(attachments), known))
+
+def attachment_types(attachments):
+    """The content types of each attachment's file formats, ex: [["pdf"], ["docx", "pdf"]]"""
+    return [[urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get("contentType", [""])[0] for url in file_formats]
+        for file_formats in attachments]
+
+def search_available():
+    """Whether records are indexed for full text search: SEARCH_INDEX is set and SQLite has FTS5.
+
+    FTS5 is checked once per process; without it a warning is printed and jobs run without indexing.
+    """
+    global search_fts5
+    if not SEARCH_INDEX:
+        return False
+    if search_fts5 is None:
+        try:
+            sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE fts5_check USING fts5(text)")
+            search_fts5 = True
+        except sqlite3.OperationalError as e:
+            print("Full text search is turned off; this SQLite (%s) has no FTS5: %s" % (sqlite3.sqlite_version, e))
+            search_fts5 = False
+    return search_fts5
+
+def search_db():
+    """Opens (once per thread) the full text search index, creating its tables if needed.
+
+    Table search_documents has one row per record indexed in each job folder (a document can be in the
+    folders of several document type choices); the FTS5 table search_text holds the record's text under the same rowid.
+
+    Returns:
+            connection: sqlite3 connection to SEARCH_DB.
+    """
+    if getattr(search_local, "pid", None) == os.getpid():
+        return search_local.connection
+    connection = sqlite3.connect(SEARCH_DB, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    table = connection.execute("SELECT sql FROM sqlite_master WHERE name='search_documents'").fetchone()
+    if table is not None and "UNIQUE (folder, document_id)" not in table["sql"]:
+        # an index with one row per document ID for all folders; later jobs index their records again
+        connection.execute("DROP TABLE IF EXISTS search_documents")
+        connection.execute("DROP TABLE IF EXISTS search_text")
+    connection.execute("""CREATE TABLE IF NOT EXISTS search_documents (
+        id INTEGER PRIMARY KEY,
+        document_id TEXT NOT NULL,
+        docket TEXT NOT NULL,
+        document_type TEXT NOT NULL,
+        listed TEXT,
+        posted TEXT,
+        folder TEXT NOT NULL,
+        link TEXT NOT NULL,
+        duplicate_group TEXT NOT NULL DEFAULT '',
+        indexed REAL,
+        UNIQUE (folder, document_id))""")
+    connection.execute("CREATE INDEX IF NOT EXISTS search_documents_docket ON search_documents (docket)")
+    connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5(title, submitter, organization, comment, abstract, files, tokenize='porter unicode61')")
+    search_local.pid = os.getpid()
+    search_local.connection = connection
+    return connection
+
+def search_index(query, docket_ID="", document_Type="", limit=SEARCH_RESULTS, offset=0):
+    """Runs a full text search over the index, best matches (bm25) first.
+
+    Arg:
+            query: FTS5 query; if it is not valid FTS5 syntax its words are searched for instead
+            docket_ID: only search this docket ("" for all)
+            document_Type: only search this document type ("" for all)
+            limit: the number of results
+            offset: the number of results to skip
+    Returns:
+            List of dictionaries: docket, document ID, type, posted date, job folder, link within the folder,
+            duplicate group, title, submitter, organization, and a snippet of the matching text.
+    """
+    connection = search_db()
+    sql = """SELECT search_documents.docket, search_documents.document_id, search_documents.document_type, search_documents.posted,
+            search_documents.folder, search_documents.link, search_documents.duplicate_group,
+            search_text.title, search_text.submitter, search_text.organization,
+            snippet(search_text, -1, '<b>', '</b>', '...', 16) AS snippet
+        FROM search_text JOIN search_documents ON search_documents.id = search_text.rowid
+        WHERE search_text MATCH ? AND (? = '' OR search_documents.docket = ?) AND (? = '' OR search_documents.document_type = ?)
+        ORDER BY bm25(search_text, 5.0, 2.0, 2.0, 1.0, 1.0, 1.0) LIMIT ? OFFSET ?"""
+    try:
+        rows = connection.execute(sql, (query, docket_ID, docket_ID, document_Type, document_Type, limit, offset)).fetchall()
+    except sqlite3.OperationalError:
+        # not FTS5 syntax (ex: an unmatched quote); search for the words
+        words = " ".join('"%s"' % word.replace('"', '') for word in query.split() if word.replace('"', ''))
+        rows = connection.execute(sql, (words, docket_ID, docket_ID, document_Type, document_Type, limit, offset)).fetchall()
+    return [dict(row) for row in rows]
+
+def extract_text(file_path):
+    """Text of a downloaded file for the search index: html (tags removed), text, docx, and pdf if pdfminer.six is installed.
+
+    Returns:
+            The text (at most SEARCH_MAX_TEXT characters), or "" for other formats and files that cannot be read.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    try:
+        if extension in {".html", ".htm"}:
+            with open(file_path, encoding="utf-8", errors="replace") as html_file:
+                text = html.unescape(re.sub("<[^>]*>", " ", html_file.read(SEARCH_MAX_TEXT * 2)))
+        elif extension == ".txt":
+            with open(file_path, encoding="utf-8", errors="replace") as text_file:
+                text = text_file.read(SEARCH_MAX_TEXT)
+        elif extension == ".docx":
+            with zipfile.ZipFile(file_path) as docx:
+                document_xml = docx.read("word/document.xml").decode("utf-8", "replace")
+            # paragraphs (w:p) on lines of their own, text runs (w:t) joined
+            text = html.unescape("\n".join("".join(re.findall("<w:t(?: [^>]*)?>([^<]*)</w:t>", paragraph))
+                for paragraph in re.findall("<w:p[ >].*?</w:p>", document_xml, re.S)))
+        elif extension == ".pdf" and pdf_extract_text is not None:
+            text = pdf_extract_text(file_path, maxpages=1000)
+        else:
+            return ""
+    except Exception:
+        return "" # damaged, encrypted or mislabelled file
+    return " ".join(text.split())[:SEARCH_MAX_TEXT]
+
+def extract_record_text(record, PATH):
+    """Pipeline stage: extracts the text of a record's files for the search index (see SearchIndex).
+
+    Records resumed from the manifest that are already in the index are passed through untouched.
+
+    Arg:
+            record: the record returned by scan_record
+            PATH: The job folder.
+    Returns:
+            The record, with "SearchText" set to the text of its comment, abstract and other files.
+    """
+    if record is None:
+        return record
+    if record["Resumed"]:
+        indexed = search_db().execute("SELECT listed FROM search_documents WHERE folder=? AND document_id=?",
+            (os.path.basename(PATH), record["ID"])).fetchone()
+        if indexed is not None and indexed["listed"] == record["Listed"]:
+            return record
+    link = record["Links"]["Link"]
+    paths = [file_record["Path"] for file_record in record["Files"]]
+    # resumed duplicates link to files saved for another record
+    paths += [path for path in [link] + record["Links"]["Attachments"] if path not in paths and os.path.isabs(path)]
+    text = {"comment": [], "abstract": [], "files": []}
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        if record["Type"] == "Public Submission" and os.path.normpath(path) == os.path.normpath(link):
+            text["comment"].append(extract_text(path))
+        elif path.endswith("_abstract.html"):
+            text["abstract"].append(extract_text(path))
+        else:
+            text["files"].append(extract_text(path))
+    record["SearchText"] = dict((field, "\n".join(part for part in parts if part)) for field, parts in text.items())
+    return record
+
+class SearchIndex(object):
+    """Adds a docket's records to the full text search index as they arrive.
+
+    Records are kept in memory and written in one short transaction once SEARCH_COMMIT_RECORDS have
+    arrived or the first has waited SEARCH_COMMIT_SECONDS, so the shared index is never locked while
+    a job waits on the API. A record downloaded again into the same job folder replaces its earlier entry. The text comes from
+    extract_record_text.
+
+    Arg:
+            docket_ID: The docket number.
+            PATH: The job folder.
+    """
+    def __init__(self, docket_ID, PATH):
+        self.docket_ID = docket_ID
+        self.PATH = PATH
+        self.connection = search_db()
+        self.pending = []
+        self.pending_since = 0
+
+    def rollback(self):
+        """Drops the records added since the last commit (when the job fails)."""
+        self.pending = []
+
+    def add(self, record, duplicate_group):
+        """Indexes a record (skipped if extract_record_text found it already indexed)."""
+        text = record.get("SearchText")
+        if text is None:
+            return
+        link = record["Links"]["Link"]
+        if os.path.isabs(link):
+            link = os.path.relpath(link, self.PATH)
+        if not self.pending:
+            self.pending_since = time.time()
+        self.pending.append(((os.path.basename(self.PATH), record["ID"]),
+            (self.docket_ID, record["Type"], record["Listed"], record["Posted"][:10], os.path.basename(self.PATH), link, duplicate_group, time.time()),
+            (record["Title"], record["Submitter"], record["Organization"], text["comment"], text["abstract"], text["files"])))
+        if len(self.pending) >= SEARCH_COMMIT_RECORDS or time.time() - self.pending_since >= SEARCH_COMMIT_SECONDS:
+            self.commit()
+
+    def commit(self):
+        """Writes the records added since the last commit."""
+        if not self.pending:
+            return
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for (folder_name, document_ID), values, text_values in self.pending:
+                existing = self.connection.execute("SELECT id FROM search_documents WHERE folder=? AND document_id=?", (folder_name, document_ID)).fetchone()
+                if existing is None:
+                    rowid = self.connection.execute("""INSERT INTO search_documents (docket, document_type, listed, posted, folder, link, duplicate_group, indexed, document_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", values + (document_ID,)).lastrowid
+                else:
+                    rowid = existing["id"]
+                    self.connection.execute("""UPDATE search_documents SET docket=?, document_type=?, listed=?, posted=?, folder=?, link=?, duplicate_group=?, indexed=?
+                        WHERE id=?""", values + (rowid,))
+                    self.connection.execute("DELETE FROM search_text WHERE rowid=?", (rowid,))
+                self.connection.execute("INSERT INTO search_text (rowid, title, submitter, organization, comment, abstract, files) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (rowid,) + text_values)
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.pending = []
+
+def document_folder(document_Type, primary_on, supporting_on, comments_on):
+    """The makefolders folder ("Primary", "Supporting" or "Comments") for a document type, or None if the type was not requested."""
+    if primary_on and document_Type not in {"Supporting & Related Material","Public Submission"}:
+        return 'Primary'
+    elif supporting_on and document_Type=="Supporting & Related Material":
+        return 'Supporting'
+    elif comments_on and document_Type=="Public Submission":
+        return 'Comments'
+    return None
+
+def fetch_record(document_data, folder, primary_on, supporting_on, comments_on, manifest):
+    """Pipeline stage 1: gets the JSON data for one record of the docket listing.
+
+    Records already in the job folder's manifest are not downloaded again if the listing still has
+    the same postedDate and all of their files are still on disk.
+
+    Arg:
+            document_data: the record from the docket listing (documents.json)
+            folder: dictionary of paths returned by makefolders
+            primary_on: True if Primary Documents requested.
+            supporting_on: True if Supporting Documents requested.
+            comments_on: True if Comments requested.
+            manifest: dictionary of manifest entries returned by load_manifest
+    Returns:
+            None if the record is withdrawn or its document type was not requested. The record's manifest
+            entry, with "Resumed" True, if it can be reused. Otherwise a dictionary with the document ID,
+            document type, listing postedDate, output folder, and DocumentRecord for download_record.
+    """
+    #Do not download withdrawn documents
+    if document_data["documentStatus"]=="Withdrawn":
+        return None
+    document_ID = document_data["documentId"]
+    document_Type = document_data["documentType"]
+    folder_name = document_folder(document_Type, primary_on, supporting_on, comments_on)
+    if folder_name is None:
+        return None
+    doc_folder = folder[folder_name]
+    entry = manifest.get(document_ID)
+    if manifest_current(entry, document_data):
+        record = dict(entry, HTML="", Resumed=True, AttachmentCount=parse_count(entry.get("AttachmentCount")))
+        if document_Type=="Public Submission" and entry["Links"]["Link"] != "See attached":
+            with open(entry["Links"]["Link"]) as html_input_file:
+                record["HTML"] = "\n" + html_input_file.read()
+        return record
+    return {"ID":document_ID, "Type":document_Type, "Listed":document_data.get("postedDate"),
+        "Folder":doc_folder, "Document":get_document(document_ID), "Resumed":False}
+
+def parse_count(value):
+    """An attachmentCount from document.json as a number ('' or missing when there are none)."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+def download_record(record, logfile, dedup=None):
+    """Pipeline stage 2: downloads a record fetched by fetch_record (including attachments).
+
+    Arg:
+            record: the record returned by fetch_record
+            logfile: variable for logfile
+            dedup: the docket's DocketDedup, used for DEDUP_SKIP_KNOWN_ATTACHMENTS
+    Returns:
+            The record's manifest entry: a dictionary with the document ID, document type, the directory fields,
+            the links returned by dlcontent or dlcomments, the files saved, and the comment's fingerprints
+            (see comment_hash and minhash). "HTML" holds the comment's html for the all comments file and
+            "Resumed" is True if the entry came from the manifest.
+    """
+    if record is None or record["Resumed"]:
+        return record
+    document_ID = record["ID"]
+    document = record["Document"]
+    #Get chosen documents
+    file_records = []
+    fingerprint = ""
+    if record["Type"]=="Public Submission":
+        fingerprint = comment_hash(document.comment)
+        known_attachments = None
+        if DEDUP_SKIP_KNOWN_ATTACHMENTS and dedup is not None:
+            known_attachments = dedup.known_attachments(fingerprint, document.attachments)
+        # pass an empty string so only this comment's html comes back; docket_socket writes them in documentId order
+        links = dlcomments(document_ID, document, "", logfile, record["Folder"], file_records, known_attachments)
+        if DEDUP_SKIP_KNOWN_ATTACHMENTS and dedup is not None:
+            dedup.remember_attachments(fingerprint, document_ID, document.attachments, file_records)
+    else:
+        links = dlcontent(document_ID, document, logfile, record["Folder"], file_records)
+    # a record with a file that failed to download is downloaded again by the next run of the job (see manifest_current)
+    incomplete = "N/A" in links["Attachments"] or links["Link"] in ("N/A", ["N/A"])
+    if incomplete:
+        logfile.write("[%s] %s is missing files; it will be downloaded again by the next run\n" % (dtime(), document_ID))
+    record = {"ID":document_ID, "Type":record["Type"], "Listed":record["Listed"],
+        "Title":document.title, "Submitter":document.submitter_name, "Organization":document.organization_name,
+        "Posted":document.posted_date, "AttachmentCount":parse_count(document.attachment_count),
+        "Links":{"Link":links["Link"], "Attachments":links["Attachments"]},
+        "Files":file_records, "CommentHash":fingerprint, "HTML":links.get("HTML", ""), "Resumed":False, "Incomplete":incomplete}
+    if DEDUP_NEAR_DUPLICATES and fingerprint:
+        record["MinHash"] = minhash(document.comment)
+    return record
+
+def scan_record(record, quarantine_directory, scan_log):
+    """Pipeline stage 3: scans each of a record's files with clamd (see scan_file).
+
+    Files of a record reused from the manifest were scanned by the run that downloaded them; only
+    those that run could not scan are scanned.
+
+    Arg:
+            record: the record returned by download_record
+            quarantine_directory: Where flagged files are moved.
+            scan_log: The open antivirus_scan.log.
+    Returns:
+            The record, with "Scanned" set to a list of (file path, True if clamd scanned it), and "Quarantined"
+            to the paths of the files it quarantined (a record reused from the manifest keeps its earlier list).
+    """
+    if record is not None:
+        scanned = dict(record.get("Scanned", [])) if record["Resumed"] else {}
+        record["Scanned"] = [(file_record["Path"], scanned.get(file_record["Path"]) or
+            scan_file(file_record["Path"], quarantine_directory, scan_log, file_record.get("SHA256"))) for file_record in record["Files"]]
+        record["Quarantined"] = sorted(set(record.get("Quarantined", [])) | set(file_record["Path"] for file_record in record["Files"]
+            if not os.path.exists(file_record["Path"]) and os.path.exists(os.path.join(quarantine_directory, os.path.basename(file_record["Path"])))))
+    return record
+
+def run_pipeline(items, stages):
+    """Runs items through stages of worker threads joined by bounded queues.
+
+    Each stage is (name, function, workers): workers threads take items from the stage's queue, call
+    function on them, and put the results on the next stage's queue. The queues hold PIPELINE_QUEUE_SIZE
+    items, so a stage that falls behind makes the stages before it wait (backpressure), and no more than
+    PIPELINE_MAX_IN_FLIGHT items are in the pipeline at once. Results are yielded in the order of items.
+    If a stage raises an exception for an item, the later stages skip it and the exception is yielded
+    with it, so one failing item does not stop the others. If the caller stops early (closes the
+    generator, or it is garbage collected), the threads finish the item they are working on and exit.
+
+    Arg:
+            items: iterable of items
+            stages: list of (name, function taking the previous stage's result, number of threads)
+    Returns:
+            generator of (item, result of the last stage or None, exception or None), in the order of items.
+    """
+    stop = threading.Event()
+    slots = threading.Semaphore(PIPELINE_MAX_IN_FLIGHT)
+    queues = [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for stage in stages] + [queue.Queue()]
+    feed_error = []
+
+    def put(stage_queue, entry):
+        while not stop.is_set():
+            try:
+                stage_queue.put(entry, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def get(stage_queue):
+        # None once the pipeline is stopped, so no thread is left waiting on a queue nobody fills
+        while not stop.is_set():
+            try:
+                return stage_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        return None
+
+    def feed():
+        try:
+            for index, item in enumerate(items):
+                while not slots.acquire(timeout=1):
+                    if stop.is_set():
+                        return
+                put(queues[0], [index, item, item, None])
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            for worker in range(stages[0][2]):
+                put(queues[0], None)
+
+    def work(name, function, in_queue, out_queue):
+        while True:
+            entry = get(in_queue)
+            if entry is None:
+                return
+            if entry[3] is None:
+                started = time.time()
+                try:
+                    entry[2] = function(entry[2])
+                except Exception as e:
+                    entry[3] = e
+                observe("stage_seconds", name, time.time() - started, error=entry[3] is not None)
+            put(out_queue, entry)
+
+    def close_stage(workers, stage_number):
+        # once every worker of a stage is done, tell the workers of the next stage
+        for worker in workers:
+            worker.join()
+        next_workers = stages[stage_number + 1][2] if stage_number + 1 < len(stages) else 1
+        for worker in range(next_workers):
+            put(queues[stage_number + 1], None)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage_number, (name, function, workers) in enumerate(stages):
+        stage_threads = [threading.Thread(target=work, args=(name, function, queues[stage_number], queues[stage_number + 1]),
+            name="%s-%s" % (name, worker), daemon=True) for worker in range(workers)]
+        threads.extend(stage_threads)
+        threads.append(threading.Thread(target=close_stage, args=(stage_threads, stage_number), daemon=True))
+    for thread in threads:
+        thread.start()
+    finished = {}
+    next_index = 0
+    try:
+        while True:
+            entry = queues[-1].get()
+            if entry is None:
+                break
+            finished[entry[0]] = entry
+            for (name, function, workers), stage_queue in zip(stages, queues):
+                set_gauge("pipeline_queue_depth", name, stage_queue.qsize())
+            set_gauge("pipeline_reorder_buffer", "", len(finished))
+            # hand results back in order
+            while next_index in finished:
+                entry = finished.pop(next_index)
+                next_index += 1
+                slots.release()
+                yield entry[1], entry[2], entry[3]
+        if feed_error:
+            raise feed_error[0]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def load_manifest(PATH):
+    """Reads the manifest of records already downloaded into a job folder.
+
+    The manifest (MANIFEST_NAME) has one JSON entry per line, appended as each record is finished,
+    so a later entry for a document ID replaces an earlier one.
+
+    Arg:
+            PATH: the job folder
+    Returns:
+            Dictionary of manifest entries by document ID (empty if there is no manifest yet).
+    """
+    manifest = {}
+    try:
+        with open(os.path.join(PATH, MANIFEST_NAME)) as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # last line cut short when a job was interrupted
+                manifest[entry["ID"]] = entry
+    except FileNotFoundError:
+        pass
+    return manifest
+
+def manifest_current(entry, document_data):
+    """Checks whether a manifest entry can be reused instead of downloading the record again.
+
+    Arg:
+            entry: the manifest entry for the record, or None
+            document_data: the record from the docket listing (documents.json)
+    Returns:
+            True if the record has the same type and postedDate as when it was downloaded, none of its
+            files failed to download, and every file it saved is still on disk with the same size (or was quarantined).
+    """
+    if entry is None or entry["Type"] != document_data["documentType"] or entry["Listed"] != document_data.get("postedDate"):
+        return False
+    if entry.get("Incomplete"):
+        return False
+    quarantined = set(entry.get("Quarantined", []))
+    for file_record in entry["Files"]:
+        if file_record["Path"] in quarantined:
+            continue
+        try:
+            if os.stat(file_record["Path"]).st_size != file_record["Size"]:
+                return False
+        except OSError:
+            return False
+    return True
+
+def write_manifest_entry(manifest_file, record):
+    """Appends a finished record to the manifest (without its comment html, which is already on disk, or its search text).
+    Its scan results are kept, so the record's files are not scanned again when a later run reuses it."""
+    entry = dict((key, value) for key, value in record.items() if key not in {"HTML", "Resumed", "SearchText"})
+    manifest_file.write(json.dumps(entry) + "\n")
+    manifest_file.flush()
+
+def ordered_map(function, items, workers):
+    """Applies function to each item on a thread pool and yields the results in the order of items.
+
+    No more than 2*workers items are in flight at once, so results stream out as they are ready
+    and memory stays bounded however many items there are. Exceptions raised by function are
+    re-raised when their result is reached.
+
+    Arg:
+            function: function taking one item
+            items: iterable of items
+            workers: number of threads
+    Returns:
+            generator of function(item) for each item, in order.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def clamd_scan(file_path):
+    """Scans a file with clamd using the INSTREAM command.
+
+    Arg:
+            file_path: The file to scan.
+    Returns:
+            The name of the virus found, or None if the file is clean.
+    Raises:
+            OSError if clamd cannot be reached or cannot scan the file.
+    """
+    family = socket.AF_INET if isinstance(CLAMD_ADDRESS, tuple) else socket.AF_UNIX
+    with socket.socket(family, socket.SOCK_STREAM) as clamd:
+        clamd.settimeout(CLAMD_TIMEOUT)
+        clamd.connect(CLAMD_ADDRESS)
+        clamd.sendall(b"zINSTREAM\0")
+        with open(file_path, "rb") as scan_file:
+            while True:
+                chunk = scan_file.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                clamd.sendall(struct.pack("!L", len(chunk)) + chunk)
+        clamd.sendall(struct.pack("!L", 0))
+        reply = b""
+        while not reply.endswith(b"\0"):
+            data = clamd.recv(4096)
+            if not data:
+                break
+            reply += data
+    # ex: "stream: OK", "stream: Eicar-Test-Signature FOUND", "INSTREAM size limit exceeded. ERROR"
+    reply = reply.rstrip(b"\0").decode("utf-8", "replace")
+    if reply.endswith(" OK"):
+        return None
+    if reply.endswith(" FOUND"):
+        return reply[len("stream: "):-len(" FOUND")]
+    raise OSError("clamd could not scan %s: %s" % (file_path, reply))
+
+def scan_file(file_path, quarantine_directory, scan_log, sha256=None):
+    """Scans one downloaded file with clamd and quarantines it if a virus is found.
+
+    Flagged files are moved to quarantine_directory, dropped from the attachment cache,
+    and listed in scan_log the same way clamscan logs them.
+
+    Arg:
+            file_path: The file to scan.
+            quarantine_directory: Where flagged files are moved.
+            scan_log: The open antivirus_scan.log.
+            sha256: SHA-256 of the file, if it may be in the attachment cache.
+    Returns:
+            True if the file was scanned, False if clamd could not scan it.
+    """
+    started = time.time()
+    try:
+        virus = clamd_scan(file_path)
+    except FileNotFoundError:
+        return True # quarantined or removed already
+    except OSError as e:
+        observe("scan_seconds", "clamd", time.time() - started, error=True)
+        scan_log.write("%s: not scanned by clamd (%s)\n" % (file_path, e))
+        return False
+    observe("scan_seconds", "clamd", time.time() - started, os.path.getsize(file_path) if virus is None else 0)
+    if virus is not None:
+        count_metric("files", "quarantined")
+        os.makedirs(quarantine_directory, exist_ok=True)
+        os.replace(file_path, os.path.join(quarantine_directory, os.path.basename(file_path)))
+        if sha256:
+            uncache_attachment(sha256)
+        scan_log.write("%s: %s FOUND\n%s: moved to '%s'\n" % (file_path, virus, file_path, quarantine_directory))
+    return True
+
+class DocketZip(object):
+    """Zip archive of a job folder that is written as files are added, straight into the serving directory.
+
+    Each volume is written as a hidden .part file in zip_directory and renamed into place by close(),
+    so a partly written zip is never served. Files with an extension in STORED_EXTENSIONS are stored
+    without recompressing them. If ZIP_VOLUME_BYTES is set, a new volume is started once the current
+    one reaches that size.
+
+    A job run again for a folder (a refresh, or a job resumed after it stopped) starts from copies of the
+    zip(s) its last run published: a file added with the same size and modification time as its entry
+    there is kept as it is, so only new and changed files are compressed. Entries of files that are not
+    added again are dropped by close(); their bytes stay in the volume until more than ZIP_REUSE_MAX_WASTE
+    of it is dropped entries, and the next run rebuilds it.
+
+    Arg:
+            zip_directory: Where the zip file(s) are published (ZIPPATH).
+            PATH: The job folder; names in the zip are relative to it.
+    """
+    def __init__(self, zip_directory, PATH):
+        self.zip_directory = zip_directory
+        self.PATH = PATH
+        self.name = os.path.split(PATH)[1]
+        self.volumes = [] # .part path of each volume
+        self.archives = [] # open ZipFile of each volume
+        self.archive = None # the volume new files are written to
+        self.reused = {} # name: (archive, ZipInfo) of the entries from the last run not added again yet
+        if ZIP_REUSE_MAX_WASTE > 0:
+            self.reuse_published()
+
+    def published_names(self):
+        """The zip file names published for the job folder: name.zip, then name_1.zip, name_2.zip, ... in volume order."""
+        names = [self.name + ".zip"] if os.path.exists(os.path.join(self.zip_directory, self.name + ".zip")) else []
+        volumes = []
+        for path in glob.glob(os.path.join(self.zip_directory, glob.escape(self.name) + "_*.zip")):
+            number = re.match(re.escape(self.name) + "_([0-9]+)\\.zip$", os.path.basename(path))
+            if number:
+                volumes.append((int(number.group(1)), os.path.basename(path)))
+        return names + [name for number, name in sorted(volumes)]
+
+    def reuse_published(self):
+        """Opens copies (reflinks where the file system allows it) of the published zip(s) to add to."""
+        for zip_name in self.published_names():
+            zip_path = os.path.join(self.zip_directory, zip_name)
+            part_path = os.path.join(self.zip_directory, ".%s_%s.zip.part" % (self.name, len(self.volumes) + 1))
+            try:
+                with zipfile.ZipFile(zip_path) as published:
+                    entries = published.infolist()
+                live_bytes = 22 + sum(info.compress_size + 76 + 2*(len(info.filename.encode("utf-8")) + len(info.extra)) for info in entries)
+                if live_bytes < (1 - ZIP_REUSE_MAX_WASTE) * os.path.getsize(zip_path):
+                    continue # mostly replaced entries; its files are compressed again
+                link_file(zip_path, part_path, hard_link=False)
+                archive = zipfile.ZipFile(part_path, "a", zipfile.ZIP_DEFLATED, allowZip64=True)
+            except (OSError, zipfile.BadZipFile):
+                continue
+            self.volumes.append(part_path)
+            self.archives.append(archive)
+            self.archive = archive
+            for info in archive.infolist():
+                if info.filename in self.reused: # in an earlier volume too; keep the later one
+                    self.drop(*self.reused[info.filename])
+                self.reused[info.filename] = (archive, info)
+
+    def drop(self, archive, info):
+        """Leaves an entry of a reused volume out of its central directory."""
+        archive.filelist.remove(info)
+        del archive.NameToInfo[info.filename]
+        archive.comment = archive.comment # marks the archive changed, so close() writes its central directory
+
+    def add(self, file_path):
+        """Adds a file to the current volume, starting a new volume first if the current one is full.
+
+        A file already in a reused volume, unchanged, is kept there instead.
+        """
+        arcname = os.path.relpath(file_path, self.PATH)
+        if arcname in self.reused:
+            archive, info = self.reused.pop(arcname)
+            stat = os.stat(file_path)
+            modified = time.localtime(stat.st_mtime)
+            # zip times have a resolution of two seconds
+            if info.file_size == stat.st_size and info.date_time == tuple(modified[:5]) + (modified[5] // 2 * 2,):
+                count_metric("zip_files", "reused")
+                return
+            self.drop(archive, info)
+        if self.archive is None or (ZIP_VOLUME_BYTES and self.archive.fp.tell() >= ZIP_VOLUME_BYTES):
+            part_path = os.path.join(self.zip_directory, ".%s_%s.zip.part" % (self.name, len(self.volumes) + 1))
+            self.volumes.append(part_path)
+            self.archive = zipfile.ZipFile(part_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+            self.archives.append(self.archive)
+        if os.path.splitext(file_path)[1].lower() in STORED_EXTENSIONS:
+            compress_type = zipfile.ZIP_STORED
+        else:
+            compress_type = zipfile.ZIP_DEFLATED
+        started = time.time()
+        self.archive.write(file_path, arcname, compress_type)
+        count_metric("zip_files", "added")
+        observe("zip_seconds", "stored" if compress_type == zipfile.ZIP_STORED else "deflated", time.time() - started, os.path.getsize(file_path))
+
+    def discard(self):
+        """Deletes the zip without publishing it (the job stopped and will be run again). Does nothing once the zip is published."""
+        for archive in self.archives:
+            archive.close()
+        for part_path in self.volumes:
+            try:
+                os.remove(part_path)
+            except FileNotFoundError:
+                pass
+        self.archive = None
+        self.archives = []
+        self.volumes = []
+        self.reused = {}
+
+    def close(self):
+        """Finishes the zip and publishes it.
+
+        Returns:
+                The names of the published zip files: name.zip, or name_1.zip, name_2.zip, ... if split into volumes.
+        """
+        # files of the last run that are not in the job any more (withdrawn, quarantined, or failed this time)
+        for archive, info in self.reused.values():
+            self.drop(archive, info)
+        self.reused = {}
+        if self.archive is None: # nothing was added; publish an empty zip
+            self.archive = zipfile.ZipFile(os.path.join(self.zip_directory, ".%s_1.zip.part" % self.name), "w")
+            self.volumes.append(self.archive.filename)
+            self.archives.append(self.archive)
+        for archive in self.archives:
+            archive.close()
+        # reused volumes whose entries were all replaced are left out
+        volumes = [part_path for part_path, archive in zip(self.volumes, self.archives) if archive.filelist] or self.volumes[-1:]
+        for part_path in self.volumes:
+            if part_path not in volumes:
+                os.remove(part_path)
+        if len(volumes) == 1:
+            names = [self.name + ".zip"]
+        else:
+            names = ["%s_%s.zip" % (self.name, number) for number in range(1, len(volumes) + 1)]
+        # remove zips left by an earlier run of the same job that are not replaced
+        for zip_name in self.published_names():
+            if zip_name not in names:
+                os.remove(os.path.join(self.zip_directory, zip_name))
+        for part_path, zip_name in zip(volumes, names):
+            os.replace(part_path, os.path.join(self.zip_directory, zip_name))
+        self.archive = None
+        self.archives = []
+        self.volumes = [] # published; discard() leaves them alone
+        return names
+
 def getLinks(links, path):
     """Takes path locations and creates file links to be used in the xlsx directory.
 
@@ -347,25 +3476,84 @@ def getLinks(links, path):
     attachment = [l.replace(path,"")[1:] for l in links["Attachments"]]
     return {"Link":link, "Attachments":attachment}
 
-def docket_socket(directory, request_response, docket_ID, doctype, email):
+def file_sha256(file_path):
+    """SHA-256 of a file's content, as a hex digest."""
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def new_quarantined_files(PATH, quarantine_directory):
+    """The files in a job folder's quarantine that have not been emailed about (see QUARANTINE_REPORTED_NAME).
+
+    A file quarantined again by a later run, with the same name and content, counts as reported.
+    """
+    reported = set()
+    try:
+        with open(os.path.join(PATH, QUARANTINE_REPORTED_NAME)) as reported_file:
+            for line in reported_file:
+                try:
+                    reported.add(tuple(json.loads(line)))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return [file_path for file_path in sorted(glob.glob(os.path.join(quarantine_directory, "*")))
+        if (os.path.basename(file_path), file_sha256(file_path)) not in reported]
+
+def record_quarantine_reported(PATH, quarantine_files):
+    """Records quarantined files as emailed about, so later runs of the job do not report them again."""
+    with open(os.path.join(PATH, QUARANTINE_REPORTED_NAME), "a") as reported_file:
+        for file_path in quarantine_files:
+            reported_file.write(json.dumps([os.path.basename(file_path), file_sha256(file_path)]) + "\n")
+
+def write_metrics_summary(PATH, docket_ID, job_id, job_started):
+    """Writes the current job's metrics (see metrics_summary) to METRICS_NAME in the job folder.
+
+    Arg:
+            PATH: The job folder.
+            docket_ID: The docket downloaded.
+            job_id: ID of the queued job (None if not run from the queue).
+            job_started: time.time() when the job started.
+    """
+    summary = dict(metrics_summary(), docket=docket_ID, job_id=job_id,
+        started=job_started, finished=time.time(), wall_seconds=time.time() - job_started)
+    with open(os.path.join(PATH, METRICS_NAME), "w") as metrics_file:
+        json.dump(summary, metrics_file, indent=1, sort_keys=True)
+
+def docket_socket(directory, request_response, docket_ID, doctype, email, job_id=None, dedup=None, notify=True):
     """Downloads all comments, primary, or supporting documents (including attachments).
 
     Downloads all records requested for a docket ID number. Saves all attachments.
     Writes The file download times and file sizes to the logfile.
     When downloading comments, saves an xlsx directory, and one html file containing all html comments.
-    Every downloaded file is scanned with clamAV. If a virus is found, the file is quarantined and Rob Letzler is notified.
-    The entire folder is compressed and copied to the www folder on the server website.
+    Identical attachments and comments are stored once and marked with a duplicate group in the directory (see DocketDedup).
+    Every downloaded file is scanned with clamAV as soon as it is finished. If a virus is found, the file is quarantined and Rob Letzler is notified.
+    Files that pass the scan are added to a zip written straight to the www folder on the server website.
     Then an email is sent out to the user containing a file path to their requested zip folder.
 
     Arg:
             directory: Server file path used to save the documents
-            request_response: Request object for the docket number
+            request_response: Request object for the first page of the docket listing (None to fetch it here)
             docket_ID: Identification number of the docket to be downloaded (from Django form)
             doctype: Type of document to download (from Django form)
                 -"Comments", Primary Documents", "Supporting Documents"
+            email: Email address notified when the download is complete
+            job_id: ID of the queued job to report progress to (None if not run from the queue)
+            dedup: DocketDedup shared with the other dockets of a batch (None for a new one)
+            notify: False to skip the completion email (run_batch sends one for the whole batch)
     Returns:
-            Nothing. Downloads files.
+            True if the download completed, False if it failed.
     """
+    global rate_limit_docket
+    rate_limit_docket = docket_ID
+    reset_metrics()
+    job_started = time.time()
+    search = None
+    records = None
+    PATH = None
+    logfile = manifest_file = scan_log = folder_lock = docket_zip = None
     try:
         # Make doctype into booleans
         primary_on = "primary" in doctype
@@ -375,157 +3563,228 @@ def docket_socket(directory, request_response, docket_ID, doctype, email):
         # Create Directories
         folder = makefolders(directory, docket_ID, primary_on, supporting_on, comments_on)
         PATH = folder['Path']
-        # Start log file
-        logfile = open(os.path.join(PATH,"docket_socket_log_file.log"),'w+')
+        # a job run outside the queue for the same folder (docket_batch --run) finishes before this one starts
+        folder_lock = open(os.path.join(PATH, FOLDER_LOCK_NAME), "a")
+        try:
+            fcntl.flock(folder_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print("Waiting for the job using %s" % PATH)
+            fcntl.flock(folder_lock, fcntl.LOCK_EX)
+        update_job(job_id, folder=PATH)
+        record_storage_access(PATH)
+        # Start log file (appended to when an interrupted or earlier job for the folder is picked up)
+        logfile = open(os.path.join(PATH,"docket_socket_log_file.log"),'a+')
         logfile.write("[%s] Began download of %s for %s\n" %(dtime(), ", ".join(doctype), docket_ID))
+        # Records downloaded by an earlier run of this job are only fetched again if they changed
+        manifest = load_manifest(PATH)
+        if manifest:
+            logfile.write("[%s] Found %s records already downloaded in %s\n" % (dtime(), len(manifest), MANIFEST_NAME))
+        manifest_file = open(os.path.join(PATH, MANIFEST_NAME), 'a')
 
-        #request_response = check_quota_and_get("http://api.data.gov:80/regulations/v3/documents.json?api_key=06oqGOmSQFYA1K5d4cOQ3estOJ0TfokvaSERlwXq&countsOnly=0&dktid=%s&rpp=1000" % docket_ID)
-
-        #V2 could: keep a log in the Django database of the times certain requests were processed, so we could tell the user when their request will be processed
-        number_of_records = request_response.json().get("totalNumRecords")
+        if request_response is None:
+            request_response = check_quota_and_get(docket_listing_url(docket_ID))
+        first_page = request_response.json()
+        number_of_records = first_page.get("totalNumRecords")
         logfile.write("[%s] Found %s records in the entire directory (includes, Primary, Supporting, and Comments)\n" % (dtime(), number_of_records))
-        assert number_of_records > 0
-        list_of_records = request_response.json()["documents"]
-        # assign the list of records in the JSON response to a list and download
-        # if over 1000 records, iterate through the pages creating a master list of all records
-        # this is about the limit on the results per page that can be returned per request, NOT the hourly limit
-        if number_of_records > 1000:
-            record_count = 1000
-            while record_count < number_of_records: # will continue downloading until all record meta data has been concatenated into one directory
-                request_response = check_quota_and_get("http://api.data.gov:80/regulations/v3/documents.json?api_key=06oqGOmSQFYA1K5d4cOQ3estOJ0TfokvaSERlwXq&countsOnly=0&dktid=%s&rpp=1000&po=%s" % (docket_ID,record_count))
-                # concatenates into one large directory
-                list_of_records = list_of_records + request_response.json()["documents"]
-                record_count = len(list_of_records)
+        assert number_of_records > 0, 'No Docket found for Docket Number: %s' % docket_ID
+        update_job(job_id, records_total=number_of_records, records_done=0)
+        # list every record in the docket; pages after the first are fetched in parallel
+        # (RECORDS_PER_PAGE is about the limit on the results per page that can be returned per request, NOT the hourly limit)
+        listing_started = time.time()
+        list_of_records = list(list_docket_records(docket_ID, first_page))
+        observe("listing_seconds", "", time.time() - listing_started)
         # Check all records were captured in our directory list of records
         assert number_of_records == len(list_of_records)
         # Sort list by documentID
-        list_of_records=sorted(list_of_records, key=operator.itemgetter('documentId'))    
+        list_of_records.sort(key=operator.itemgetter('documentId'))    
         
-        # Create an Excel directory of records
-        fields = ('Document ID', 'Link','Document Type', 'Document Title', 
-         'Submitter Name', 'Organization Name', 'Date Posted', 'Attachment Count', 'Attachment Link(s)')
-        xls_directory = xlsxwriter.Workbook(os.path.join(PATH, docket_ID + "_directory.xlsx"))
-        worksheet = xls_directory.add_worksheet(docket_ID + " Directory")
-        worksheet.set_column('A:A', len(docket_ID)*1.4)    # Widen column A
-        worksheet.set_column('B:J', 18)    # Widen columns
-        date_format = xls_directory.add_format({'num_format': 'mm/dd/yyyy'})
-
-        # Write header in bold.
-        bold = xls_directory.add_format({'bold': True})
-        worksheet.write_row(0, 0, fields, bold) #write header
-        row = 1 #Directory starts on row 1 before Looping
-        blueU = xls_directory.add_format({'underline': True, 'font_color': 'blue'})
+        # Create a directory of records (xlsx, and CSV/Parquet if listed in DIRECTORY_FORMATS)
+        directory_writer = DirectoryWriter(PATH, docket_ID)
 
         if comments_on:
-            all_html_comments = ""
+            # comments are written to the all comments file(s) as they arrive, in documentId order
+            all_html_comments = CommentsWriter(PATH, docket_ID)
+
+        # Records go through a pipeline: fetch JSON data, download files, scan files with clamd
+        quarantine_path = os.path.normpath(os.path.join(PATH,"flagged_by_clam_AV/*"))
+        scan_log = open(os.path.join(PATH,"antivirus_scan.log"),'a')
+        unscanned = [] # (path, SHA-256 or None) of files clamd could not scan
+        # Files that pass the scan go straight into the zip in the www folder
+        docket_zip = DocketZip(ZIPPATH, PATH)
+
+        # Records are added to the full text search index as they arrive
+        search = SearchIndex(docket_ID, PATH) if search_available() else None
+        # Identical attachments and comments are stored once
+        if dedup is None:
+            dedup = DocketDedup()
+        dedup.start_docket(PATH)
 
         any_docs_downloaded = False
-        #for each element in the list of records
-        for document_data in list_of_records:
-            #Do not download withdrawn documents
-            if document_data["documentStatus"]=="Withdrawn":
+        attachments = 0
+        #each stage works on several records at a time; results come back in documentId order,
+        #so the directory and html comments stay in the same order
+        stages = [
+            ("metadata", lambda document_data: fetch_record(document_data, folder, primary_on, supporting_on, comments_on, manifest), METADATA_WORKERS),
+            ("download", lambda record: download_record(record, logfile, dedup), DOWNLOAD_WORKERS),
+            ("scan", lambda record: scan_record(record, quarantine_path[:-2], scan_log), SCAN_WORKERS)]
+        if search is not None:
+            stages.append(("extract", lambda record: extract_record_text(record, PATH), SEARCH_WORKERS))
+        records = run_pipeline(list_of_records, stages)
+        for records_done, (document_data, record, error) in enumerate(records):
+            if records_done % 25 == 0:
+                update_job(job_id, records_done=records_done, attachments=attachments)
+                save_job_metrics(job_id)
+                # stop here if the scheduler needs the worker; the records so far are in the manifest
+                check_preempted(job_id)
+            #Skip withdrawn documents and document types that were not requested
+            if error is None and record is None:
+                count_metric("records", "skipped")
                 continue
-        #   use the document API to learn more about each document ID, like OCC-2013-0003-0062
-        # ex http://api.data.gov:80/regulations/v3/document.json?api_key=06oqGOmSQFYA1K5d4cOQ3estOJ0TfokvaSERlwXq&documentId=OCC-2013-0003-0062
-            document_ID = document_data["documentId"]
-            document_Type = document_data["documentType"]
-            request_response = check_quota_and_get("http://api.data.gov:80/regulations/v3/document.json?api_key=06oqGOmSQFYA1K5d4cOQ3estOJ0TfokvaSERlwXq&documentId=%s" % document_ID)
-
-        #Get chosen documents
-            #Primary Documents
-            if primary_on and document_Type not in {"Supporting & Related Material","Public Submission"}:
-                primary_links = dlcontent(document_ID, request_response, logfile, folder['Primary'])
-                all_links = getLinks(primary_links, PATH)
-                any_docs_downloaded = True
-            #Supporting Documents
-            elif supporting_on and document_Type=="Supporting & Related Material":
-                supporting_links = dlcontent(document_ID, request_response, logfile, folder['Supporting'])
-                all_links = getLinks(supporting_links, PATH)
-                any_docs_downloaded = True
-            #Comments
-            elif comments_on and document_Type=="Public Submission":
-                comment_links = dlcomments(document_ID, request_response, all_html_comments, logfile, folder['Comments'])
-                all_html_comments = comment_links["HTML"]
-                all_links = getLinks(comment_links, PATH)
-                any_docs_downloaded = True
-            # Saved document to directory   
-            if ((primary_on and document_Type not in {"Supporting & Related Material","Public Submission"}) or 
-                (supporting_on and  document_Type=="Supporting & Related Material") or
-                (comments_on and document_Type=="Public Submission")):
-                title = getvalue(request_response.json(),"title")
-                submitter_name = getvalue(request_response.json(),"submitterName")
-                organization_name = getvalue(request_response.json(),"organization")
+            if error is None:
                 try:
-                    date_posted = request_response.json().get("postedDate")
-                except:
-                    date_posted = ""
-                if date_posted != "":
-                    reg = re.search("(.*?)T00", date_posted).group(1)
-                    try:
-                        date_posted = datetime.strptime(reg,'%Y-%m-%d')
-                        worksheet.write_datetime(row,6,date_posted,date_format)
-                    except:
-                        worksheet.write(row,6,"")
-                attachment_count = getvalue(request_response.json(),"attachmentCount")
-                #save meta data to xls directory
-                worksheet.write_row(row,0,(document_ID, '', document_Type, title,
-                    submitter_name, organization_name))
-                worksheet.write_number(row,7,int(attachment_count))
-                #Write Link
-                if all_links["Link"] == "See attached":
-                    worksheet.write(row, 1, "See attached")
-                else:
-                    worksheet.write(row, 1, '=HYPERLINK("%s")' % all_links["Link"], blueU)
-                #Write attachment links
-                col = 8
-                for attachment in all_links["Attachments"]:
-                    worksheet.write(row, col, '=HYPERLINK("%s")' % attachment, blueU)
-                    col += 1
-                row+=1
+                    duplicate_group = dedup.add_record(record, logfile)
+                    if not record["Resumed"]:
+                        write_manifest_entry(manifest_file, record)
+                    file_sha256 = dict((file_record["Path"], file_record.get("SHA256")) for file_record in record["Files"])
+                    for file_name_and_path, scanned in record["Scanned"]:
+                        if not scanned:
+                            unscanned.append((file_name_and_path, file_sha256.get(file_name_and_path)))
+                        elif os.path.exists(file_name_and_path): # not quarantined
+                            docket_zip.add(file_name_and_path)
+                    document_ID = record["ID"]
+                    document_Type = record["Type"]
+                    all_links = getLinks(record["Links"], PATH)
+                    if comments_on:
+                        all_html_comments.write(document_ID, record["HTML"])
+                    # Saved document to directory
+                    date_posted = None
+                    if record["Posted"] != "":
+                        try:
+                            reg = re.search("(.*?)T00", record["Posted"]).group(1)
+                            date_posted = datetime.strptime(reg,'%Y-%m-%d')
+                        except:
+                            date_posted = None
+                    #save meta data to directory
+                    directory_writer.write_row(document_ID, all_links["Link"], document_Type, record["Title"], record["Submitter"],
+                        record["Organization"], date_posted, record["AttachmentCount"], duplicate_group, all_links["Attachments"])
+                    if search is not None:
+                        search.add(record, duplicate_group)
+                    count_metric("records", "resumed" if record["Resumed"] else "downloaded")
+                    any_docs_downloaded = True
+                    attachments += record["AttachmentCount"]
+                    continue
+                except Exception as e:
+                    # one record that cannot be saved fails that record, not the job
+                    error = e
+            count_metric("records", "failed")
+            # record the failure in the log, directory and manifest and carry on; the record is retried by the next run of the job
+            logfile.write("[%s] Failed to download %s: %s\n" % (dtime(), document_data["documentId"], error))
+            directory_writer.write_row(document_data["documentId"], "Download failed", document_data["documentType"],
+                "%s: %s" % (type(error).__name__, error), "", "", None, 0, "", [])
+            write_manifest_entry(manifest_file, {"ID":document_data["documentId"], "Type":document_data["documentType"],
+                "Listed":document_data.get("postedDate"), "Files":[], "Incomplete":True})
 
 #        if any_docs_downloaded == False:
 #                    messages.error(request, 'The docket appears to contain none of the document type that you specified')
 #                    return render(request, 'html/error.html')    
-        if comments_on: #save all_html_comments
-            file_name_and_path = os.path.join(PATH, docket_ID + "_all_comments.html")
-            with open(file_name_and_path, "w") as html_output_file:
-                html_output_file.write(all_html_comments)
-            logfile.write("[%s] %s bytes\tDownloaded %s_all_comments.html\n" % (dtime(file_name_and_path), os.stat(file_name_and_path).st_size, document_ID))
+        if comments_on: #finish all_html_comments
+            for file_name_and_path in all_html_comments.close():
+                logfile.write("[%s] %s bytes\tDownloaded %s\n" % (dtime(file_name_and_path), os.stat(file_name_and_path).st_size, os.path.basename(file_name_and_path)))
         
         # Remove empty directories
         for s_target in os.listdir(PATH):
             s_path = os.path.join(PATH, s_target)
             if os.path.isdir(s_path) and not os.listdir(s_path):
                 os.rmdir(s_path)
-        xls_directory.close()
+        directory_writer.close()
+        manifest_file.close()
+        if search is not None:
+            search.commit()
+        log_request_stats(logfile)
+        freed = evict_cache() if CACHE_MAX_BYTES > 0 else 0
+        if freed:
+            logfile.write("[%s] Evicted %s bytes from the attachment cache\n" % (dtime(), freed))
         logfile.close()
 
-        # Run ClamAV virus scan on every file downloaded
-        project_path=PATH+"/*"
-        original_files = glob.glob(project_path)
+        # Scan the directory and all comments file too
+        for file_name_and_path in glob.glob(os.path.join(PATH, glob.escape(docket_ID) + "_*")):
+            if not scan_file(file_name_and_path, quarantine_path[:-2], scan_log):
+                unscanned.append((file_name_and_path, None))
+            elif os.path.exists(file_name_and_path):
+                docket_zip.add(file_name_and_path)
+        scan_log.close()
 
-        quarantine_path = os.path.normpath(os.path.join(PATH,"flagged_by_clam_AV/*"))
-        os.makedirs(quarantine_path[:-2],exist_ok=True)
-        print(os.path.join(project_path[:-2],"antivirus_scan.log"))
-        subprocess.run(["clamscan", project_path[:-2], "--recursive", "--move="+quarantine_path[:-2], "--log="+os.path.join(project_path[:-2],"antivirus_scan.log")])
-        post_scan_files = glob.glob(project_path)
-        quarantine_files = glob.glob(quarantine_path)
+        if unscanned:
+            # clamd could not scan these files (ex: larger than its StreamMaxLength): scan just them with clamscan
+            with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file_list:
+                file_list.write("".join(file_name_and_path + "\n" for file_name_and_path, sha256 in unscanned))
+            os.makedirs(quarantine_path[:-2],exist_ok=True)
+            clamscan_started = time.time()
+            try:
+                subprocess.run(["clamscan", "--file-list=" + file_list.name, "--max-filesize=4000M", "--max-scansize=4000M",
+                    "--move=" + quarantine_path[:-2], "--log=" + os.path.join(PATH, "antivirus_scan.log")])
+            finally:
+                os.remove(file_list.name)
+            observe("scan_seconds", "clamscan", time.time() - clamscan_started)
+            for file_name_and_path, sha256 in unscanned:
+                if os.path.exists(file_name_and_path):
+                    docket_zip.add(file_name_and_path)
+                elif os.path.exists(os.path.join(quarantine_path[:-2], os.path.basename(file_name_and_path))):
+                    count_metric("files", "quarantined")
+                    if sha256:
+                        uncache_attachment(sha256)
+        # only files not reported by an earlier run of the job are emailed about
+        quarantine_files = new_quarantined_files(PATH, quarantine_path[:-2])
         print(quarantine_files)
-        if quarantine_files==[]:
-            #number can grow if we add an antivirus log; or stay the same if the antivirus log already existed or could not be created.  that is not worrying
-            assert len(post_scan_files)>=len(original_files), "The number of files dropped during the virus scan, but no viruses were quarantined.  Something's odd!"
-        else:
+        if quarantine_files!=[]:
 #            print(str(['File(s) in your docket download flagged as potential viruses', 'clamAV flagged files in your docket download and moved them to ' + quarantine_path[:-2] + "\n Rob Letzler in ARM has been notified and will investigate. The following files were quarantined and not included in your ZIP file:  " +str(quarantine_files), 'letzlerr@gao.gov', [email, "letzlerr@gao.gov"]]))
             send_mail('File(s) in your docket download flagged as potential viruses', 'clamAV flagged files in your docket download and moved them to ' + quarantine_path + "\n Rob Letzler in ARM has been notified and will investigate. The following files were quarantined and not included in your ZIP file:  " +str(quarantine_files), 'letzlerr@gao.gov', [email, "letzlerr@gao.gov"], fail_silently=False)
+            record_quarantine_reported(PATH, quarantine_files)
 
-
-        #zip all files downloaded, including log and directory
-        shutil.make_archive(PATH, 'zip', PATH)
-        #Copy zip file to www folder and send email
-        ZIPPATH="/var/www/docket"
-        shutil.copy(PATH+".zip",ZIPPATH)
-        #os.remove(PATH) #Uncomment if we want to delete original folder
-        print("/docket/"+os.path.split(PATH)[1]+".ZIP")
-        send_mail('Your docket download is complete', 'Your docket download is complete and is available from [WEB ADDRESS TBD]/docket/' + os.path.split(PATH)[1] + '.ZIP', 'letzlerr@gao.gov', [email], fail_silently=False)
+        update_job(job_id, records_done=number_of_records, attachments=attachments)
+        # Save the job's timings and totals to the job folder and the jobs database
+        write_metrics_summary(PATH, docket_ID, job_id, job_started)
+        save_job_metrics(job_id)
+        #finish the zip with the logs, manifest and metrics, publish it to the www folder, and send email
+        for file_name in ("docket_socket_log_file.log", "antivirus_scan.log", MANIFEST_NAME, METRICS_NAME):
+            docket_zip.add(os.path.join(PATH, file_name))
+        zip_names = docket_zip.close()
+        # the job folder is kept for later jobs to resume from until enforce_retention deletes it
+        record_storage(PATH, zip_names, number_of_records)
+        print(["/docket/" + zip_name for zip_name in zip_names])
+        update_job(job_id, zips=",".join(zip_names))
+        if notify and len(zip_names) == 1:
+            send_mail('Your docket download is complete', 'Your docket download is complete and is available from [WEB ADDRESS TBD]/docket/' + os.path.split(PATH)[1] + '.ZIP', 'letzlerr@gao.gov', [email], fail_silently=False)
+        elif notify:
+            send_mail('Your docket download is complete', 'Your docket download is complete and is available in %s parts from:\n' % len(zip_names) + "\n".join('[WEB ADDRESS TBD]/docket/' + zip_name for zip_name in zip_names), 'letzlerr@gao.gov', [email], fail_silently=False)
+        return True
+    except JobPreempted:
+        # keep what was downloaded for the next run of the job, which resumes from the manifest
+        records.close()
+        logfile.write("[%s] Preempted after %s records; the job is back on the queue\n" % (dtime(), records_done))
+        if search is not None:
+            search.commit()
+        save_job_metrics(job_id)
+        record_storage_size(PATH)
+        raise
     except Exception as e:
         print("Failed to download data due to {}".format(e))
+        if records is not None:
+            records.close()
+        if search is not None:
+            search.rollback()
+        if logfile is not None and not logfile.closed:
+            logfile.write("[%s] Failed: %s\n" % (dtime(), e))
+        update_job(job_id, error=str(e))
+        save_job_metrics(job_id)
+        if PATH is not None:
+            record_storage_size(PATH)
+        return False
+    finally:
+        # a job that failed or was preempted leaves no open files, and no unpublished zip in the www folder;
+        # the folder lock is released last
+        if docket_zip is not None:
+            docket_zip.discard()
+        for open_file in (logfile, manifest_file, scan_log, folder_lock):
+            if open_file is not None:
+                open_file.close()